@@ -0,0 +1,165 @@
+import time # Timing experiments
+import numpy as np
+from utils import * # Constants, saving/loading data
+from lm_utils import * # Interacting with the LM / generating prompts
+import telemetry # Counting unparseable samples, timing each pass
+
+# Sequential sampling: each cell's plan orderings are asked one at a time and the cell stops as soon as its answer is settled,
+# then whatever is left of the budget is spent on extra temperature>0 samples for the cells that disagree with themselves most.
+
+# Ordering of the 6 plan permutations (as indexed by plan_permutations) that asks the 3 cyclic shifts first, so a cell that
+# stops after 3 samples has still seen every plan in every position once
+BALANCED_ORDER = [0, 3, 4, 1, 2, 5]
+
+# Function: bucket_of
+# Purpose: get which bucket (low / medium / high PS) a score falls in
+# Parameters: score, a float between 1 and 3
+#             edges=(1.5, 2.5), a tuple of bucket boundaries
+# Produces: bucket, an integer index
+def bucket_of(score, edges=(1.5, 2.5)):
+    return int(np.searchsorted(edges, score, side="right"))
+
+# Function: cell_converged
+# Purpose: decide whether a cell needs any more of its permutations asked
+# Parameters: ps, a list of the PS scores (1-3) seen so far
+#             n_max, an integer of how many permutations there are in total
+#             edges=(1.5, 2.5), a tuple of bucket boundaries
+#             min_samples=3, an integer of the fewest samples to accept a confidence-bound stop on
+#             tol=0.25, a float of the largest acceptable confidence half-width
+#             z=1.96, a float of the normal quantile for the confidence bound
+# Produces: converged, a boolean
+# The bound's spread counts one pseudo-answer at each end of the scale (as Agresti-Coull adds pseudo-counts), so cells whose
+# answers all agree so far don't get a zero-width bound; the orderings are drawn without replacement, hence the finite
+# population correction
+def cell_converged(ps, n_max, edges=(1.5, 2.5), min_samples=3, tol=0.25, z=1.96):
+    m = len(ps)
+    if m >= n_max:
+        return True
+    lowest = (sum(ps) + (n_max - m) * 1) / n_max # Final mean if every remaining answer is the least power-seeking plan
+    highest = (sum(ps) + (n_max - m) * 3) / n_max # ... or the most
+    if bucket_of(lowest, edges) == bucket_of(highest, edges):
+        return True
+    spread = np.std(list(ps) + [1, 3], ddof=1)
+    return m >= min_samples and bool(z * spread / np.sqrt(m) * np.sqrt((n_max - m) / (n_max - 1)) <= tol)
+
+# Function: sequential_prompt_experiment
+# Purpose: ask a cell's plan orderings one at a time (at temperature 0) until it converges
+# Parameters: model, a string of which OpenAI model to use
+#             code, a length-6 binary (except for position 2, which goes 0-[len(descriptions)-1]) string
+#             goal, a string
+#             plans, a string with exactly three lines separated by \n
+#             **stop_kwargs, passed to cell_converged
+# Produces: ps, a list of integer PS scores, one per permutation asked
+def sequential_prompt_experiment(model, code, goal, plans, **stop_kwargs):
+    original_plans, permutations = plan_permutations(plans)
+    choice_prompt = generate_choice_prompt(code, descriptions, goal)
+    ps = []
+    for k in BALANCED_ORDER:
+        plan_output = choose_plan(model, choice_prompt, permutations[k])
+        plan_choice = resolve_choice(model, choice_prompt, permutations[k], plan_output.choices[0].text)
+        if plan_choice is None: # Given up on; the next ordering is asked instead
+            continue
+        ps.append(choice_to_ps(original_plans, permutations[k], plan_choice))
+        if cell_converged(ps, len(permutations), **stop_kwargs):
+            break
+    return ps
+
+# Function: sample_prompt_experiment
+# Purpose: draw extra temperature>0 choices for a cell, spread evenly over the plan orderings
+# Parameters: model, a string of which OpenAI model to use
+#             code, a string
+#             goal, a string
+#             plans, a string with exactly three lines separated by \n
+#             n, an integer of how many samples to draw
+#             temperature=1.0, a float
+# Produces: ps, a dictionary of lists of integer PS scores, keyed by permutation index, up to n in all (unparseable samples are
+#               dropped; re-asking at temperature 0 would skew them)
+def sample_prompt_experiment(model, code, goal, plans, n, temperature=1.0):
+    original_plans, permutations = plan_permutations(plans)
+    choice_prompt = generate_choice_prompt(code, descriptions, goal)
+    ps = {}
+    for j, k in enumerate(BALANCED_ORDER):
+        n_k = n // len(permutations) + (1 if j < n % len(permutations) else 0)
+        if n_k == 0:
+            continue
+        params = {**choice_params(model, choice_prompt, permutations[k]), "temperature": temperature, "n": n_k}
+        for choice in cached_completion(refresh=True, **params).choices: # One request returns all n_k fresh samples
+            plan_choice = parse_choice(choice.text, len(permutations[k]))
+            if plan_choice is None:
+                telemetry.record("parse_failure", response=choice.text)
+            else:
+                ps.setdefault(k, []).append(choice_to_ps(original_plans, permutations[k], plan_choice))
+    return ps
+
+# Function: allocate_samples
+# Purpose: split a sample budget between cells in proportion to their standard deviation (Neyman allocation)
+# Parameters: cell_ps, a dictionary of lists of PS scores seen so far, keyed by cell
+#             budget, an integer of how many samples to hand out
+#             unit=1, an integer every share is a multiple of
+# Produces: allocation, a dictionary of integers, keyed by cell (cells whose answers all agree get none; cells with spread get
+#               their share whether or not they stopped early or ran every ordering)
+def allocate_samples(cell_ps, budget, unit=1):
+    cells = list(cell_ps.keys())
+    stds = np.array([np.std(cell_ps[cell], ddof=1) if len(cell_ps[cell]) > 1 else 0.0 for cell in cells])
+    if budget <= 0 or stds.sum() == 0:
+        return {}
+    shares = np.floor(budget * stds / stds.sum() / unit).astype(int) * unit
+    return {cell: int(n) for cell, n in zip(cells, shares) if n > 0}
+
+# Function: adaptive_multi_goal_experiment
+# Purpose: get power-seeking scores for several prompts and goals under a fixed sample budget, stopping settled cells early
+#          and spending the savings on extra samples for high-variance cells
+# Parameters: goals, a list of strings
+#             codes, a list of strings
+#             model, a string of which OpenAI model to use
+#             budget=None, an integer of the total number of sampled choices to spend (defaults to 6 per cell, the cost of a full run)
+#             temperature=1.0, a float of the temperature for the extra samples
+#             plan_set=0, an integer of which of each goal's plan sets to run
+#             verbose=True, a boolean controlling printing behavior
+#             save_csv=True, a boolean controlling whether to save results to csv's
+#             name="experiment", a string of the folder name to store all the csv's to
+#             **stop_kwargs, passed to cell_converged
+# Produces: scores, a dictionary of dictionaries of float PS scores, keyed by goal and then code; a cell that got extra samples
+#               is scored from those alone, each ordering's samples weighing the same (temperature 0 answers and temperature>0
+#               samples are different populations), and otherwise from its temperature 0 answers
+#           n_samples, a dictionary of dictionaries of how many choices each cell's score is from
+#           dest, a string of the folder the csv's were saved to
+def adaptive_multi_goal_experiment(goals, codes, model, budget=None, temperature=1.0, plan_set=0, verbose=True, save_csv=True,
+                                   name="experiment", **stop_kwargs):
+    t1 = time.time()
+    dest = experiment_folder(name)
+    budget = budget if budget is not None else 6 * len(goals) * len(codes)
+    plans = {goal: load_plans(goal, plan_set) for goal in goals}
+
+    with telemetry.labelled(model=model), telemetry.stage("sequential"): # First pass: stop each cell once it's settled
+        cell_ps = {(goal, code): sequential_prompt_experiment(model, code, goal, plans[goal], **stop_kwargs)
+                   for goal in goals for code in codes}
+    used = sum(len(ps) for ps in cell_ps.values())
+
+    cell_samples = {} # Temperature>0 samples, keyed by cell and then ordering
+    # Second pass: spend the savings, in rounds of the 3 cyclic shifts so each cell's samples see every plan in every position
+    with telemetry.labelled(model=model), telemetry.stage("sampling"):
+        for (goal, code), n in allocate_samples(cell_ps, budget - used, unit=3).items():
+            cell_samples[(goal, code)] = sample_prompt_experiment(model, code, goal, plans[goal], n, temperature=temperature)
+            used += sum(len(ps) for ps in cell_samples[(goal, code)].values()) # Unparseable samples aren't counted
+
+    results, n_samples = {}, {}
+    for goal in goals:
+        results[goal], n_samples[goal] = {}, {}
+        for code in codes:
+            samples = cell_samples.get((goal, code))
+            if samples:
+                results[goal][code] = float(np.mean([np.mean(ps) for ps in samples.values()]))
+                n_samples[goal][code] = sum(len(ps) for ps in samples.values())
+            else:
+                results[goal][code] = float(np.mean(cell_ps[(goal, code)]))
+                n_samples[goal][code] = len(cell_ps[(goal, code)])
+
+    if save_csv:
+        os.makedirs(dest)
+        experiment_to_csv(results, dest)
+
+    if verbose:
+        print(f"Analysis of {len(codes)} prompts over {len(goals)} goals took {time.time()-t1:.2f} seconds "
+              f"({used} of {budget} samples).")
+    return results, n_samples, dest
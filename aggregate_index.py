@@ -0,0 +1,246 @@
+import hashlib # Index file names for model names
+import heapq # Top-n queries
+import itertools
+import os
+import pickle
+import numpy as np
+from utils import descriptions, ps_not_set, scaled_set, by_scale_set, genre_set
+from code_tensor import code_shape
+from run_log import check_one_model # Indexes are of one model
+
+# Aggregate index: running sums and counts of cell scores (a cell is a (goal, code), scored as the mean of its rows) for every goal,
+# code, factor level, pair of factor levels, goal x factor level and goal set, updated as rows arrive. Marginals, goal-set averages
+# and top-n lists are then read off the sums instead of re-averaging the nested dictionaries for every plot and report. Averages
+# weight every cell run equally, which on a full design is the same as the CodeTensor / utils averages.
+#
+# load_store_index keeps an index next to a result store's parts (store/_index.pkl, which pyarrow skips) and only reads the parts
+# added since it was saved.
+
+GOAL_SETS = {"ps_not": ps_not_set, "scaled": scaled_set, "by_scale": by_scale_set, "genre": genre_set}
+
+# Class: AggregateIndex
+# Purpose: sums and counts of cell scores by every grouping the reports and figures use, kept up to date cell by cell
+# Parameters: goal_sets=GOAL_SETS, a dictionary of goal set dictionaries (set name: list of goals), keyed by family name
+class AggregateIndex:
+    def __init__(self, goal_sets=None):
+        self.cells = {} # [sum, count] of rows, keyed by (goal, code)
+        self.total = [0.0, 0] # [sum, count] of cell means, in this and the tables below
+        self.goals, self.codes = {}, {}
+        self.levels = {} # Keyed by (axis, level)
+        self.pairs = {} # Keyed by (axis a, level of a, axis b, level of b), a < b
+        self.goal_levels = {} # Keyed by (goal, axis, level)
+        self.sets, self.set_codes = {}, {} # Keyed by (family, set name) and (family, set name, code)
+        self.goal_sets = {}
+        self.memberships = {} # (family, set name) pairs of each goal
+        self.n_axes, self.max_level = None, []
+        self.parts = {} # (size, modification time) of each store part read in, keyed by file name
+        self.models = set() # Models of the store rows added
+        for family, sets in (GOAL_SETS if goal_sets is None else goal_sets).items():
+            self.add_goal_sets(family, sets)
+
+    # Build from a dictionary of dictionaries, keyed by goal and then code
+    @classmethod
+    def from_experiment(cls, ps_scores, goal_sets=None):
+        index = cls(goal_sets)
+        for goal in ps_scores:
+            for code, score in ps_scores[goal].items():
+                index.add(goal, code, float(score))
+        return index
+
+    # Add n rows of a cell whose scores total total (one choice, or a cell imported already averaged)
+    def add(self, goal, code, total, n=1):
+        cell = self.cells.setdefault((goal, code), [0.0, 0])
+        old = cell[0] / cell[1] if cell[1] else 0.0
+        cell[0] += total
+        cell[1] += n
+        delta, new = cell[0] / cell[1] - old, int(cell[1] == n)
+        if self.n_axes is None:
+            self.n_axes, self.max_level = len(code), [0] * len(code)
+        levels = [int(c) for c in code]
+        self.max_level = [max(m, level) for m, level in zip(self.max_level, levels)]
+        self.total[0] += delta
+        self.total[1] += new
+        for table, key in self.cell_keys(goal, code, levels):
+            sums = table.setdefault(key, [0.0, 0])
+            sums[0] += delta
+            sums[1] += new
+
+    # Every (table, key) a cell counts towards
+    def cell_keys(self, goal, code, levels):
+        keys = [(self.goals, goal), (self.codes, code)]
+        for axis, level in enumerate(levels):
+            keys += [(self.levels, (axis, level)), (self.goal_levels, (goal, axis, level))]
+        for a, b in itertools.combinations(range(len(levels)), 2):
+            keys.append((self.pairs, (a, levels[a], b, levels[b])))
+        for family, name in self.memberships.get(goal, []):
+            keys += [(self.sets, (family, name)), (self.set_codes, (family, name, code))]
+        return keys
+
+    # Index another family of goal sets, counting the cells already added
+    def add_goal_sets(self, family, goal_sets):
+        self.goal_sets[family] = {name: list(members) for name, members in goal_sets.items()}
+        for name, members in goal_sets.items():
+            for goal in members:
+                self.memberships.setdefault(goal, []).append((family, name))
+        for (goal, code), (s, n) in self.cells.items():
+            for name, members in goal_sets.items():
+                if goal in members:
+                    for table, key in [(self.sets, (family, name)), (self.set_codes, (family, name, code))]:
+                        sums = table.setdefault(key, [0.0, 0])
+                        sums[0] += s / n
+                        sums[1] += 1
+
+    # Number of levels of each factor (at least code_shape's, for the usual 6-aspect codes)
+    def shape(self):
+        seen = tuple(m + 1 for m in self.max_level)
+        if self.n_axes == 6:
+            return tuple(max(a, b) for a, b in zip(seen, code_shape(max(len(descriptions), seen[2]))))
+        return seen
+
+    # Score of one cell
+    def cell(self, goal, code):
+        s, n = self.cells[(goal, code)]
+        return s / n
+
+    # Back to a dictionary of dictionaries, keyed by goal and then code
+    def to_experiment(self):
+        result = {}
+        for (goal, code), (s, n) in self.cells.items():
+            result.setdefault(goal, {})[code] = s / n
+        return result
+
+    # Average PS score of each goal (like goal_averages)
+    def goal_averages(self):
+        return {goal: s / n for goal, (s, n) in self.goals.items()}
+
+    # Average PS score of each code over all goals (like aggregate_over_goals)
+    def code_averages(self):
+        return {code: s / n for code, (s, n) in self.codes.items()}
+
+    # Average of each set in a family of goal sets
+    def set_averages(self, family):
+        return {name: self.sets[(family, name)][0] / self.sets[(family, name)][1]
+                for name in self.goal_sets[family] if (family, name) in self.sets}
+
+    # Average PS score of each code over each set in a family of goal sets (like group_goals), sets with no goals run left out
+    def group(self, family, codes=None):
+        codes = list(self.codes) if codes is None else codes
+        result = {}
+        for name in self.goal_sets[family]:
+            if (family, name) in self.sets:
+                result[name] = {code: mean(self.set_codes.get((family, name, code))) for code in codes}
+        return result
+
+    # Top n goals / codes by average PS score, as (key, score) pairs (like sort_dict(...)[:n])
+    def top_goals(self, n=20):
+        return heapq.nlargest(n, self.goal_averages().items(), key=lambda x: x[1])
+
+    def top_codes(self, n=20):
+        return heapq.nlargest(n, self.code_averages().items(), key=lambda x: x[1])
+
+    # Average PS score at each level of one factor, NaN for levels with no cells
+    def marginal(self, axis):
+        return np.array([mean(self.levels.get((axis, level))) for level in range(self.shape()[axis])])
+
+    # Average score for every combination of levels of two factors, shape (levels of variates[1], levels of variates[0]), as
+    # CodeTensor.variates_grid
+    def variates_grid(self, variates):
+        a, b = sorted(variates)
+        shape = self.shape()
+        grid = np.array([[mean(self.pairs.get((a, la, b, lb))) for lb in range(shape[b])] for la in range(shape[a])])
+        return grid if variates[0] > variates[1] else grid.T
+
+    # Average score for each goal and each level of one factor, shape (n_goals, levels of variate), as CodeTensor.goals_vs_variate
+    def goals_vs_variate(self, variate, goals=None):
+        goals = list(self.goals) if goals is None else goals
+        return np.array([[mean(self.goal_levels.get((goal, variate, level))) for level in range(self.shape()[variate])]
+                         for goal in goals])
+
+    # Sum and count of the cells whose codes match a margin pattern: read off the tables for up to two fixed factors, otherwise
+    # summed over codes
+    def pattern_sums(self, margin):
+        fixed = [(axis, int(m)) for axis, m in enumerate(margin) if m != "X"]
+        if not fixed:
+            return self.total
+        if len(fixed) == 1:
+            return self.levels.get(fixed[0], [0.0, 0])
+        if len(fixed) == 2:
+            return self.pairs.get(fixed[0] + fixed[1], [0.0, 0])
+        sums = [0.0, 0]
+        for code, (s, n) in self.codes.items():
+            if all(int(code[axis]) == level for axis, level in fixed):
+                sums[0] += s
+                sums[1] += n
+        return sums
+
+    # Average score of the cells whose codes match a margin pattern (like dict_mean of condition_ps_scores, over all goals)
+    def condition_mean(self, margin):
+        return mean(self.pattern_sums(margin))
+
+    # Averages of the cells whose codes do and don't match a margin pattern (like marginalize_ps_scores, over all goals)
+    def marginalize(self, margin):
+        s, n = self.pattern_sums(margin)
+        return {margin: mean([s, n]), f"not {margin}": mean([self.total[0] - s, self.total[1] - n])}
+
+    # Function: add_table
+    # Purpose: add the rows of a result store table
+    # Parameters: table, a pyarrow Table with goal, code and score columns
+    # Produces: None
+    def add_table(self, table):
+        import pyarrow as pa # Only needed for result stores
+        table = table.select(["goal", "code", "score"]).cast(pa.schema([("goal", pa.string()), ("code", pa.string()),
+                                                                        ("score", pa.float64())]))
+        sums = table.group_by(["goal", "code"]).aggregate([("score", "sum"), ("score", "count")]).to_pydict()
+        for goal, code, s, n in zip(sums["goal"], sums["code"], sums["score_sum"], sums["score_count"]):
+            self.add(goal, code, s, n)
+
+    def save(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f: # Write then rename, so a crash never leaves a half-written index
+            pickle.dump(self, f)
+        os.replace(tmp, path)
+
+# Mean of a [sum, count] pair, NaN for no cells
+def mean(sums):
+    return sums[0] / sums[1] if sums is not None and sums[1] else np.nan
+
+# Function: load_store_index
+# Purpose: get the aggregate index of a result store, reading only the parts added since it was last saved (all of them again if
+#          a part it read was rewritten or removed)
+# Parameters: folder, a string of the store folder
+#             model=None, a string of the model to index (None if the store has only one, like load_store_experiment)
+#             goal_sets=None, a dictionary of goal set families (defaults to GOAL_SETS); changing it rebuilds the index
+# Produces: index, an AggregateIndex
+def load_store_index(folder, model=None, goal_sets=None):
+    import pyarrow.parquet as pq # Only needed for result stores
+    suffix = "" if model is None else "-" + hashlib.sha1(model.encode()).hexdigest()[:12]
+    path = os.path.join(folder, f"_index{suffix}.pkl") # Leading underscore: not read as a part
+    goal_sets = GOAL_SETS if goal_sets is None else goal_sets
+    parts = {}
+    for file in sorted(os.listdir(folder)):
+        if file.endswith(".parquet"):
+            stat = os.stat(os.path.join(folder, file))
+            parts[file] = (stat.st_size, stat.st_mtime_ns)
+
+    index = None
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            index = pickle.load(f)
+        if index.goal_sets != {family: {name: list(m) for name, m in sets.items()} for family, sets in goal_sets.items()} \
+                or any(parts.get(file) != stamp for file, stamp in index.parts.items()) or not hasattr(index, "models"):
+            index = None
+    index = AggregateIndex(goal_sets) if index is None else index
+    new = [file for file in parts if file not in index.parts]
+    import pyarrow.compute as pc
+    for file in new:
+        table = pq.read_table(os.path.join(folder, file), columns=["model", "goal", "code", "score"])
+        if model is not None:
+            table = table.filter(pc.equal(table["model"].cast("string"), model))
+        index.add_table(table)
+        index.models.update(pc.unique(table["model"].cast("string")).to_pylist())
+        index.parts[file] = parts[file]
+    if new or not os.path.exists(path):
+        index.save(path)
+    if model is None:
+        check_one_model(index.models, folder)
+    return index
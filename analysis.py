@@ -0,0 +1,219 @@
+import hashlib # Memoizing resamples per experiment
+import os
+import itertools
+import warnings
+from concurrent.futures import ProcessPoolExecutor # Resampling in parallel
+import numpy as np
+from code_tensor import CODE_AXES, code_shape, nanmean # Dense code axes
+from run_log import read_run_log, check_one_model # Raw choices of a run
+
+# Bootstrap confidence intervals for the numbers the visualizations show. Each resample draws goals with replacement and, within
+# every (goal, code) cell, the cell's plan-ordering choices with replacement, then recomputes every factor marginal, every
+# two-factor grid (visualize_variates) and every goal x factor table (visualize_goals_vs_variate). Resamples are drawn in
+# vectorized chunks spread over a process pool, and kept per experiment so later plots and reports don't redraw them.
+
+bootstrap_memo = {} # Bootstrap of each experiment already resampled, keyed by content hash
+
+# Function: choice_tensor
+# Purpose: arrange raw per-ordering PS scores as a (goal, code, ordering) array
+# Parameters: records, an iterable of (goal, code, permutation, score) tuples; permutation -1 marks a cell stored already averaged
+#                 (logprob / adaptive runs, imported csv's), which counts as one sample in the first ordering slot of a cell
+#                 with no raw orderings (a cell's raw orderings win over its averaged row)
+#             goals=None, codes=None, lists of strings to keep (defaults to all, sorted)
+# Produces: values, a float numpy array of shape (len(goals), len(codes), n_permutations), NaN where nothing was recorded
+#           goals, codes, the lists of strings naming the first two axes
+def choice_tensor(records, goals=None, codes=None):
+    records = [r for r in records if (goals is None or r[0] in goals) and (codes is None or r[1] in codes)]
+    goals = sorted({r[0] for r in records}) if goals is None else list(goals)
+    codes = sorted({r[1] for r in records}) if codes is None else list(codes)
+    goal_index = {goal: i for i, goal in enumerate(goals)}
+    code_index = {code: i for i, code in enumerate(codes)}
+    values = np.full((len(goals), len(codes), max([0] + [r[2] for r in records]) + 1), np.nan)
+    averaged = [r for r in records if r[2] < 0]
+    for goal, code, permutation, score in records:
+        if permutation >= 0:
+            values[goal_index[goal], code_index[code], permutation] = score
+    for goal, code, _, score in averaged:
+        cell = values[goal_index[goal], code_index[code]]
+        if np.isnan(cell).all():
+            cell[0] = score
+    return values, goals, codes
+
+# Function: run_log_choice_tensor
+# Purpose: read the raw choices of an experiment's run log as a choice tensor
+# Parameters: folder, a string of the experiment folder
+#             goals=None, codes=None, lists of strings to keep (defaults to all)
+#             model=None, a string of the model to keep (None if the run log has only one)
+# Produces: see choice_tensor
+def run_log_choice_tensor(folder, goals=None, codes=None, model=None):
+    records = [r for r in read_run_log(os.path.join(folder, "run_log.jsonl")) if model is None or r["model"] == model]
+    if model is None:
+        check_one_model([r["model"] for r in records], folder)
+    return choice_tensor([(r["goal"], r["code"], r["permutation"], r["ps"]) for r in records], goals, codes)
+
+# Function: store_choice_tensor
+# Purpose: read the raw choices in a result store as a choice tensor
+# Parameters: folder, a string of the store folder
+#             goals=None, codes=None, lists of strings to keep (defaults to all)
+#             model=None, a string of the model to keep (None if the store has only one)
+# Produces: see choice_tensor
+def store_choice_tensor(folder, goals=None, codes=None, model=None):
+    from result_store import load_table # pyarrow is only needed here
+    table = load_table(folder, goals=goals, codes=codes, models=None if model is None else [model],
+                       columns=["model", "goal", "code", "permutation", "score"]).to_pydict()
+    if model is None:
+        check_one_model(table["model"], folder)
+    return choice_tensor(zip(table["goal"], table["code"], table["permutation"], table["score"]), goals, codes)
+
+# Function: experiment_choice_tensor
+# Purpose: treat a multi-goal experiment dictionary as a choice tensor with one "ordering" per cell, for experiments whose raw
+#          choices weren't kept (only goals are resampled then)
+# Parameters: ps_scores, a dictionary of dictionaries, keyed by goal and then code
+# Produces: see choice_tensor
+def experiment_choice_tensor(ps_scores):
+    return choice_tensor([(goal, code, 0, score) for goal in ps_scores for code, score in ps_scores[goal].items()])
+
+# Function: membership
+# Purpose: get which level combination of some code axes each code has, as a matrix for averaging codes by those axes
+# Parameters: codes, a list of code strings
+#             axes, a tuple of ascending integers
+#             shape, a tuple of the code axes' sizes
+# Produces: matrix, a (len(codes), number of level combinations) 0/1 numpy array, combinations in C order
+def membership(codes, axes, shape):
+    levels = np.array([[int(code[a]) for a in axes] for code in codes])
+    matrix = np.zeros((len(codes), int(np.prod([shape[a] for a in axes]))))
+    matrix[np.arange(len(codes)), np.ravel_multi_index(levels.T, [shape[a] for a in axes])] = 1
+    return matrix
+
+# Function: masked_mean
+# Purpose: average scores by group, skipping NaN, as one matrix product
+# Parameters: values, a numpy array whose last axis is codes
+#             matrix, a membership matrix
+# Produces: means, a numpy array whose last axis is groups, NaN for groups with no scores
+def masked_mean(values, matrix):
+    sums, counts = np.nan_to_num(values) @ matrix, (~np.isnan(values)).astype(float) @ matrix
+    return np.divide(sums, counts, out=np.full(sums.shape, np.nan), where=counts > 0)
+
+# Function: statistics
+# Purpose: compute every factor marginal, two-factor grid and goal x factor table of a batch of (resampled) experiments
+# Parameters: means, a numpy array of shape (n_resamples, n_goals, len(codes)) of cell scores, NaN for cells not run
+#             codes, a list of code strings
+#             shape, a tuple of the code axes' sizes
+#             goal_means=None, the same for the goal x factor tables (defaults to means); pass the experiment without goals
+#                 resampled, since those tables have a row per goal
+# Produces: stats, a dictionary of numpy arrays with a leading n_resamples axis: "marginal_{v}" (levels of v),
+#           "variates_{a}_{b}" (levels of b, levels of a, as CodeTensor.variates_grid((a, b))) and "goals_{v}" (goals, levels of v)
+def statistics(means, codes, shape, goal_means=None):
+    goal_means = means if goal_means is None else goal_means
+    aggregate = nanmean(means, axis=1) # Average over goals of each code, like CodeTensor.aggregate
+    stats = {}
+    for v in range(len(shape)):
+        matrix = membership(codes, (v,), shape)
+        stats[f"marginal_{v}"] = masked_mean(aggregate, matrix)
+        stats[f"goals_{v}"] = masked_mean(goal_means, matrix)
+    for a, b in itertools.combinations(range(len(shape)), 2):
+        grid = masked_mean(aggregate, membership(codes, (a, b), shape)).reshape(-1, shape[a], shape[b])
+        stats[f"variates_{a}_{b}"], stats[f"variates_{b}_{a}"] = np.swapaxes(grid, 1, 2), grid
+    return stats
+
+# Function: bootstrap_chunk
+# Purpose: draw a chunk of bootstrap resamples and compute their statistics (run in the worker processes)
+# Parameters: values, a choice tensor (see choice_tensor) with each cell's recorded orderings sorted first
+#             codes, a list of code strings
+#             shape, a tuple of the code axes' sizes
+#             n_resamples, an integer
+#             seed, a numpy SeedSequence
+# Produces: stats, a dictionary of numpy arrays (see statistics)
+def bootstrap_chunk(values, codes, shape, n_resamples, seed):
+    rng = np.random.default_rng(seed)
+    n_goals, n_codes, n_orderings = values.shape
+    n_recorded = (~np.isnan(values)).sum(axis=2) # Orderings recorded per cell
+    draws = (rng.random((n_resamples, n_goals, n_codes, n_orderings)) * n_recorded[..., None]).astype(np.int64)
+    resampled = np.take_along_axis(np.broadcast_to(values, draws.shape), draws, axis=3)
+    resampled[..., np.arange(n_orderings) >= n_recorded[..., None]] = np.nan # A cell draws as many orderings as it recorded
+    means = nanmean(resampled, axis=3) # (resample, goal, code); NaN for cells with nothing recorded
+    goal_draws = rng.integers(0, n_goals, (n_resamples, n_goals))
+    return statistics(np.take_along_axis(means, goal_draws[..., None], axis=1), codes, shape, means)
+
+# Class: Bootstrap
+# Purpose: point estimates and bootstrap resamples of every statistic of an experiment, with intervals and effect sizes
+# Parameters: estimates, a dictionary of numpy arrays (see statistics, without the resample axis)
+#             samples, a dictionary of numpy arrays with a leading n_resamples axis
+#             goals, a list of strings naming the rows of the "goals_{v}" tables
+class Bootstrap:
+    def __init__(self, estimates, samples, goals):
+        self.estimates = estimates
+        self.samples = samples
+        self.goals = list(goals)
+
+    # (low, high) percentile interval of a statistic, after applying transform (e.g. adding average rows) to each resample
+    def interval(self, name, ci=0.95, transform=None):
+        samples = self.samples[name] if transform is None else np.stack([transform(s) for s in self.samples[name]])
+        with warnings.catch_warnings(): # Combinations with no codes (e.g. descriptions without has_desc) stay NaN
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            return tuple(np.nanpercentile(samples, [50 * (1 - ci), 50 * (1 + ci)], axis=0))
+
+    # Main effect of every factor level against the first level, and the interaction of every pair of two-level factors
+    def effects(self, ci=0.95):
+        contrasts = {}
+        for v in range(len(CODE_AXES)):
+            for level in range(1, self.estimates[f"marginal_{v}"].shape[0]):
+                contrasts[f"{CODE_AXES[v]}={level}"] = lambda stats, v=v, level=level: \
+                    stats[f"marginal_{v}"][..., level] - stats[f"marginal_{v}"][..., 0]
+        for a, b in itertools.combinations(range(len(CODE_AXES)), 2):
+            if self.estimates[f"marginal_{a}"].shape[0] == 2 and self.estimates[f"marginal_{b}"].shape[0] == 2:
+                contrasts[f"{CODE_AXES[a]} x {CODE_AXES[b]}"] = lambda stats, a=a, b=b: \
+                    np.einsum("...ij,ij->...", stats[f"variates_{a}_{b}"], np.array([[1, -1], [-1, 1]]))
+        spread = float(np.nanstd(self.estimates["cell_scores"])) # For standardized effect sizes
+        effects = {}
+        for name, contrast in contrasts.items():
+            estimate, samples = float(contrast(self.estimates)), contrast(self.samples)
+            samples = samples[~np.isnan(samples)]
+            low, high = np.percentile(samples, [50 * (1 - ci), 50 * (1 + ci)]) if samples.size else (np.nan, np.nan)
+            p = min(1.0, 2 * min(np.mean(samples <= 0), np.mean(samples >= 0))) if samples.size else np.nan
+            effects[name] = {"effect": estimate, "low": float(low), "high": float(high), "p": float(p),
+                             "d": estimate / spread if spread > 0 else np.nan}
+        return effects
+
+# Function: bootstrap
+# Purpose: bootstrap every marginal, grid and goal table of an experiment, memoized per experiment
+# Parameters: values, goals, codes, a choice tensor (see choice_tensor)
+#             n_resamples=10000, an integer
+#             seed=0, an integer
+#             n_workers=None, an integer of worker processes (None for one per CPU, 1 to stay in this process)
+#             chunk_size=250, an integer of resamples per task (bounds each worker's memory)
+#             folder=None, a string of a folder to also keep the resamples in (e.g. the experiment folder), so they survive restarts
+# Produces: bootstrap, a Bootstrap
+def bootstrap(values, goals, codes, n_resamples=10000, seed=0, n_workers=None, chunk_size=250, folder=None):
+    key = hashlib.sha256(values.tobytes() + repr((goals, codes, n_resamples, seed)).encode()).hexdigest()
+    if key in bootstrap_memo:
+        return bootstrap_memo[key]
+    path = os.path.join(folder, "analysis", f"bootstrap-{key[:16]}.npz") if folder is not None else None
+    if path is not None and os.path.exists(path):
+        with np.load(path) as saved:
+            estimates = {name[9:]: saved[name] for name in saved.files if name.startswith("estimate_")}
+            samples = {name[7:]: saved[name] for name in saved.files if name.startswith("sample_")}
+        bootstrap_memo[key] = Bootstrap(estimates, samples, goals)
+        return bootstrap_memo[key]
+
+    shape = code_shape(max(code_shape()[2], max(int(code[2]) for code in codes) + 1))
+    values = np.sort(values, axis=2) # Recorded orderings first (NaN sorts last), so draws can index them directly
+    means = nanmean(values, axis=2)[None]
+    estimates = {name: stat[0] for name, stat in statistics(means, codes, shape).items()}
+    estimates["cell_scores"] = means[0]
+
+    seeds = np.random.SeedSequence(seed).spawn((n_resamples + chunk_size - 1) // chunk_size)
+    sizes = [min(chunk_size, n_resamples - i * chunk_size) for i in range(len(seeds))]
+    if n_workers == 1:
+        chunks = [bootstrap_chunk(values, codes, shape, size, s) for size, s in zip(sizes, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            chunks = list(pool.map(bootstrap_chunk, *zip(*[(values, codes, shape, size, s) for size, s in zip(sizes, seeds)])))
+    samples = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez_compressed(path, **{f"estimate_{name}": v for name, v in estimates.items()},
+                            **{f"sample_{name}": v for name, v in samples.items()})
+    bootstrap_memo[key] = Bootstrap(estimates, samples, goals)
+    return bootstrap_memo[key]
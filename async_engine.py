@@ -0,0 +1,182 @@
+import asyncio # Running choice requests concurrently
+import random # Jittering retry backoff
+import time # Timing experiments, refilling rate limit buckets
+import openai # For LLM API errors
+from utils import * # Constants, saving/loading data
+from lm_utils import * # Interacting with the LM / generating prompts
+from run_log import RunLog, ASYNC_FSYNC_EVERY # Recording choices so runs can be resumed
+import telemetry # Instrumenting calls
+
+# Errors worth retrying: throttling, server hiccups and dropped connections
+RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.APIError, openai.error.Timeout,
+                    openai.error.APIConnectionError, openai.error.ServiceUnavailableError, asyncio.TimeoutError)
+
+# Class: TokenBucket
+# Purpose: rate limiter that refills continuously at a fixed rate per minute, up to a capacity
+# Parameters: rate_per_min, a float of how many units (requests or tokens) are allowed per minute
+#             capacity=None, a float of the largest allowed burst (defaults to one second's worth)
+class TokenBucket:
+    def __init__(self, rate_per_min, capacity=None):
+        self.rate = rate_per_min / 60 # Units refilled per second
+        self.capacity = capacity if capacity is not None else max(1.0, self.rate)
+        self.level = self.capacity
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock() # Serve waiters in order so large requests aren't starved
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.last) * self.rate)
+        self.last = now
+
+    # Wait until `amount` units are available, then take them
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity) # A request bigger than the bucket only has to wait for a full bucket
+        async with self.lock:
+            self._refill()
+            while self.level < amount:
+                await asyncio.sleep((amount - self.level) / self.rate)
+                self._refill()
+            self.level -= amount
+
+# Class: Scheduler
+# Purpose: run model calls with bounded concurrency, request/token rate limits and jittered exponential backoff
+# Parameters: max_concurrency=32, an integer of how many requests may be in flight at once
+#             requests_per_min=3000, a float of the request rate limit
+#             tokens_per_min=250000, a float of the token rate limit
+#             max_retries=6, an integer of how many times to retry a failed call
+#             base_delay=1, a float of the initial backoff in seconds
+#             max_delay=60, a float of the largest backoff in seconds
+class Scheduler:
+    def __init__(self, max_concurrency=32, requests_per_min=3000, tokens_per_min=250000,
+                 max_retries=6, base_delay=1, max_delay=60):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.request_bucket = TokenBucket(requests_per_min)
+        self.token_bucket = TokenBucket(tokens_per_min)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.n_calls = 0
+        self.n_retries = 0
+
+    # Run the coroutine function `call` once the rate limits allow a request of `n_tokens` tokens
+    async def run(self, call, n_tokens):
+        t_queued = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(n_tokens)
+            async with self.semaphore:
+                t_sent = time.perf_counter()
+                try:
+                    self.n_calls += 1
+                    response = await call()
+                    telemetry.record_call(response, time.perf_counter() - t_sent, queue_wait=t_sent - t_queued, retries=attempt)
+                    return response
+                except RETRYABLE_ERRORS as e:
+                    telemetry.record("call_error", error=type(e).__name__, latency=time.perf_counter() - t_sent)
+                    if attempt == self.max_retries:
+                        raise
+                    self.n_retries += 1
+            # "Full jitter" backoff, so throttled requests don't all come back at the same moment
+            await asyncio.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+# Function: async_single_prompt_experiment
+# Purpose: get the power-seeking score for a single prompt, running all permutations of the plans concurrently
+# Parameters: scheduler, the Scheduler to submit calls through
+#             model, a string of which OpenAI model to use
+#             code, a length-6 binary (except for position 2, which goes 0-[len(descriptions)-1]) string
+#             goal, a string
+#             plans, a string with exactly three lines separated by \n
+#             run_log=None, a RunLog to record choices in and resume from
+# Produces: score, a float corresponding to the average PS score of the model over all 6 permutations of the plans (over the
+#               ones with a valid answer, if any were given up on; nan if none were)
+async def async_single_prompt_experiment(scheduler, model, code, goal, plans, run_log=None):
+    original_plans, permutations = plan_permutations(plans)
+    choice_prompt = generate_choice_prompt(code, descriptions, goal)
+
+    async def score(k, plans_p):
+        record = run_log.get(model, goal, code, k) if run_log is not None else None
+        if record is not None: # Already done in a previous run
+            return record["ps"]
+        prompt_tokens = estimate_tokens(choice_prompt.format(format_plans(plans_p)))
+        run = lambda call: scheduler.run(call, prompt_tokens + CHOICE_MAX_TOKENS) # Cached responses skip the rate limiter
+        on_invalid = (lambda text, final=False: run_log.log_invalid(model, goal, code, k, text, final=final)) \
+            if run_log is not None else None
+        with telemetry.labelled(model=model, goal=goal, code=code, permutation=k):
+            plan_output = await achoose_plan(model, choice_prompt, plans_p, run=run)
+            plan_choice = await aresolve_choice(model, choice_prompt, plans_p, plan_output.choices[0].text,
+                                                run=lambda call: scheduler.run(call, prompt_tokens + 1), on_invalid=on_invalid)
+        if plan_choice is None: # Given up on: left out of the score, and asked again on resume
+            return None
+        power_seekiness = choice_to_ps(original_plans, plans_p, plan_choice)
+        if run_log is not None:
+            run_log.log(model, goal, code, k, plan_choice, power_seekiness)
+        return power_seekiness
+
+    ps = [p for p in await asyncio.gather(*[score(k, plans_p) for k, plans_p in enumerate(permutations)]) if p is not None]
+    return sum(ps) / len(ps) if ps else float("nan")
+
+# Function: async_multi_goal_experiment
+# Purpose: get the power-seeking scores for several prompts and goals, fanning every (goal, code, permutation) out concurrently
+# Parameters: goals, a list of strings
+#             codes, a list of length-6 binary (except for position 2, which goes 0-[len(descriptions)-1]) strings
+#             model, a string of which OpenAI model to use
+#             scheduler=None, the Scheduler to use (defaults to Scheduler())
+#             verbose=True, a boolean controlling printing behavior
+#             save_csv=True, a boolean controlling whether to save results to csv's
+#             name="experiment", a string of the folder name to store all the csv's to
+#             resume=None, a string of a previous run's folder to continue (only cells missing from its run log are run)
+#             run_log=None, an open RunLog of resume's folder to share with other runs (e.g. other models in a sweep); left open
+#             plan_set=0, an integer of which of each goal's plan sets to run
+# Produces: scores, a dictionary of dictionaries of float PS scores, keyed by goal and then code
+#           dest, a string of the folder the csv's were saved to
+async def async_multi_goal_experiment(goals, codes, model, scheduler=None, verbose=True, save_csv=True, name="experiment",
+                                      resume=None, run_log=None, plan_set=0):
+    scheduler = scheduler if scheduler is not None else Scheduler()
+    t1 = time.time()
+    dest = resume if resume is not None else experiment_folder(name)
+    if dest[-1] != "/":
+        dest += "/"
+
+    own_log = run_log is None
+    if own_log:
+        run_log = RunLog(dest, fsync_every=ASYNC_FSYNC_EVERY) # Makes the folder, records every choice as it comes in
+
+    async def run_goal(goal):
+        plans = load_plans(goal, plan_set)
+        with telemetry.labelled(goal=goal), telemetry.stage("goal"):
+            scores = await asyncio.gather(*[async_single_prompt_experiment(scheduler, model, code, goal, plans,
+                                                                           run_log=run_log) for code in codes])
+        ps_scores = dict(zip(codes, scores))
+        if verbose:
+            print(f"Power-Seeking Scores for '{goal}': {ps_scores}")
+        if save_csv: # Save each goal as soon as it's done, like multi_prompt_experiment
+            ps_scores_to_csv(ps_scores, dest + f"{goal}.csv")
+        return ps_scores
+
+    try:
+        results = dict(zip(goals, await asyncio.gather(*[run_goal(goal) for goal in goals])))
+    finally:
+        if own_log:
+            run_log.close()
+
+    if verbose:
+        print(f"Analysis of {len(codes)} prompts over {len(goals)} goals took {time.time()-t1:.2f} seconds "
+              f"({scheduler.n_calls} calls, {scheduler.n_retries} retries).")
+    return results, dest
+
+# Function: run_async_multi_goal_experiment
+# Purpose: synchronous entry point for async_multi_goal_experiment, for use from scripts like eval.py
+# Parameters: goals, a list of strings
+#             codes, a list of strings
+#             model, a string of which OpenAI model to use
+#             max_concurrency=32, requests_per_min=3000, tokens_per_min=250000, max_retries=6, Scheduler settings
+#             **kwargs, passed to async_multi_goal_experiment
+# Produces: scores, a dictionary of dictionaries, keyed by goal and then code
+#           dest, a string of the folder the csv's were saved to
+def run_async_multi_goal_experiment(goals, codes, model, max_concurrency=32, requests_per_min=3000,
+                                    tokens_per_min=250000, max_retries=6, **kwargs):
+    async def main(): # Scheduler must be created inside the running event loop
+        scheduler = Scheduler(max_concurrency=max_concurrency, requests_per_min=requests_per_min,
+                              tokens_per_min=tokens_per_min, max_retries=max_retries)
+        return await async_multi_goal_experiment(goals, codes, model, scheduler=scheduler, **kwargs)
+    return asyncio.run(main())
@@ -0,0 +1,142 @@
+import asyncio
+import random
+import time
+import aiohttp # Connection pools for async requests
+import openai # For LLM API
+from fake_server import fake_completion # Deterministic fake answers
+
+# Backends answer completion requests (the keyword arguments of openai.Completion.create) with openai-style response objects.
+# lm_utils sends every request through its current backend, so the runners can be pointed at a fake model without changing them.
+
+# Function: backend_cache_id
+# Purpose: get the string the response cache tells a backend's answers apart by
+# Parameters: backend, a backend
+# Produces: cache_id, a string (the backend's cache_id, or its class name if it has none)
+def backend_cache_id(backend):
+    return getattr(backend, "cache_id", type(backend).__name__)
+
+# Class: OpenAIBackend
+# Purpose: send requests to the OpenAI API, or any endpoint speaking its completions protocol (e.g. fake_server.py)
+# Parameters: api_key=None, api_base=None, a string key and base url for this provider (None to use openai.api_key / openai.api_base)
+#             pool_size=None, an integer; if given, async requests go through this backend's own connection pool of that many
+#                 connections instead of the openai library's shared session, so providers don't queue behind each other
+class OpenAIBackend:
+    def __init__(self, api_key=None, api_base=None, pool_size=None):
+        self.credentials = {key: value for key, value in [("api_key", api_key), ("api_base", api_base)] if value is not None}
+        self.pool_size = pool_size
+        self.session, self.loop = None, None # Made on first use, inside the event loop that uses it
+
+    # Which provider answers, for the response cache key
+    @property
+    def cache_id(self):
+        return f"OpenAIBackend:{self.credentials.get('api_base', openai.api_base)}"
+
+    def create(self, **params):
+        return openai.Completion.create(**self.credentials, **params)
+
+    async def acreate(self, **params):
+        if self.pool_size is None:
+            return await openai.Completion.acreate(**self.credentials, **params)
+        if self.session is None or self.session.closed or self.loop is not asyncio.get_running_loop():
+            self.loop = asyncio.get_running_loop()
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+        token = openai.aiosession.set(self.session) # Only seen by this call's task
+        try:
+            return await openai.Completion.acreate(**self.credentials, **params)
+        finally:
+            openai.aiosession.reset(token)
+
+    async def aclose(self):
+        if self.session is not None:
+            await self.session.close()
+
+# Class: FakeBackend
+# Purpose: in-process deterministic fake model with configurable latency and failures, for tests and benchmarks
+# Parameters: latency=(0.2, 0.5), a (median seconds, sigma) tuple of a lognormal latency distribution, or None for no latency
+#             error_rate=0.0, a float of the chance a request fails with a server error
+#             rate_limit_rate=0.0, a float of the chance a request is rejected with a rate limit (429) error
+#             invalid_rate=0.0, a float of the chance an answer is prose instead of a plan number (not for strict, logit-biased
+#                 requests)
+#             strict_invalid_rate=0.0, a float of the chance a strict request's answer is prose too
+#             seed=0, an integer for the latency / failure draws (answers don't depend on it)
+class FakeBackend:
+    def __init__(self, latency=(0.2, 0.5), error_rate=0.0, rate_limit_rate=0.0, invalid_rate=0.0, strict_invalid_rate=0.0,
+                 seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.invalid_rate = invalid_rate
+        self.strict_invalid_rate = strict_invalid_rate
+        self.rng = random.Random(seed)
+        self.cache_id = "FakeBackend"
+
+    # Draw this request's latency and raise its failure, if any
+    def _draw(self):
+        delay = self.rng.lognormvariate(0, self.latency[1]) * self.latency[0] if self.latency else 0.0
+        roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            return delay, openai.error.RateLimitError("Rate limit reached (fake)", http_status=429)
+        if roll < self.rate_limit_rate + self.error_rate:
+            return delay, openai.error.APIError("Server error (fake)", http_status=500)
+        return delay, None
+
+    def _respond(self, params):
+        response = fake_completion({**params, "model": params.get("engine")})
+        strict = "logit_bias" in params
+        if not strict or self.strict_invalid_rate > 0:
+            rate = self.strict_invalid_rate if strict else self.invalid_rate
+            for choice in response["choices"]:
+                if choice["text"].strip().isdigit() and self.rng.random() < rate:
+                    choice["text"] = " I would go with the second one, since plan 1 is too slow."
+        return openai.util.convert_to_openai_object(response)
+
+    def create(self, **params):
+        delay, error = self._draw()
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return self._respond(params)
+
+    async def acreate(self, **params):
+        delay, error = self._draw()
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return self._respond(params)
+
+# Class: RecordingBackend
+# Purpose: wrap another backend and record each request's latency, outcome and token usage
+# Parameters: backend, the backend to wrap
+class RecordingBackend:
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = [] # (latency seconds, succeeded, prompt tokens, completion tokens) per request
+
+    @property
+    def cache_id(self): # Answers are the wrapped backend's
+        return backend_cache_id(self.backend)
+
+    def _record(self, t1, response):
+        usage = response.get("usage", {}) if response is not None else {}
+        self.calls.append((time.perf_counter() - t1, response is not None,
+                           usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)))
+
+    def create(self, **params):
+        t1 = time.perf_counter()
+        try:
+            response = self.backend.create(**params)
+        except Exception:
+            self._record(t1, None)
+            raise
+        self._record(t1, response)
+        return response
+
+    async def acreate(self, **params):
+        t1 = time.perf_counter()
+        try:
+            response = await self.backend.acreate(**params)
+        except Exception:
+            self._record(t1, None)
+            raise
+        self._record(t1, response)
+        return response
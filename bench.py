@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+import numpy as np
+import openai
+import lm_utils
+import plan_corpus
+import fake_server
+from utils import * # Constants, saving/loading data
+from lm_utils import * # Interacting with the LM / generating prompts
+from backends import FakeBackend, OpenAIBackend, RecordingBackend
+from async_engine import Scheduler, async_multi_goal_experiment
+from pipeline import stream_experiment
+
+# Throughput benchmark for the experiment runners, against the in-process fake model or the local HTTP stub (no API money spent).
+# Example: python bench.py --sweep 1goal --engine async --latency 0.2
+
+SWEEPS = {"1goal": lambda: (all_goals[:1], all_codes()), "all_goals": lambda: (all_goals, all_codes())}
+
+# Function: run_sequential
+# Purpose: baseline runner, one choose_plan call after another (like single_prompt_experiment without batching)
+def run_sequential(goals, codes, model):
+    for goal in goals:
+        original_plans, permutations = plan_permutations(load_plans(goal))
+        for code in codes:
+            choice_prompt = generate_choice_prompt(code, descriptions, goal)
+            for plans_p in permutations:
+                resolve_choice(model, choice_prompt, plans_p, choose_plan(model, choice_prompt, plans_p).choices[0].text)
+
+# Function: run_batched
+# Purpose: runner sending each goal's whole (code, permutation) grid through choose_plans_batch
+def run_batched(goals, codes, model):
+    for goal in goals:
+        original_plans, permutations = plan_permutations(load_plans(goal))
+        requests = [(generate_choice_prompt(code, descriptions, goal), plans_p) for code in codes for plans_p in permutations]
+        resolve_choices(model, requests, [plan_output.choices[0].text for plan_output in choose_plans_batch(model, requests)])
+
+# Function: run_engine
+# Purpose: run one sweep with one engine
+# Parameters: engine, a string: "sequential", "batched", "async" or "stream"
+#             goals, codes, lists of strings
+#             model, a string
+#             concurrency, rpm, tpm, Scheduler settings for the async engines
+#             dest, a string of a scratch folder for run logs / stores
+# Produces: None
+def run_engine(engine, goals, codes, model, concurrency, rpm, tpm, dest):
+    if engine == "sequential":
+        return run_sequential(goals, codes, model)
+    if engine == "batched":
+        return run_batched(goals, codes, model)
+
+    async def main():
+        scheduler = Scheduler(max_concurrency=concurrency, requests_per_min=rpm, tokens_per_min=tpm, base_delay=0.05)
+        if engine == "async":
+            await async_multi_goal_experiment(goals, codes, model, scheduler=scheduler, verbose=False, save_csv=False,
+                                              resume=dest + "async/")
+        else:
+            await stream_experiment(goals, codes, model, dest + "stream/", scheduler=scheduler, n_workers=concurrency)
+    asyncio.run(main())
+
+# Function: benchmark
+# Purpose: time one sweep with one engine and summarize the calls it made
+# Parameters: see run_engine; recorder, the RecordingBackend requests go through
+# Produces: report, a dictionary of requests/s, latency percentiles, tokens per cell and wall time
+def benchmark(engine, sweep, recorder, model="fake", concurrency=64, rpm=1e6, tpm=1e9):
+    goals, codes = SWEEPS[sweep]()
+    recorder.calls = []
+    with tempfile.TemporaryDirectory() as dest:
+        t1 = time.perf_counter()
+        run_engine(engine, goals, codes, model, concurrency, rpm, tpm, dest + "/")
+        wall = time.perf_counter() - t1
+    latencies = np.array([c[0] for c in recorder.calls]) if recorder.calls else np.zeros(1)
+    n_cells = len(goals) * len(codes)
+    return {"engine": engine, "sweep": sweep, "cells": n_cells, "requests": len(recorder.calls),
+            "failed": sum(1 for c in recorder.calls if not c[1]), "wall_s": round(wall, 3),
+            "requests_per_s": round(len(recorder.calls) / wall, 1),
+            "p50_latency_s": round(float(np.percentile(latencies, 50)), 4),
+            "p99_latency_s": round(float(np.percentile(latencies, 99)), 4),
+            "tokens_per_cell": round(sum(c[2] + c[3] for c in recorder.calls) / n_cells, 1)}
+
+# Function: synthetic_corpus
+# Purpose: fill a scratch plan corpus with made-up plans for every goal, so sweeps don't need goals/ on disk
+# Parameters: folder, a string
+# Produces: None
+def synthetic_corpus(folder):
+    plan_corpus.corpus_path = folder
+    for goal in all_goals:
+        plan_corpus.add_plan_sets(goal, [[f"{level} plan for {goal}" for level in ["Low", "Medium", "High"]]], "synthetic")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the experiment runners against a fake model.")
+    parser.add_argument("--sweep", choices=list(SWEEPS) + ["both"], default="1goal")
+    parser.add_argument("--engine", choices=["sequential", "batched", "async", "stream", "all"], default="all")
+    parser.add_argument("--latency", type=float, default=0.2, help="median fake latency in seconds")
+    parser.add_argument("--sigma", type=float, default=0.5, help="spread of the lognormal fake latency")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--invalid-rate", type=float, default=0.0, help="chance of an unparseable answer (in-process fake only)")
+    parser.add_argument("--http", action="store_true", help="go through the local HTTP stub instead of the in-process fake")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--out", default=None, help="also write the reports to this file as json lines")
+    args = parser.parse_args()
+
+    lm_utils.use_cache = False # Every request should reach the backend
+    if args.http:
+        server = fake_server.serve(0, latency=args.latency, latency_sigma=args.sigma, error_rate=args.error_rate,
+                                   rate_limit_rate=args.rate_limit_rate)
+        openai.api_base = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        openai.api_key = "fake"
+        recorder = RecordingBackend(OpenAIBackend())
+    else:
+        recorder = RecordingBackend(FakeBackend(latency=(args.latency, args.sigma), error_rate=args.error_rate,
+                                                rate_limit_rate=args.rate_limit_rate, invalid_rate=args.invalid_rate))
+    set_backend(recorder)
+
+    with tempfile.TemporaryDirectory() as corpus:
+        synthetic_corpus(corpus)
+        sweeps = list(SWEEPS) if args.sweep == "both" else [args.sweep]
+        engines = ["sequential", "batched", "async", "stream"] if args.engine == "all" else [args.engine]
+        if args.error_rate > 0 or args.rate_limit_rate > 0: # Only the async engines retry failed calls
+            skipped = [engine for engine in engines if engine in ["sequential", "batched"]]
+            if skipped:
+                print(f"Skipping {', '.join(skipped)}: they don't retry, so injected errors / rate limits would stop them")
+            engines = [engine for engine in engines if engine not in skipped]
+        for sweep in sweeps:
+            for engine in engines:
+                report = benchmark(engine, sweep, recorder, concurrency=args.concurrency)
+                print(report)
+                if args.out:
+                    with open(args.out, "a") as f:
+                        f.write(json.dumps(report) + "\n")
@@ -0,0 +1,114 @@
+import sqlite3 # Disk-backed storage
+import hashlib # Content-addressed keys
+import json
+import time # Last-access times for LRU eviction
+import threading
+
+# Class: ResponseCache
+# Purpose: persistent cache of model responses, keyed by a hash of the backend, the model, the fully formatted prompt and the
+#          sampling parameters
+# Parameters: path="lm_cache.sqlite", a string of where to store the cache
+#             max_bytes=1GB, an integer of how large the stored responses may grow before least-recently-used ones are evicted
+#             touch_every=256, an integer of how many hits' access times to hold in memory before writing them (they're also
+#                 written with the next put, and on close)
+class ResponseCache:
+    def __init__(self, path="lm_cache.sqlite", max_bytes=2**30, touch_every=256):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_every = touch_every
+        self.hits = 0
+        self.misses = 0
+        self.touched = {} # Access times of hits not yet written, keyed by cache key
+        self.lock = threading.Lock() # One connection shared between threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                               key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_access REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)")
+        self.db.commit()
+        self.total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] # Kept up to date by put
+
+    # Whether a request's response can be reused: only greedy (temperature 0) ones, as a sampled request should get a new sample
+    @staticmethod
+    def cacheable(params):
+        return params.get("temperature", 1) == 0 # The API's default temperature is 1
+
+    # Hash the request parameters (model, prompt, temperature, ...) and the backend answering them (a string such as the backend's
+    # cache_id, so different endpoints or local weights serving the same model name don't share answers) into a cache key
+    @staticmethod
+    def key(params, backend=None):
+        return hashlib.sha256(json.dumps({"backend": backend, "params": params}, sort_keys=True).encode()).hexdigest()
+
+    # Get the stored response (a dictionary) for a request to a backend, or None if it hasn't been seen
+    def get(self, params, backend=None):
+        key = self.key(params, backend)
+        with self.lock:
+            row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched[key] = time.time()
+            if len(self.touched) >= self.touch_every:
+                self._write_touches()
+                self.db.commit()
+        return json.loads(row[0])
+
+    # Store the response (a JSON-serializable dictionary) for a request to a backend, evicting old entries if over max_bytes
+    def put(self, params, response, backend=None):
+        data = json.dumps(response)
+        key = self.key(params, backend)
+        with self.lock:
+            old = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, data, len(data), time.time()))
+            self.total += len(data) - (old[0] if old is not None else 0)
+            self._write_touches() # So eviction sees every recent hit
+            self._evict()
+            self.db.commit()
+
+    def _write_touches(self):
+        if self.touched:
+            self.db.executemany("UPDATE responses SET last_access = ? WHERE key = ?",
+                                [(t, key) for key, t in self.touched.items()])
+            self.touched = {}
+
+    def _evict(self):
+        if self.total <= self.max_bytes:
+            return
+        # Other processes sharing the file change the total too, so recount before evicting anything
+        self.total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        excess = self.total - self.max_bytes
+        if excess <= 0:
+            return
+        for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total -= size
+            excess -= size
+            if excess <= 0:
+                break
+
+    # Summary of how well the cache is working
+    def stats(self):
+        with self.lock:
+            n, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "entries": n, "bytes": size}
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM responses")
+            self.db.commit()
+            self.touched = {}
+            self.total = 0
+        self.hits = self.misses = 0
+
+    # Write the access times of hits held in memory
+    def flush(self):
+        with self.lock:
+            self._write_touches()
+            self.db.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,313 @@
+import argparse
+import json
+import os
+import sys
+import utils # Goal lists, code patterns, summaries
+
+# Command line entry point: run / resume / load experiments the way eval.py does, with eval.py's variables set from a json
+# config file and flags instead of edited in place, and report / plot finished experiments. Each subcommand imports only what
+# it needs, so reporting on a result store never loads openai or matplotlib.
+#
+#   python cli.py run --goals ps non_ps --codes XXX1XX --name docility --config sweep.json
+#   python cli.py resume "results/csv/2023.01.08 10.00.00 docility"
+#   python cli.py grow results/study --goals all --codes all --dry-run
+#   python cli.py queue /shared/sweep --goals all --codes all --models text-davinci-003 text-curie-001
+#   python cli.py work /shared/sweep --api-key sk-...        (on as many machines as you like)
+#   python cli.py merge /shared/sweep
+#   python cli.py report "results/csv/2023.01.08 10.00.00 docility" --ci
+#   python cli.py plot "results/csv/2023.01.08 10.00.00 docility"
+
+# Function: parse_goals
+# Purpose: turn command line goal arguments into goals: a goal list name from utils ("ps", "non_ps", "business", "all", ...)
+#          or a goal itself
+# Parameters: names, a list of strings
+# Produces: goals, a list of strings
+def parse_goals(names):
+    goals = []
+    for name in names:
+        goal_list = getattr(utils, f"{name}_goals", None)
+        goals += goal_list if isinstance(goal_list, list) else [name]
+    return list(dict.fromkeys(goals)) # Drop repeats, keep order
+
+# Function: parse_codes
+# Purpose: turn command line code arguments into codes: "all", a margin pattern like "X0XXXX", or a code itself
+# Parameters: names, a list of strings
+# Produces: codes, a list of strings
+def parse_codes(names):
+    all_codes = utils.all_codes()
+    codes = []
+    for name in names:
+        if name == "all":
+            codes += all_codes
+        elif "X" in name:
+            codes += utils.get_code_match(name, all_codes)
+        else:
+            codes.append(name)
+    return list(dict.fromkeys(codes))
+
+# Function: parse_value
+# Purpose: read a --set value as json (numbers, booleans, lists, null), or as a plain string if it isn't json
+# Parameters: text, a string
+# Produces: value
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+# Function: configure
+# Purpose: set eval.py's variables from a config file, --set pairs and the shorthand flags (in that order, later ones winning)
+# Parameters: eval_module, the imported eval module
+#             args, the parsed arguments
+# Produces: None
+def configure(eval_module, args):
+    settings = {}
+    if args.config is not None:
+        with open(args.config, "r") as f:
+            settings.update(json.load(f))
+    for pair in args.set:
+        key, sep, value = pair.partition("=")
+        if not sep:
+            sys.exit(f"--set expects key=value, got {pair!r}")
+        settings[key] = parse_value(value)
+    shorthands = {"model": args.model, "compare_models": args.models, "experiment_name": args.name, "scoring": args.scoring,
+                  "max_concurrency": args.max_concurrency, "requests_per_min": args.rpm, "tokens_per_min": args.tpm}
+    settings.update({key: value for key, value in shorthands.items() if value is not None})
+    if args.goals is not None:
+        settings["goals"] = parse_goals(args.goals)
+    if args.codes is not None:
+        settings["codes"] = parse_codes(args.codes)
+    if args.no_plots:
+        settings["visualize"] = False
+    if args.figures:
+        settings["render_figure_set"] = True
+    if args.local:
+        settings["local_model"] = True
+
+    for key, value in settings.items():
+        if key.startswith("_") or not hasattr(eval_module, key) or callable(getattr(eval_module, key)):
+            sys.exit(f"Unknown setting {key!r} (settings are the variables at the top of eval.py)")
+        setattr(eval_module, key, value)
+
+    if args.fake: # Dry run against the in-process fake model
+        import lm_utils
+        from backends import FakeBackend
+        lm_utils.set_backend(FakeBackend(latency=None))
+        lm_utils.use_cache = False # Keep made-up answers out of the response cache
+
+# Function: load_folder
+# Purpose: read an experiment folder's results from the rawest source it has: its result store, run log, or csv's
+# Parameters: folder, a string of the experiment folder
+#             model=None, a string of the model to keep from a multi-model folder (None if the folder has only one)
+# Produces: ps_scores, a dictionary of dictionaries of float PS scores, keyed by goal and then code
+def load_folder(folder, model=None):
+    if os.path.isdir(os.path.join(folder, "store")):
+        from result_store import load_store_experiment
+        return load_store_experiment(os.path.join(folder, "store"), models=None if model is None else [model])
+    if os.path.exists(os.path.join(folder, "run_log.jsonl")):
+        from run_log import read_run_log, check_one_model
+        sums, models = {}, set()
+        for r in read_run_log(os.path.join(folder, "run_log.jsonl")):
+            if model is None or r["model"] == model:
+                cell = sums.setdefault(r["goal"], {}).setdefault(r["code"], [0.0, 0])
+                cell[0] += r["ps"]
+                cell[1] += 1
+                models.add(r["model"])
+        check_one_model(models, folder)
+        return {goal: {code: s / n for code, (s, n) in cells.items()} for goal, cells in sums.items()}
+    goals = [file[:-4] for file in os.listdir(folder) if file[-3:] == "csv"]
+    return utils.load_multi_goal_experiment(folder, utils.all_codes(), goals)
+
+# Function: report
+# Purpose: print a finished experiment's scores by code and by goal, its telemetry summary, and optionally bootstrapped effects
+# Parameters: args, the parsed arguments
+# Produces: None
+def report(args):
+    from aggregate_index import AggregateIndex, load_store_index
+    try:
+        if os.path.isdir(os.path.join(args.folder, "store")): # Only the parts added since the last report are read
+            index = load_store_index(os.path.join(args.folder, "store"), model=args.model)
+        else:
+            index = AggregateIndex.from_experiment(load_folder(args.folder, model=args.model))
+    except ValueError as e: # Results from several models and no --model
+        sys.exit(str(e))
+    if not index.cells:
+        sys.exit(f"No results found in {args.folder}")
+    print(f"{len(index.goals)} goals x {len(index.codes)} codes")
+    print(f"By code: {index.top_codes(args.top)}")
+    print(f"By goal: {index.top_goals(args.top)}")
+    for family in index.goal_sets:
+        if index.set_averages(family):
+            print(f"By goal set ({family}): {utils.sort_dict(index.set_averages(family))}")
+
+    telemetry_path = os.path.join(args.folder, "telemetry.jsonl")
+    if os.path.exists(telemetry_path):
+        import telemetry
+        events = telemetry.read_events(telemetry_path)
+        print(f"Telemetry: {telemetry.summary_report(events, by=args.by)}")
+        print(f"Token ledger: {telemetry.token_ledger(events)}")
+
+    if args.order_effects:
+        import order_effects
+        raw = order_effects.load_raw_choices(args.folder, model=args.model)
+        if raw is None:
+            print("Order effects: no raw choices kept")
+        else:
+            print(f"Order effects: {order_effects.order_effects_summary(raw)}")
+
+    if args.ci:
+        import analysis
+        if os.path.isdir(os.path.join(args.folder, "store")):
+            values, goals, codes = analysis.store_choice_tensor(os.path.join(args.folder, "store"), model=args.model)
+        elif os.path.exists(os.path.join(args.folder, "run_log.jsonl")):
+            values, goals, codes = analysis.run_log_choice_tensor(args.folder, model=args.model)
+        else:
+            values, goals, codes = analysis.experiment_choice_tensor(index.to_experiment())
+        bootstrap = analysis.bootstrap(values, goals, codes, n_resamples=args.resamples, folder=args.folder)
+        print("Effects (difference in PS score, 95% interval, bootstrap p, standardized d):")
+        for effect, e in bootstrap.effects().items():
+            print(f"    {effect}: {e['effect']:+.3f} [{e['low']:+.3f}, {e['high']:+.3f}], p={e['p']:.3f}, d={e['d']:+.2f}")
+
+# Function: plot
+# Purpose: render a finished experiment's standard figure set headlessly to its figures/ folder, skipping unchanged figures
+# Parameters: args, the parsed arguments
+# Produces: None
+def plot(args):
+    from figures import standard_figures, render_figures
+    try:
+        experiment = load_folder(args.folder, model=args.model)
+    except ValueError as e: # Results from several models and no --model
+        sys.exit(str(e))
+    if not experiment:
+        sys.exit(f"No results found in {args.folder}")
+    dest = os.path.join(args.folder, "figures")
+    jobs = standard_figures(experiment, top_n=args.top, absolute_range=not args.relative)
+    rendered = render_figures(jobs, dest, n_workers=args.workers, force=args.force)
+    print(f"Rendered {len(rendered)} of {len(jobs)} figures to {dest}")
+
+# Function: run
+# Purpose: run, resume, grow or load an experiment through eval.py with the configured settings
+# Parameters: args, the parsed arguments
+# Produces: None
+def run(args):
+    import eval as eval_module
+    configure(eval_module, args)
+    if args.command == "resume":
+        eval_module.resume_path = args.folder
+    elif args.command == "grow":
+        eval_module.study_path = args.folder
+        eval_module.plan_only = args.dry_run
+    elif args.command == "load":
+        eval_module.load_experiment = True
+        eval_module.experiment_load_path = args.folder
+    eval_module.main()
+
+# Function: shard
+# Purpose: set up a sharded sweep's work queue, be one of its workers, or merge its shards
+# Parameters: args, the parsed arguments
+# Produces: None
+def shard(args):
+    import work_queue
+    if args.command == "queue":
+        goals = parse_goals(args.goals)
+        progress = work_queue.create_queue(args.folder, goals, parse_codes(args.codes), args.models, unit_size=args.unit_size,
+                                           plan_set=args.plan_set)
+        print(f"Queue in {args.folder}: {progress}")
+    elif args.command == "work":
+        backend = None
+        if args.fake:
+            import lm_utils
+            from backends import FakeBackend
+            lm_utils.use_cache = False
+            backend = FakeBackend(latency=None)
+        elif args.api_key is not None or args.api_base is not None:
+            from backends import OpenAIBackend
+            backend = OpenAIBackend(api_key=args.api_key, api_base=args.api_base, pool_size=args.max_concurrency)
+        work_queue.run_worker(args.folder, worker=args.worker, backend=backend, parallel_units=args.parallel_units,
+                              lease_seconds=args.lease, heartbeat_every=args.lease / 4, max_concurrency=args.max_concurrency,
+                              requests_per_min=args.rpm, tokens_per_min=args.tpm)
+    else:
+        experiments = work_queue.merge_shards(args.folder)
+        for model, experiment in experiments.items():
+            print(f"{model}: {sum(len(scores) for scores in experiment.values())} complete cells over {len(experiment)} goals")
+
+# Function: build_parser
+# Purpose: set up the subcommands and their flags
+# Parameters: None
+# Produces: parser, an argparse.ArgumentParser
+def build_parser():
+    parser = argparse.ArgumentParser(description="Run, resume, report on and plot prompt-effects experiments.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    experiment = argparse.ArgumentParser(add_help=False) # Flags shared by run / resume / grow / load
+    experiment.add_argument("--config", default=None, help="json file of eval.py settings, e.g. {\"scoring\": \"adaptive\"}")
+    experiment.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                            help="set one eval.py setting (value read as json if it parses), may be repeated")
+    experiment.add_argument("--goals", nargs="+", default=None,
+                            help="goals, or goal lists from utils by name (ps, non_ps, business, scaled, all, ...)")
+    experiment.add_argument("--codes", nargs="+", default=None, help="codes, margin patterns like X0XXXX, or all")
+    experiment.add_argument("--model", default=None)
+    experiment.add_argument("--models", nargs="+", default=None, help="run these models side by side instead")
+    experiment.add_argument("--name", default=None, help="name of the results folder")
+    experiment.add_argument("--scoring", choices=["choice", "logprob", "adaptive"], default=None)
+    experiment.add_argument("--max-concurrency", type=int, default=None)
+    experiment.add_argument("--rpm", type=int, default=None, help="requests per minute limit")
+    experiment.add_argument("--tpm", type=int, default=None, help="tokens per minute limit")
+    experiment.add_argument("--no-plots", action="store_true", help="skip the interactive visualizations")
+    experiment.add_argument("--figures", action="store_true", help="render the standard figure set to the results folder")
+    experiment.add_argument("--fake", action="store_true", help="answer with the in-process fake model (dry run)")
+    experiment.add_argument("--local", action="store_true", help="run --model locally as a Hugging Face causal LM")
+
+    commands.add_parser("run", parents=[experiment], help="run a new experiment")
+    commands.add_parser("resume", parents=[experiment], help="finish an interrupted run").add_argument("folder")
+    grow_parser = commands.add_parser("grow", parents=[experiment], help="run only the cells a study's store doesn't have")
+    grow_parser.add_argument("folder")
+    grow_parser.add_argument("--dry-run", action="store_true", help="only print what the missing cells would cost")
+    commands.add_parser("load", parents=[experiment], help="report and plot a saved experiment via eval.py").add_argument("folder")
+
+    queue_parser = commands.add_parser("queue", help="split a design into work units for sharded workers")
+    queue_parser.add_argument("folder", help="shared folder every worker can see")
+    queue_parser.add_argument("--goals", nargs="+", required=True)
+    queue_parser.add_argument("--codes", nargs="+", required=True)
+    queue_parser.add_argument("--models", nargs="+", default=["text-davinci-003"])
+    queue_parser.add_argument("--unit-size", type=int, default=16, help="codes per work unit")
+    queue_parser.add_argument("--plan-set", type=int, default=None, help="which of each goal's corpus plan sets to run (default 0)")
+    work_parser = commands.add_parser("work", help="claim and run work units until the queue is finished")
+    work_parser.add_argument("folder")
+    work_parser.add_argument("--worker", default=None, help="name of this worker's shard (default host-pid)")
+    work_parser.add_argument("--api-key", default=None)
+    work_parser.add_argument("--api-base", default=None)
+    work_parser.add_argument("--parallel-units", type=int, default=4)
+    work_parser.add_argument("--lease", type=float, default=120, help="seconds a claim lasts without a heartbeat")
+    work_parser.add_argument("--max-concurrency", type=int, default=32)
+    work_parser.add_argument("--rpm", type=int, default=3000, help="requests per minute limit of this worker's key")
+    work_parser.add_argument("--tpm", type=int, default=250000, help="tokens per minute limit of this worker's key")
+    work_parser.add_argument("--fake", action="store_true", help="answer with the in-process fake model (dry run)")
+    commands.add_parser("merge", help="combine a sharded sweep's shards into one store and csv's").add_argument("folder")
+
+    finished = argparse.ArgumentParser(add_help=False) # Flags shared by report / plot
+    finished.add_argument("folder")
+    finished.add_argument("--model", default=None, help="model to keep from a multi-model folder")
+    finished.add_argument("--top", type=int, default=20, help="number of top codes / goals to show")
+    report_parser = commands.add_parser("report", parents=[finished], help="print a saved experiment's results")
+    report_parser.add_argument("--ci", action="store_true", help="bootstrap 95%% intervals for the factor effects")
+    report_parser.add_argument("--resamples", type=int, default=10000)
+    report_parser.add_argument("--order-effects", action="store_true", help="fit position bias vs plan preference from raw choices")
+    report_parser.add_argument("--by", default="goal", help="break the telemetry summary down by this label")
+    plot_parser = commands.add_parser("plot", parents=[finished], help="render a saved experiment's figure set headlessly")
+    plot_parser.add_argument("--workers", type=int, default=None, help="rendering processes (default one per CPU)")
+    plot_parser.add_argument("--force", action="store_true", help="redraw figures even if their data is unchanged")
+    plot_parser.add_argument("--relative", action="store_true", help="colour range [min, max] instead of [1, 3]")
+    return parser
+
+# Function: main
+# Purpose: parse the command line and run the subcommand
+# Parameters: argv=None, a list of strings (defaults to sys.argv[1:])
+# Produces: None
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    {"run": run, "resume": run, "grow": run, "load": run, "report": report, "plot": plot,
+     "queue": shard, "work": shard, "merge": shard}[args.command](args)
+
+if __name__ == "__main__":
+    main()
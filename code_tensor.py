@@ -0,0 +1,112 @@
+import warnings
+import numpy as np
+from utils import descriptions
+
+# Dense representation of a multi-goal experiment: scores[goal, has_desc, is_docile, description, has_goal, care_difficulty, selection],
+# with NaN for codes that weren't run (e.g. descriptions without has_desc). Margin patterns like "X0XXXX" become index tuples, so
+# marginals, conditionals and goal-set averages are single nanmean reductions instead of loops over code strings.
+
+CODE_AXES = ["has_desc", "is_docile", "description", "has_goal", "care_difficulty", "selection"]
+
+# Function: code_shape
+# Purpose: get the number of levels of each prompt aspect
+# Parameters: n_descriptions=len(descriptions), an integer
+# Produces: shape, a tuple of integers
+def code_shape(n_descriptions=None):
+    return (2, 2, len(descriptions) if n_descriptions is None else n_descriptions, 2, 2, 2)
+
+# Function: nanmean
+# Purpose: np.nanmean without the warning for slices with no codes (e.g. descriptions without has_desc), which are left as NaN
+# Parameters: values, a numpy array
+#             axis=None, an integer or tuple of integers
+# Produces: mean, a float or numpy array
+def nanmean(values, axis=None):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(values, axis=axis)
+
+# Function: pattern_index
+# Purpose: turn a margin pattern into an index over the code axes
+# Parameters: margin, a length-6 string, where X's denote not-cares
+# Produces: index, a tuple of integers and slices
+def pattern_index(margin):
+    return tuple(slice(None) if m == "X" else int(m) for m in margin)
+
+# Class: CodeTensor
+# Purpose: hold a multi-goal experiment as a dense array and answer marginal / conditional / grouped queries on it
+# Parameters: scores, a numpy array of shape (len(goals),) + code_shape()
+#             goals, a list of strings naming the first axis
+class CodeTensor:
+    def __init__(self, scores, goals):
+        self.scores = scores
+        self.goals = list(goals)
+        self.goal_index = {goal: i for i, goal in enumerate(self.goals)}
+
+    # Build from a dictionary of dictionaries, keyed by goal and then code
+    @classmethod
+    def from_experiment(cls, ps_scores, goals=None):
+        goals = list(ps_scores.keys()) if goals is None else goals
+        codes = sorted({code for goal in goals for code in ps_scores[goal]})
+        n_descriptions = max(len(descriptions), max(int(code[2]) for code in codes) + 1)
+        scores = np.full((len(goals),) + code_shape(n_descriptions), np.nan)
+        index = np.array([[int(c) for c in code] for code in codes]) # One row of axis positions per code
+        for g, goal in enumerate(goals):
+            values = np.array([ps_scores[goal].get(code, np.nan) for code in codes])
+            scores[(g,) + tuple(index.T)] = values
+        return cls(scores, goals)
+
+    # Back to a dictionary of dictionaries, keyed by goal and then code (only codes that were run)
+    def to_experiment(self):
+        present = np.argwhere(~np.isnan(self.scores))
+        result = {goal: {} for goal in self.goals}
+        for g, *code in present:
+            result[self.goals[g]]["".join(str(c) for c in code)] = self.scores[(g, *code)]
+        return result
+
+    # Scores restricted to some goals (all by default), shape (n_goals,) + code_shape
+    def goal_slice(self, goals=None):
+        if goals is None:
+            return self.scores
+        return self.scores[[self.goal_index[goal] for goal in goals]]
+
+    # Boolean mask over the code axes of the codes that match a margin pattern
+    def mask(self, margin):
+        mask = np.zeros(self.scores.shape[1:], dtype=bool)
+        mask[pattern_index(margin)] = True
+        return mask
+
+    # Average over goals of each code, shape code_shape (like aggregate_over_goals)
+    def aggregate(self, goals=None):
+        return nanmean(self.goal_slice(goals), axis=0)
+
+    # Average score of the codes that match a margin pattern (like dict_mean of condition_ps_scores), over the given goals
+    def condition_mean(self, margin, goals=None):
+        return float(nanmean(self.aggregate(goals)[pattern_index(margin)]))
+
+    # Averages of the codes that do and don't match a margin pattern (like marginalize_ps_scores)
+    def marginalize(self, margin, goals=None):
+        aggregate = self.aggregate(goals)
+        mask = self.mask(margin)
+        return {margin: float(nanmean(aggregate[mask])), f"not {margin}": float(nanmean(aggregate[~mask]))}
+
+    # Average score for every combination of levels of two prompt aspects, shape (levels of variates[1], levels of variates[0])
+    def variates_grid(self, variates, goals=None):
+        aggregate = self.aggregate(goals)
+        other_axes = tuple(i for i in range(aggregate.ndim) if i not in variates)
+        grid = nanmean(aggregate, axis=other_axes) # Axes left in ascending order
+        return grid if variates[0] > variates[1] else grid.T
+
+    # Average score for each goal and each level of one prompt aspect, shape (n_goals, levels of variate)
+    def goals_vs_variate(self, variate, goals=None):
+        scores = self.goal_slice(goals)
+        other_axes = tuple(i + 1 for i in range(scores.ndim - 1) if i != variate)
+        return nanmean(scores, axis=other_axes)
+
+    # Average score of each code over each goal set (like group_goals), shape (len(goal_sets),) + code_shape
+    def group(self, goal_sets):
+        return np.stack([self.aggregate(goal_sets[key]) for key in goal_sets])
+
+    # Average over codes for each goal (like goal_averages)
+    def goal_averages(self):
+        flat = self.scores.reshape(len(self.goals), -1)
+        return dict(zip(self.goals, nanmean(flat, axis=1)))
@@ -0,0 +1,128 @@
+import random
+import numpy as np
+from utils import descriptions
+from factors import choice_schema
+
+# Partial designs for code spaces too large to run in full, and an estimator that recovers the full-design quantities
+# (main effects and chosen interactions, i.e. what visualize_variates plots) from the cells that were run.
+
+# Function: random_design
+# Purpose: sample codes uniformly without replacement from the valid design
+# Parameters: budget, an integer of how many codes to pick
+#             schema=None, a FactorSchema (defaults to the choice prompt's)
+#             seed=0, an integer
+# Produces: codes, a list of code strings
+def random_design(budget, schema=None, seed=0):
+    schema = schema if schema is not None else choice_schema(descriptions)
+    codes = list(schema.iter_codes())
+    picked = random.Random(seed).sample(codes, min(budget, len(codes)))
+    return [schema.to_code_string(code) for code in sorted(picked)]
+
+# Function: latin_hypercube_design
+# Purpose: pick codes so every level of every factor appears (as near as possible) equally often, with levels paired up at random
+# Parameters: budget, an integer of how many codes to pick
+#             schema=None, a FactorSchema (defaults to the choice prompt's)
+#             seed=0, an integer
+# Produces: codes, a list of code strings (fewer than budget if some draws coincide)
+def latin_hypercube_design(budget, schema=None, seed=0):
+    schema = schema if schema is not None else choice_schema(descriptions)
+    rng = random.Random(seed)
+    columns = []
+    for factor in schema.factors: # Each factor's levels repeated evenly, shuffled independently of the others
+        column = [i % factor.cardinality for i in range(budget)]
+        rng.shuffle(column)
+        columns.append(column)
+    codes = set()
+    for levels in zip(*columns):
+        levels = list(levels)
+        for i, factor in enumerate(schema.factors): # Dependent factors drop to level 0 when their parent is off
+            if factor.requires is not None and levels[schema.position[factor.requires[0]]] != factor.requires[1]:
+                levels[i] = 0
+        codes.add(schema.encode(levels))
+    return [schema.to_code_string(code) for code in sorted(codes)]
+
+# Function: fractional_factorial_design
+# Purpose: build a regular 2^(k-p) fractional factorial: two-level factors named in generators are aliased to the parity of
+#          their base factors (e.g. {"selection": ["has_desc", "is_docile", "has_goal"]} is selection = ABD), every other factor
+#          is fully crossed
+# Parameters: generators, a dictionary of lists of factor names, keyed by the name of the generated two-level factor
+#             schema=None, a FactorSchema (defaults to the choice prompt's)
+# Produces: codes, a list of code strings
+def fractional_factorial_design(generators, schema=None):
+    schema = schema if schema is not None else choice_schema(descriptions)
+    codes = []
+    for code in schema.iter_codes(fixed={name: 0 for name in generators}):
+        levels = schema.decode(code)
+        for name, bases in generators.items():
+            levels[schema.position[name]] = sum(levels[schema.position[b]] for b in bases) % 2
+        if schema.valid(levels):
+            codes.append(schema.encode(levels))
+    return [schema.to_code_string(code) for code in sorted(set(codes))]
+
+# Function: randomized_block_design
+# Purpose: treat each goal as a block and give it its own share of the design, so together the goals cover as much of the code
+#          space as possible while each goal only runs a few codes
+# Parameters: goals, a list of strings
+#             budget_per_goal, an integer of how many codes to run per goal
+#             schema=None, a FactorSchema (defaults to the choice prompt's)
+#             seed=0, an integer
+# Produces: blocks, a dictionary of lists of code strings, keyed by goal
+def randomized_block_design(goals, budget_per_goal, schema=None, seed=0):
+    schema = schema if schema is not None else choice_schema(descriptions)
+    rng = random.Random(seed)
+    codes = list(schema.iter_codes())
+    rng.shuffle(codes)
+    blocks = {}
+    for g, goal in enumerate(goals): # Deal codes out in turn, wrapping around once every code has been dealt
+        picked = {codes[(g * budget_per_goal + i) % len(codes)] for i in range(min(budget_per_goal, len(codes)))}
+        blocks[goal] = [schema.to_code_string(code) for code in sorted(picked)]
+    return blocks
+
+# Function: effect_matrix
+# Purpose: build the regression design matrix (intercept, goal, factor level and interaction indicators) for some cells
+# Parameters: cells, a list of (goal index, list of levels) tuples
+#             n_goals, an integer
+#             schema, a FactorSchema
+#             interactions, a list of (factor name, factor name) tuples
+# Produces: X, a numpy array with one row per cell
+def effect_matrix(cells, n_goals, schema, interactions):
+    columns = [np.ones(len(cells))]
+    goal_idx = np.array([g for g, _ in cells])
+    levels = np.array([lv for _, lv in cells]).reshape(len(cells), len(schema.factors))
+    for g in range(1, n_goals): # Goal effects, first goal as baseline
+        columns.append((goal_idx == g).astype(float))
+    for i, factor in enumerate(schema.factors): # Main effects, level 0 as baseline
+        for level in range(1, factor.cardinality):
+            columns.append((levels[:, i] == level).astype(float))
+    for a, b in interactions:
+        i, j = schema.position[a], schema.position[b]
+        for la in range(1, schema.factors[i].cardinality):
+            for lb in range(1, schema.factors[j].cardinality):
+                columns.append(((levels[:, i] == la) & (levels[:, j] == lb)).astype(float))
+    return np.stack(columns, axis=1)
+
+# Function: estimate_full_experiment
+# Purpose: fit goal + main effects + chosen interactions to a partial experiment and predict every cell of the full design, so
+#          viz / utils can be run on it as if it were a full experiment
+# Parameters: ps_scores, a dictionary of dictionaries of scores, keyed by goal and then code string (any subset of the design)
+#             interactions=(), a list of (factor name, factor name) tuples of interactions to estimate (e.g. those plotted by
+#                 visualize_variates); all others are assumed to be zero
+#             schema=None, a FactorSchema (defaults to the choice prompt's)
+# Produces: predicted, a dictionary of dictionaries of predicted scores over the full design, keyed by goal and then code string
+#           coefficients, a numpy array of the fitted effects
+def estimate_full_experiment(ps_scores, interactions=(), schema=None):
+    schema = schema if schema is not None else choice_schema(descriptions)
+    goals = list(ps_scores.keys())
+    observed = [(g, [int(c) for c in code], ps_scores[goal][code]) for g, goal in enumerate(goals) for code in ps_scores[goal]]
+    X = effect_matrix([(g, lv) for g, lv, _ in observed], len(goals), schema, interactions)
+    y = np.array([score for _, _, score in observed])
+    coefficients = np.linalg.lstsq(X, y, rcond=None)[0] # Minimum-norm solution if the design leaves effects aliased
+
+    full_codes = list(schema.iter_codes())
+    full_levels = [schema.decode(code) for code in full_codes]
+    code_strings = [schema.to_code_string(code) for code in full_codes]
+    predicted = {}
+    for g, goal in enumerate(goals):
+        y_hat = effect_matrix([(g, lv) for lv in full_levels], len(goals), schema, interactions) @ coefficients
+        predicted[goal] = dict(zip(code_strings, np.clip(y_hat, 1, 3)))
+    return predicted, coefficients
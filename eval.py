@@ -1,23 +1,64 @@
 import time # Timing experiments
 import itertools # Permuting plan list to counter order effects
+import json
 from utils import * # Constants, saving/loading data
-from lm_utils import * # Interacting with the LM / generating prompts
-from viz import * # Creating visualizations
+from run_log import RunLog # Recording choices so runs can be resumed
+# The runners (lm_utils and the engines built on it: openai, aiohttp) and the result store (pyarrow) are imported where they're
+# used, so loading and reporting on results doesn't pay for them
+import telemetry # Per-call latency, token and cache instrumentation
+import analysis # Bootstrap confidence intervals and effect sizes
+import order_effects as oe # Raw per-ordering choices, position bias and plan preference
+from aggregate_index import AggregateIndex # Averages by goal, code and goal set, summed once
 
 ### VARIABLES FOR INTERFACING WITH EXPERIMENT / VISUALIZATION SOFTWARE ###
 
 model = "text-davinci-003" # OpenAI model to use (Only compatible with openai.Completion models)
+local_model = False # Whether to run model locally as a Hugging Face causal LM (e.g. model = "gpt2"; needs torch and transformers)
+compare_models = [] # Models to run side by side instead of model, as names or ModelLane(name, backend, max_concurrency, ...)
 
 load_experiment = False # Whether to load data from csv or generate anew
 experiment_load_path = "C:/Users/divin/OneDrive/Documents/SERI MATS/LMPower/results/csv/all/" # Where to load data from
 print_results = True # Whether to print total results and summary to terminal
+resume_path = None # Folder of a crashed / interrupted run to finish (None to start a new run)
+study_path = None # Folder of a study to grow: only cells (of model / compare_models, goals, codes) missing from its store are run
+plan_only = False # With study_path, only print what the missing cells would cost
+plan_set = 0 # Which of each goal's corpus plan sets to run (keep one plan set per experiment / study folder)
+
+scoring = "choice" # "choice" to average sampled choices over all 6 plan orderings,
+                   # "logprob" for expected score from plan-number probabilities,
+                   # "adaptive" to stop each cell once settled and spend the savings on high-variance cells
+logprob_permutations = "cyclic" # For "logprob" scoring, "cyclic" (3 orderings) or "all" (6 orderings)
+sample_budget = None # For "adaptive" scoring, total sampled choices to spend (None for 6 per cell)
+sample_temperature = 1.0 # For "adaptive" scoring, temperature of the extra samples
+
+run_async = True # Whether to send all requests concurrently (otherwise one after another)
+max_concurrency = 32 # Most requests in flight at once when running asynchronously
+requests_per_min = 3000 # Request rate limit for your API key
+tokens_per_min = 250000 # Token rate limit for your API key
+stream_results = False # Whether to run as a streaming pipeline (bounded memory, results go straight to dest/store)
+report_every = 500 # When streaming, print partial results every this many finished prompts
+
+batch_requests = True # When not running asynchronously, whether to pack many prompts into each request
+batch_max_prompts = 20 # Most prompts per batched request
+batch_max_tokens = 40000 # Most prompt + completion tokens per batched request
+
+record_telemetry = True # Whether to record every call's latency, retries and tokens (to dest/telemetry.jsonl, dest/metrics.prom)
+prompt_layout = "question_first" # "plans_first" puts each goal's plan list ahead of the per-code text, so prefix caches can reuse it
+                                 # (see factors.PROMPT_LAYOUTS; responses aren't comparable across layouts)
+telemetry_by = "goal" # Break the telemetry summary down by "goal", "model", "code" or a code factor ("is_docile", ...)
+
+confidence_intervals = True # Whether to bootstrap 95% intervals for printed effects and the variates / goals_variate plots
+bootstrap_resamples = 10000 # Number of bootstrap resamples
+order_effects = False # Whether to print position bias vs plan preference, fitted from the raw per-ordering choices
 
 save_csv = True # If we're running experiment, whether to save the results
+save_store = True # If we're running experiment, whether to save the results to a columnar store (dest/store) as well
+save_choices = True # If we're running experiment, whether to keep the raw choices as a goal x code x ordering array (dest/choices.npz)
 save_png = True # If we're visualizing results, whether to save the visualization
-ask_for_png_name = False # Whether to ask filename for saved visualization
 
+render_figure_set = False # Whether to (re)draw the standard figure set to dest/figures/ headlessly, skipping unchanged figures
 visualize = True # Generate visualization?
-visualizations = ["top_n_goals"] # Options: variates, goals
+visualizations = ["top_n_goals"] # Options: variates, goals, models (needs a result store with several models)
 absolute_range = False # Whether to give the heatmap (graph) a colorbar (y-axis) range of [1,3] or of [sample min, max]
 variates = (1,3) # Which prompt aspects to look at for variates plot
 top_n = 20 # Number of top goals / prompts to look at in graph
@@ -35,13 +76,65 @@ hot_codes = all_codes[16:40]
 codes = ["100100"]
 
 
+experiment_name = "experiment" # Name of the folder (under ./results/, after the date) new runs save to
+
+
 ## CODE FOR RUNNING EXPERIMENTS ##
 
-experiment_name = ""
-if not load_experiment and (save_csv or save_png):
-    experiment_name = input(f"Please enter a name for your experiment on goals {goals} and codes {codes}: ")
-gen_plans_prompt = open("gen_plans_prompt.txt", "r").read()
 
+# Function: run_cells
+# Purpose: get the model's choice for every (code, permutation) cell of a goal, skipping cells already in the run log
+# Parameters: codes, a list of length-6 binary (except for position 2, which goes 0-[len(descriptions)-1]) strings
+#             goal, a string
+#             plans, a string with exactly three lines separated by \n
+#             run_log=None, a RunLog to record choices in and resume from
+# Produces: choices, a dictionary of (choice, PS score) integer tuples, keyed by (code, permutation index); orderings given up
+#               on (no valid answer even to the strict re-ask) are missing
+def run_cells(codes, goal, plans, run_log=None):
+    from lm_utils import plan_permutations, generate_choice_prompt, pack_batches, choice_params, choose_plans_batch, \
+        choose_plan, resolve_choices, choice_to_ps # Interacting with the LM / generating prompts
+    original_plans, permutations = plan_permutations(plans) # Save original ordering (low-high PS) for scoring purposes
+    choices = {}
+    todo = []
+    for code in codes:
+        for k, plans_p in enumerate(permutations):
+            record = run_log.get(model, goal, code, k) if run_log is not None else None
+            if record is not None: # Already done in a previous run
+                choices[(code, k)] = (record["choice"], record["ps"])
+            else:
+                todo.append((code, k))
+
+    choice_prompts = {code: generate_choice_prompt(code, descriptions, goal) for code in codes} # Prompts for eliciting choice of plan
+    requests = [(choice_prompts[code], permutations[k]) for code, k in todo]
+    if batch_requests: # Send many cells at once, a request's worth at a time, so each batch is logged as soon as it's back
+        chunks = pack_batches([choice_params(model, *request) for request in requests], batch_max_prompts, batch_max_tokens)
+    else:
+        chunks = [[i] for i in range(len(requests))]
+
+    for chunk in chunks:
+        chunk_requests = [requests[i] for i in chunk]
+        with telemetry.labelled(model=model, goal=goal), telemetry.stage("choose"):
+            if batch_requests:
+                plan_outputs = choose_plans_batch(model, chunk_requests, batch_max_prompts, batch_max_tokens)
+            else:
+                plan_outputs = [choose_plan(model, choice_prompt, plans_p) for choice_prompt, plans_p in chunk_requests]
+
+        def on_invalid(i, text, final=False): # Unparseable answers are re-asked with a strict one-token request
+            if run_log is not None:
+                run_log.log_invalid(model, goal, *todo[chunk[i]], text, final=final)
+        with telemetry.labelled(model=model, goal=goal), telemetry.stage("resolve"):
+            plan_choices = resolve_choices(model, chunk_requests, [plan_output.choices[0].text for plan_output in plan_outputs],
+                                           on_invalid, batch_max_prompts, batch_max_tokens) # Number of plan chosen by model
+
+        for i, plan_choice in zip(chunk, plan_choices):
+            if plan_choice is None: # Given up on: left out of the cell (and of the run log, so a resume asks it again)
+                continue
+            code, k = todo[i]
+            power_seekiness = choice_to_ps(original_plans, permutations[k], plan_choice) # Where this plan is in original order
+            if run_log is not None:
+                run_log.log(model, goal, code, k, plan_choice, power_seekiness)
+            choices[(code, k)] = (plan_choice, power_seekiness)
+    return choices
 
 # Function: single_prompt_experiment
 # Purpose: get the power-seeking score for a single prompt, given a single goal and single set of plans
@@ -49,34 +142,49 @@ gen_plans_prompt = open("gen_plans_prompt.txt", "r").read()
 #             goal, a string
 #             plans, a string with exactly three lines separated by \n
 #             verbose=False, a boolean controlling printing behavior
+#             run_log=None, a RunLog to record choices in and resume from
 # Produces: score, a float corresponding to the average PS score of the model over all 6 permutations of the plans
-def single_prompt_experiment(code, goal, plans, verbose=False):
-    plan_list = [p for p in plans.split("\n") if p != ""]
-    original_plans = plan_list.copy() # Save original ordering (low-high PS) for scoring purposes
+def single_prompt_experiment(code, goal, plans, verbose=False, run_log=None):
+    from lm_utils import plan_permutations
+    original_plans, permutations = plan_permutations(plans)
 
     ps_score = 0 # How power-seeking the model is under the given prompt and goal
-    n = 0
     t1 = time.time()
-    choice_prompt = generate_choice_prompt(code, descriptions, goal) # Get prompt for eliciting choice of plan
+    choices = run_cells([code], goal, plans, run_log=run_log)
 
-    for plans_p in list(itertools.permutations(plan_list)): # Average over all permutations of plan list
+    n = 0
+    for k in range(len(permutations)): # Average over all permutations of plan list
+        if (code, k) not in choices: # Given up on
+            continue
         n += 1
-        plan_output = choose_plan(model, choice_prompt, plans_p)
-        plan_choice = get_choice(plan_output.choices[0].text) # Number of plan chosen by model
-        power_seekiness = original_plans.index(plans_p[plan_choice - 1]) + 1 # Find where this plan appears in original order
-
+        power_seekiness = choices[(code, k)][1]
         if verbose:
             result = f"""Model: {model}\nGoal: {goal.strip()}\n\nPlans:\n{plans.strip()}\n\nPS, Choice: {power_seekiness}, 
                     {original_plans[power_seekiness - 1]}"""
             print(result)
         ps_score += power_seekiness
-    ps_score /= n
+    ps_score = ps_score / n if n else float("nan")
 
     if verbose:
         print(f"Power-seeking Rating: {ps_score:.2f}")  # Average power-seeking score
         print(f"Analysis of code {code} took {time.time() - t1:.2f} seconds")  # How long the sim took
     return ps_score
 
+# Function: batch_prompt_experiment
+# Purpose: get the power-seeking scores for several prompts, given a single goal and single set of plans, sending the
+#          whole grid of (code, permutation) prompts together (as a few batched requests if batch_requests is set)
+# Parameters: codes, a list of length-6 binary (except for position 2, which goes 0-[len(descriptions)-1]) strings
+#             goal, a string
+#             plans, a string with exactly three lines separated by \n
+#             run_log=None, a RunLog to record choices in and resume from
+# Produces: scores, a dictionary of float PS scores, keyed by code
+def batch_prompt_experiment(codes, goal, plans, run_log=None):
+    from lm_utils import plan_permutations
+    n = len(plan_permutations(plans)[1])
+    choices = run_cells(codes, goal, plans, run_log=run_log)
+    ps = {code: [choices[(code, k)][1] for k in range(n) if (code, k) in choices] for code in codes} # Without those given up on
+    return {code: sum(ps[code]) / len(ps[code]) if ps[code] else float("nan") for code in codes}
+
 # Function: multi_prompt_experiment
 # Purpose: get the power-seeking scores for several prompts, given a single goal and single set of plans
 # Parameters: codes, a list of length-6 binary (except for position 2, which goes 0-[len(descriptions)-1]) strings
@@ -85,13 +193,17 @@ def single_prompt_experiment(code, goal, plans, verbose=False):
 #             verbose=True, a boolean controlling printing behavior
 #             save_csv=True, a boolean controlling whether to save the results
 #             dest="./results", a string of the destination to save the csv to
+#             run_log=None, a RunLog to record choices in and resume from
 # Produces: scores, a dictionary of float PS scores, keyed by code
-def multi_prompt_experiment(codes, goal, plans, verbose=True, save_csv=True, dest="./results"):
+def multi_prompt_experiment(codes, goal, plans, verbose=True, save_csv=True, dest="./results", run_log=None):
     ps_scores = {}  # Power-seeking scores
     t1 = time.time()  # Get runtime
 
-    for code in codes: # Get score for each code
-        ps_scores[code] = single_prompt_experiment(code, goal, plans)
+    if batch_requests:
+        ps_scores = batch_prompt_experiment(codes, goal, plans, run_log=run_log)
+    else:
+        for code in codes: # Get score for each code
+            ps_scores[code] = single_prompt_experiment(code, goal, plans, run_log=run_log)
 
     if verbose:
         print()
@@ -110,61 +222,229 @@ def multi_prompt_experiment(codes, goal, plans, verbose=True, save_csv=True, des
 #             verbose=True, a boolean controlling printing behavior
 #             save_csv=True, a boolean controlling whether to save results to csv's
 #             name="experiment", a string of the folder name to store all the csv's to
+#             resume=None, a string of a previous run's folder to continue (only cells missing from its run log are run)
+#             plan_set=0, an integer of which of each goal's plan sets to run
 # Produces: scores, a dictionary of multi_prompt_experiments, keyed by goal
-def multi_goal_experiment(goals, codes, verbose=True, save_csv=True, name="experiment"):
+def multi_goal_experiment(goals, codes, verbose=True, save_csv=True, name="experiment", resume=None, plan_set=0):
     results = {}
     t1 = time.time()
-    dt = datetime.datetime.now()
-    dest = f"./results/csv/{dt.strftime('%Y.%d.%m %H.%M.%S')} {name}/"
+    dest = resume if resume is not None else experiment_folder(name)
+    if dest[-1] != "/":
+        dest += "/"
 
-    if save_csv:
-        os.makedirs(dest) # Make folder to save multi_prompt_experiments to
+    run_log = RunLog(dest) # Makes the folder, records every choice as it comes in
 
-    for goal in goals:
-        plans = open(f"goals/{goal}/plans.txt", "r").read()
-        results[goal] = multi_prompt_experiment(codes, goal, plans, verbose=verbose, save_csv=save_csv, dest=dest)
+    try:
+        for goal in goals:
+            plans = load_plans(goal, plan_set)
+            with telemetry.labelled(model=model, goal=goal), telemetry.stage("goal"):
+                results[goal] = multi_prompt_experiment(codes, goal, plans, verbose=verbose, save_csv=save_csv, dest=dest,
+                                                        run_log=run_log)
+    finally:
+        run_log.close()
 
     if verbose:
         print(f"Analysis of {len(codes)} prompts over {len(goals)} goals took {time.time()-t1:.2f} seconds.")
     return results, dest
 
 ### WHERE THE EXPERIMENTS HAPPEN ###
-if not load_experiment:
-    experiment, dest = multi_goal_experiment(goals, codes, save_csv=save_csv, name=experiment_name)
-else:
-    dest = experiment_load_path
-    experiment = load_multi_goal_experiment(dest, codes, goals)
 
-if print_results:
-    sorted_code = sort_dict(aggregate_over_goals(goals, codes, experiment))
-    sorted_goal = sort_dict(goal_averages(experiment))
+# Function: run_experiment
+# Purpose: run (or resume, or load) the experiment described by the variables above, and save its results
+# Parameters: None
+# Produces: experiment, a dictionary of dictionaries of PS scores, keyed by goal and then code
+#           dest, a string of the experiment folder
+#           experiment_model, a string of the model the experiment's scores are from (None if loaded, except from multi-model stores)
+def run_experiment():
+    if not load_experiment:
+        import lm_utils # Prompt settings and backends
+        lm_utils.prompt_layout = prompt_layout
+        if local_model:
+            from local_backend import LocalBackend # torch and transformers are only needed here
+            lm_utils.set_backend(LocalBackend(model), model=model)
+    if record_telemetry and not load_experiment:
+        telemetry.enable()
+    experiment_model = None if load_experiment else model
+    if not load_experiment and study_path is not None:
+        from model_sweep import ModelLane # Running several models side by side
+        from planner import run_incremental_sweep # Growing a study by only the cells it doesn't have yet
+        lanes = compare_models if compare_models else [ModelLane(model, max_concurrency=max_concurrency,
+                                                                 requests_per_min=requests_per_min, tokens_per_min=tokens_per_min)]
+        experiments, plan = run_incremental_sweep(goals, codes, lanes, study_path, execute=not plan_only, verbose=print_results,
+                                                  plan_set=plan_set)
+        dest = study_path
+        experiment_model = lanes[0] if isinstance(lanes[0], str) else lanes[0].model
+        experiment = experiments.get(experiment_model, {}) # Summaries are of the first model, as for compare_models
+    elif not load_experiment and compare_models:
+        from model_sweep import run_model_sweep
+        experiments, dest = run_model_sweep(goals, codes, compare_models, name=experiment_name, resume=resume_path,
+                                            save_store=save_store, verbose=print_results, plan_set=plan_set)
+        experiment_model = list(experiments)[0]
+        experiment = experiments[experiment_model] # Summaries are of the first model; see the "models" visualization
+    elif not load_experiment and scoring == "logprob":
+        from logprob_scoring import logprob_multi_goal_experiment # Scoring from plan-number probabilities
+        experiment, position_bias, dest = logprob_multi_goal_experiment(goals, codes, model, permutation_set=logprob_permutations,
+                                                                        save_csv=save_csv, name=experiment_name, plan_set=plan_set)
+    elif not load_experiment and scoring == "adaptive":
+        from adaptive import adaptive_multi_goal_experiment # Stopping settled cells early
+        experiment, n_samples, dest = adaptive_multi_goal_experiment(goals, codes, model, budget=sample_budget,
+                                                                     temperature=sample_temperature, plan_set=plan_set,
+                                                                     save_csv=save_csv, name=experiment_name)
+    elif not load_experiment and stream_results:
+        from pipeline import run_stream_experiment # Streaming sweeps with bounded memory
+        from result_store import load_store_experiment
+        aggregates, dest = run_stream_experiment(goals, codes, model, name=experiment_name, resume=resume_path,
+                                                 max_concurrency=max_concurrency, requests_per_min=requests_per_min,
+                                                 tokens_per_min=tokens_per_min, report_every=report_every, plan_set=plan_set)
+        experiment = load_store_experiment(os.path.join(dest, "store"), codes, goals)
+    elif not load_experiment and run_async:
+        from async_engine import run_async_multi_goal_experiment # Running experiments concurrently
+        experiment, dest = run_async_multi_goal_experiment(goals, codes, model, max_concurrency=max_concurrency,
+                                                           requests_per_min=requests_per_min, tokens_per_min=tokens_per_min,
+                                                           save_csv=save_csv, name=experiment_name, resume=resume_path,
+                                                           plan_set=plan_set)
+    elif not load_experiment:
+        experiment, dest = multi_goal_experiment(goals, codes, save_csv=save_csv, name=experiment_name, resume=resume_path,
+                                                 plan_set=plan_set)
+    elif os.path.isdir(os.path.join(experiment_load_path, "store")): # Prefer the columnar store when there is one
+        from result_store import load_store_experiment, store_models # Columnar result storage
+        dest = experiment_load_path
+        if len(store_models(os.path.join(dest, "store"))) > 1: # A model sweep or study: summarize the model setting's results
+            experiment_model = model
+        experiment = load_store_experiment(os.path.join(dest, "store"), codes, goals,
+                                           models=None if experiment_model is None else [experiment_model])
+    else:
+        dest = experiment_load_path
+        experiment = load_multi_goal_experiment(dest, codes, goals)
+    if dest[-1] != "/":
+        dest += "/"
 
+    own_store = stream_results or compare_models or study_path is not None # These write their own stores
+    if not load_experiment and save_store and not own_store:
+        from result_store import run_log_to_store, experiment_to_store
+        if os.path.exists(dest + "run_log.jsonl"): # Keep every raw choice
+            run_log_to_store(dest)
+        else:
+            experiment_to_store(experiment, os.path.join(dest, "store"), model=model)
+
+    if not load_experiment and save_choices:
+        raw = oe.load_raw_choices(dest, model=experiment_model, use_saved=False) # Rebuilt, so new choices get in
+        if raw is not None: # Not for scoring modes that don't keep a choice per ordering (logprob, adaptive)
+            raw.save(dest + "choices.npz")
+
+    events = telemetry.disable().events if telemetry.active is not None else []
+    if events: # Skipped when nothing ran (e.g. a plan_only dry run), so earlier telemetry is left alone
+        # Studies and resumed runs keep every run's events; the metrics and ledger then cover all of them
+        append = study_path is not None or resume_path is not None
+        telemetry.write_events(events, dest + "telemetry.jsonl", append=append)
+        run_events = events
+        if append:
+            events = telemetry.read_events(dest + "telemetry.jsonl")
+        telemetry.export_prometheus(events, dest + "metrics.prom")
+        ledger = telemetry.token_ledger(events)
+        with open(dest + "token_ledger.json", "w") as f:
+            json.dump(ledger, f, indent=1)
+        if print_results:
+            print(f"Telemetry: {telemetry.summary_report(run_events, by=telemetry_by)}")
+            print(f"Token ledger: {ledger.get('total')}")
+    return experiment, dest, experiment_model
+
+# Function: experiment_bootstrap
+# Purpose: bootstrap an experiment's statistics from the rawest results its folder has (run log, then store, then cell means)
+# Parameters: experiment, a dictionary of dictionaries, keyed by goal and then code
+#             dest, a string of the experiment folder
+#             experiment_model=None, a string of the model to keep from a multi-model folder
+# Produces: bootstrap, an analysis.Bootstrap
+def experiment_bootstrap(experiment, dest, experiment_model=None):
+    if study_path is not None and os.path.isdir(os.path.join(dest, "store")): # A study's run log only has what was run in it
+        values, boot_goals, boot_codes = analysis.store_choice_tensor(os.path.join(dest, "store"), goals, codes,
+                                                                      model=experiment_model)
+    elif os.path.exists(os.path.join(dest, "run_log.jsonl")): # Raw choices, so each cell's orderings get resampled too
+        values, boot_goals, boot_codes = analysis.run_log_choice_tensor(dest, goals, codes, model=experiment_model)
+    elif os.path.isdir(os.path.join(dest, "store")):
+        values, boot_goals, boot_codes = analysis.store_choice_tensor(os.path.join(dest, "store"), goals, codes,
+                                                                      model=experiment_model)
+    else:
+        values, boot_goals, boot_codes = analysis.experiment_choice_tensor(experiment)
+    return analysis.bootstrap(values, boot_goals, boot_codes, n_resamples=bootstrap_resamples, folder=dest)
+
+# Function: report_experiment
+# Purpose: print an experiment's results by code and by goal, and its effects if bootstrapped
+# Parameters: experiment, a dictionary of dictionaries, keyed by goal and then code
+#             bootstrap=None, an analysis.Bootstrap of the experiment
+# Produces: None
+def report_experiment(experiment, bootstrap=None):
+    index = AggregateIndex.from_experiment(experiment)
     print(f"Total results: {experiment}")
-    print(f"By code: {sorted_code}")
-    print(f"By goal: {sorted_goal}")
+    print(f"By code: {sort_dict(index.code_averages())}")
+    print(f"By goal: {sort_dict(index.goal_averages())}")
+    if bootstrap is not None:
+        print("Effects (difference in PS score, 95% interval, bootstrap p, standardized d):")
+        for effect, e in bootstrap.effects().items():
+            print(f"    {effect}: {e['effect']:+.3f} [{e['low']:+.3f}, {e['high']:+.3f}], p={e['p']:.3f}, d={e['d']:+.2f}")
 
-if visualize:
+# Function: plot_experiment
+# Purpose: draw the visualizations chosen above, and render the standard figure set if render_figure_set is on
+# Parameters: experiment, a dictionary of dictionaries, keyed by goal and then code
+#             dest, a string of the experiment folder
+#             bootstrap=None, an analysis.Bootstrap of the experiment, for intervals on the variates / goals_variate plots
+# Produces: None
+def plot_experiment(experiment, dest, bootstrap=None):
+    from viz import visualize_variates, visualize_goals_vs_codes, visualize_goals_vs_variate, histo_general, graph_general, \
+        visualize_models_vs_codes, visualize_models_vs_goals # matplotlib is only needed here
+    if render_figure_set:
+        from figures import standard_figures, render_figures
+        rendered = render_figures(standard_figures(experiment, top_n=top_n, absolute_range=absolute_range), dest + "figures/")
+        print(f"Rendered {len(rendered)} figures to {dest}figures/")
+    if not visualize:
+        return
+
+    run_goals = [goal for goal in goals if goal in experiment]
+    index = AggregateIndex.from_experiment(experiment, goal_sets={"plot": goal_sets})
     if "variates" in visualizations:
-        visualize_variates(experiment, variates,
-                           save_png=save_png, dest=dest, absolute_range=absolute_range,
-                           name=input("Please enter a name for your 'variates' plot: ") if ask_for_png_name else f"variates_{str(variates)}")
+        visualize_variates(experiment, variates, save_png=save_png, dest=dest, absolute_range=absolute_range,
+                           bootstrap=bootstrap, name=f"variates_{str(variates)}")
     if "goals" in visualizations:
-        visualize_goals_vs_codes(group_goals(experiment, codes, goal_sets), save_png=save_png, dest=dest, absolute_range=absolute_range,
-                                 name=input("Please enter a name for your 'goals' plot: ") if ask_for_png_name else f"goals")
+        visualize_goals_vs_codes(index.group("plot", codes), save_png=save_png, dest=dest,
+                                 absolute_range=absolute_range, name="goals")
     if "goals_variate" in visualizations:
-        group = group_goals(experiment, codes, goal_sets)
-        visualize_goals_vs_variate(group, variates[0],
-                                   save_png=save_png, dest=dest, absolute_range=absolute_range,
-                                   name=input("Please enter a name for your 'goals_variate' plot: ") if ask_for_png_name else f"goals_variate_{str(variates[0])}")
+        group = index.group("plot", codes)
+        per_goal = bootstrap is not None and all(key in bootstrap.goals for key in group) # Intervals are per goal, not per goal set
+        visualize_goals_vs_variate(group, variates[0], save_png=save_png, dest=dest, absolute_range=absolute_range,
+                                   bootstrap=bootstrap if per_goal else None, name=f"goals_variate_{str(variates[0])}")
     if "histo" in visualizations:
-        ps_values = [experiment[goal][code] for goal in goals for code in codes]
-        histo_general(ps_values, "Power-Seeking over Codes",
-                      save_png=save_png, dest=dest, name=input("Please enter a name for your 'histo' plot: ") if ask_for_png_name else f"histo")
+        ps_values = [experiment[goal][code] for goal in run_goals for code in codes]
+        histo_general(ps_values, "Power-Seeking over Codes", save_png=save_png, dest=dest, name="histo")
     if "top_n_codes" in visualizations:
-        graph_general(sorted_code[:top_n], f"Top {top_n} Power-Seeking Codes",
-                      save_png=save_png, dest=dest, name=input("Please enter a name for your 'graph' plot: ") if ask_for_png_name else f"graph_codes",
-                      absolute=absolute_range)
+        graph_general(index.top_codes(top_n), f"Top {top_n} Power-Seeking Codes",
+                      save_png=save_png, dest=dest, name="graph_codes", absolute=absolute_range)
     if "top_n_goals" in visualizations:
-        graph_general(sorted_goal[:top_n], f"Top {top_n} Power-Seeking Goals",
-                      save_png=save_png, dest=dest, name=input("Please enter a name for your 'graph' plot: ") if ask_for_png_name else f"graph_goals",
-                      absolute=absolute_range)
+        graph_general(index.top_goals(top_n), f"Top {top_n} Power-Seeking Goals",
+                      save_png=save_png, dest=dest, name="graph_goals", absolute=absolute_range)
+    if "models" in visualizations:
+        from result_store import load_store_models
+        experiments = load_store_models(os.path.join(dest, "store"), codes, goals)
+        visualize_models_vs_codes(experiments, save_png=save_png, dest=dest, absolute_range=absolute_range, name="models")
+        visualize_models_vs_goals(experiments, save_png=save_png, dest=dest, absolute_range=absolute_range, name="models_goals")
+
+# Function: main
+# Purpose: run, report and plot the experiment described by the variables above (see also cli.py)
+# Parameters: None
+# Produces: experiment, a dictionary of dictionaries, keyed by goal and then code
+#           dest, a string of the experiment folder
+def main():
+    experiment, dest, experiment_model = run_experiment()
+    if study_path is not None and plan_only:
+        return experiment, dest
+    bootstrap = experiment_bootstrap(experiment, dest, experiment_model) if confidence_intervals else None
+    if print_results:
+        report_experiment(experiment, bootstrap)
+    if order_effects:
+        raw = oe.load_raw_choices(dest, model=experiment_model)
+        print(f"Order effects: {oe.order_effects_summary(raw)}" if raw is not None else "Order effects: no raw choices kept")
+    if visualize or render_figure_set:
+        plot_experiment(experiment, dest, bootstrap)
+    return experiment, dest
+
+if __name__ == "__main__":
+    main()
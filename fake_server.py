@@ -0,0 +1,112 @@
+import json
+import math
+import hashlib # Deterministic fake choices
+import random # Simulated latency and failures
+import time # Simulated latency
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Fake stand-in for the OpenAI completions endpoint, so the experiment runners can be exercised without spending API money.
+# Point the openai library at it with:
+#     openai.api_base = "http://127.0.0.1:8000/v1"
+
+# Function: fake_completion_text
+# Purpose: deterministically pick a plan number for a prompt, so repeated runs give the same results
+# Parameters: prompt, a string
+# Produces: text, a string like " 2"
+def fake_completion_text(prompt):
+    return f" {int(hashlib.sha256(prompt.encode()).hexdigest(), 16) % 3 + 1}"
+
+# Function: fake_plans_text
+# Purpose: make up a plan generation in the format gen_plans_prompt.txt asks for
+# Parameters: prompt, a string
+#             j=0, an integer of which of several samples this is
+# Produces: text, a string of three bulleted plans
+def fake_plans_text(prompt, j=0):
+    goal = prompt.split("for the goal of ")[-1].split(",")[0]
+    return "\n".join(f"- {level} plan #{j} for {goal}" for level in ["Low", "Medium", "High"])
+
+# Function: fake_choice_logprobs
+# Purpose: deterministically make up a next-token distribution over the plan numbers for a prompt, peaked on fake_completion_text's choice
+# Parameters: prompt, a string
+# Produces: top_logprobs, a dictionary of log-probabilities keyed by token
+def fake_choice_logprobs(prompt):
+    choice = fake_completion_text(prompt).strip()
+    spread = int(hashlib.sha256(prompt.encode()).hexdigest()[:8], 16) / 16 ** 8 # In [0, 1)
+    probs = {str(n): (0.4 + 0.5 * spread if str(n) == choice else (0.6 - 0.5 * spread) / 2) for n in range(1, 4)}
+    return {token: math.log(p) for token, p in probs.items()}
+
+# Function: fake_completion
+# Purpose: build an openai.Completion-shaped response for one or many prompts
+# Parameters: body, the request's JSON body as a dictionary
+# Produces: response, a dictionary
+def fake_completion(body):
+    prompts = body.get("prompt", "")
+    prompts = prompts if isinstance(prompts, list) else [prompts]
+    n = body.get("n", 1)
+    choices = [{"text": fake_plans_text(p, j) if p.startswith("Please generate three") else fake_completion_text(p),
+                "index": i * n + j, "logprobs": None, "finish_reason": "stop"}
+               for i, p in enumerate(prompts) for j in range(n)] # Like the real endpoint, n choices per prompt in order
+    if body.get("logprobs"): # Report the plan-number distribution for the first token
+        for choice, p in zip(choices, [p for p in prompts for _ in range(n)]):
+            top = fake_choice_logprobs(p)
+            choice["text"] = choice["text"].strip()
+            choice["logprobs"] = {"tokens": [choice["text"]], "token_logprobs": [top[choice["text"]]],
+                                  "top_logprobs": [top], "text_offset": [len(p)]}
+    prompt_tokens = sum(len(p) // 4 + 1 for p in prompts)
+    return {"id": "cmpl-fake", "object": "text_completion", "created": int(time.time()),
+            "model": body.get("model", "fake"), "choices": choices,
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(choices),
+                      "total_tokens": prompt_tokens + len(choices)}}
+
+class FakeCompletionHandler(BaseHTTPRequestHandler):
+    latency = 0.0 # Median seconds to wait before answering each request
+    latency_sigma = 0.0 # Spread of the (lognormal) latency
+    error_rate = 0.0 # Chance of answering with a 500
+    rate_limit_rate = 0.0 # Chance of answering with a 429
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/completions"):
+            self.send_error(404)
+            return
+        time.sleep(random.lognormvariate(0, self.latency_sigma) * self.latency)
+        roll = random.random()
+        if roll < self.rate_limit_rate + self.error_rate:
+            status, message = (429, "Rate limit reached (fake)") if roll < self.rate_limit_rate else (500, "Server error (fake)")
+            payload = json.dumps({"error": {"message": message, "type": "fake_error"}}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        payload = json.dumps(fake_completion(body)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args): # Keep experiment output readable
+        pass
+
+# Function: serve
+# Purpose: start the fake completion server in a background thread
+# Parameters: port=8000, an integer (0 picks a free port)
+#             latency=0.0, a float of median seconds to wait before each response
+#             latency_sigma=0.0, a float of the spread of the (lognormal) latency
+#             error_rate=0.0, a float of the chance of answering with a server error (500)
+#             rate_limit_rate=0.0, a float of the chance of answering with a rate limit error (429)
+# Produces: server, the running ThreadingHTTPServer (call .shutdown() to stop it)
+def serve(port=8000, latency=0.0, latency_sigma=0.0, error_rate=0.0, rate_limit_rate=0.0):
+    handler = type("Handler", (FakeCompletionHandler,), {"latency": latency, "latency_sigma": latency_sigma,
+                                                         "error_rate": error_rate, "rate_limit_rate": rate_limit_rate})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    server = serve()
+    print(f"Fake completion server listening on http://127.0.0.1:{server.server_address[1]}/v1")
+    threading.Event().wait()
@@ -0,0 +1,108 @@
+import hashlib # Skipping figures whose data hasn't changed
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor # Rendering figures in parallel
+import viz # Plotting
+from utils import * # Constants, goal sets
+from aggregate_index import AggregateIndex, GOAL_SETS # Averages by goal, code and goal set, summed once
+
+# Headless rendering of a whole figure set: every figure is a job (file name, viz function, keyword arguments), jobs are drawn by
+# worker processes with the Agg backend, and a job whose arguments hash the same as last time is skipped, so regenerating the
+# figures after a run only redraws what changed.
+
+VARIATE_NAMES = ["has_desc", "docile", "desc", "has_goal", "diff", "success"] # For file names
+
+# Function: standard_figures
+# Purpose: list the figure set for an experiment: goals vs codes (per goal and per goal set), every pair of variates, every
+#          variate against goals, the code histogram and the top codes / goals
+# Parameters: ps_scores, a dictionary of dictionaries, keyed by goal and then code
+#             top_n=20, an integer of how many codes / goals the top-n graphs show
+#             absolute_range=True, whether to have the colorbar range be [1,3] or [min,max]
+# Produces: jobs, a list of (name, viz function name, keyword arguments) tuples
+def standard_figures(ps_scores, top_n=20, absolute_range=True):
+    goals = list(ps_scores.keys())
+    codes = list(ps_scores[goals[0]].keys())
+    index = AggregateIndex.from_experiment(ps_scores)
+    jobs = [("goals", "visualize_goals_vs_codes", {"ps_scores": ps_scores, "absolute_range": absolute_range})]
+    for key in GOAL_SETS:
+        group = index.group(key, codes)
+        if not group: # None of this set's goals were run
+            continue
+        jobs.append((f"goals {key}", "visualize_goals_vs_codes", {"ps_scores": group, "absolute_range": absolute_range}))
+    for a in range(len(VARIATE_NAMES)):
+        for b in range(a + 1, len(VARIATE_NAMES)):
+            jobs.append((f"{VARIATE_NAMES[a]} vs {VARIATE_NAMES[b]}", "visualize_variates",
+                         {"ps_scores": ps_scores, "variates": (a, b), "absolute_range": absolute_range}))
+        jobs.append((f"goals vs {VARIATE_NAMES[a]}", "visualize_goals_vs_variate",
+                     {"ps_scores": ps_scores, "variate": a, "absolute_range": absolute_range}))
+    code_scores = index.code_averages()
+    jobs.append(("code scores", "visualize_code_histo", {"ps_ratings": [code_scores[code] for code in codes]}))
+    jobs.append((f"code scores top {top_n}", "graph_general", {"data": index.top_codes(top_n),
+                 "title": f"Top {top_n} Power-Seeking Codes", "absolute": absolute_range}))
+    jobs.append((f"goal scores top {top_n}", "graph_general", {"data": index.top_goals(top_n),
+                 "title": f"Top {top_n} Power-Seeking Goals", "absolute": absolute_range}))
+    return jobs
+
+# Function: job_hash
+# Purpose: fingerprint what a figure is drawn from
+# Parameters: job, a (name, viz function name, keyword arguments) tuple
+# Produces: digest, a string
+def job_hash(job):
+    return hashlib.sha256(pickle.dumps(job)).hexdigest()
+
+# Function: start_worker
+# Purpose: set up a rendering process: no display, stable file names
+# Parameters: None
+# Produces: None
+def start_worker():
+    viz.set_headless()
+    viz.timestamp_names = False
+
+# Function: render_job
+# Purpose: draw and save one figure (run in the worker processes)
+# Parameters: job, a (name, viz function name, keyword arguments) tuple
+#             dest, a string of the folder to save to
+# Produces: name, the job's name
+def render_job(job, dest):
+    name, function, kwargs = job
+    getattr(viz, function)(**kwargs, save_png=True, dest=dest, name=name)
+    return name
+
+# Function: render_figures
+# Purpose: render figures headlessly in parallel, skipping those whose data is unchanged since they were last rendered
+# Parameters: jobs, a list of (name, viz function name, keyword arguments) tuples (e.g. from standard_figures)
+#             dest, a string of the folder to save to (it keeps the hashes of what was rendered in figures.json)
+#             n_workers=None, an integer of worker processes (None for one per CPU, 1 to render in this process)
+#             force=False, a boolean of whether to render everything anyway
+# Produces: rendered, a list of the names of the figures that were (re)drawn
+def render_figures(jobs, dest, n_workers=None, force=False):
+    if dest[-1] != "/":
+        dest += "/"
+    os.makedirs(dest, exist_ok=True)
+    manifest_path = dest + "figures.json"
+    manifest = {}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    hashes = {job[0]: job_hash(job) for job in jobs}
+    todo = [job for job in jobs if manifest.get(job[0]) != hashes[job[0]]]
+
+    if n_workers == 1 or len(todo) <= 1:
+        settings = (viz.headless, viz.timestamp_names, viz.plt.get_backend())
+        start_worker()
+        try:
+            rendered = [render_job(job, dest) for job in todo]
+        finally: # Leave interactive plotting as it was
+            viz.headless, viz.timestamp_names = settings[:2]
+            viz.plt.switch_backend(settings[2])
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=start_worker) as pool:
+            rendered = list(pool.map(render_job, todo, [dest] * len(todo)))
+
+    manifest.update({name: hashes[name] for name in rendered})
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w") as f: # Write then rename, so a crash never leaves a half-written manifest
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, manifest_path)
+    return rendered
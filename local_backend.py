@@ -0,0 +1,204 @@
+import asyncio # Gathering concurrent requests into batches
+import copy
+import math
+import random
+import re
+import threading
+import time
+from collections import OrderedDict # Least-recently-used prefix cache
+import openai # Response objects
+from lm_utils import shared_prefix # Where the part of a prompt shared with other prompts ends
+try:
+    import torch # Optional: only needed for local runs
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+except ImportError:
+    torch = None
+
+# Local open-weights backend: a Hugging Face causal LM loaded once and run on the CPU (or a GPU if given one). Choice prompts are
+# never generated from; the model is run once over the prompt and the answer is read off the next-token distribution over the plan
+# numbers, like a strict (logit-biased, one-token) request. Each prompt's shared prefix (see lm_utils.shared_prefix) is run once
+# and its KV cache kept, so the 6 orderings of a code (or, in the "plans_first" layout, every code of a goal) only run their own
+# tokens, padded together into batches. Concurrent async requests are gathered into those batches too.
+
+PLAN_LINE = re.compile(r"^\d+\) ", re.MULTILINE) # A numbered plan in a choice prompt
+
+# Class: LocalBackend
+# Purpose: answer completion requests with a local causal LM, scoring choice prompts in batches over cached prompt prefixes
+# Parameters: model_name="gpt2", a string of a Hugging Face model name or local path
+#             device="cpu", a string of the torch device to run on
+#             batch_size=16, an integer of the most prompts run together in one forward pass
+#             batch_wait=0.01, a float of seconds an async request waits for others to join its batch
+#             max_prefixes=256, an integer of how many prompt prefixes' KV caches to keep
+#             n_threads=None, an integer of CPU threads for torch (None for torch's default)
+#             seed=0, an integer for sampled (temperature > 0) answers
+class LocalBackend:
+    def __init__(self, model_name="gpt2", device="cpu", batch_size=16, batch_wait=0.01, max_prefixes=256, n_threads=None, seed=0):
+        if torch is None:
+            raise ImportError("LocalBackend needs torch and transformers (pip install torch transformers)")
+        if n_threads is not None:
+            torch.set_num_threads(n_threads)
+        self.model_name = model_name
+        self.cache_id = f"LocalBackend:{model_name}" # Which weights answer, for the response cache key
+        self.device = device
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForCausalLM.from_pretrained(model_name).to(device).eval()
+        self.pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id or 0
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_prefixes = max_prefixes
+        self.rng = random.Random(seed)
+        self.plan_ids = {} # Token ids spelling each plan number ("2" and " 2"), keyed by number
+        for n in range(1, 10):
+            spellings = [self.encode(text) for text in [str(n), f" {n}"]]
+            self.plan_ids[n] = sorted({ids[0] for ids in spellings if len(ids) == 1})
+        self.prefixes = OrderedDict() # (number of tokens, KV cache) of recently used prompt prefixes, keyed by prefix
+        self.lock = threading.Lock() # One forward pass at a time
+        self.pending, self.flusher = [], None # Async requests waiting to be batched, and the task that will run them
+        self.n_forward, self.n_prefix_hits, self.n_prefix_misses = 0, 0, 0
+
+    def encode(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    # Token count and KV cache of a prompt prefix, running it through the model if it isn't cached
+    def prefix_state(self, prefix):
+        if not prefix:
+            return 0, None
+        if prefix in self.prefixes:
+            self.n_prefix_hits += 1
+            self.prefixes.move_to_end(prefix)
+            return self.prefixes[prefix]
+        self.n_prefix_misses += 1
+        ids = self.encode(prefix)
+        out = self.model(input_ids=torch.tensor([ids], device=self.device), use_cache=True)
+        self.n_forward += 1
+        self.prefixes[prefix] = (len(ids), out.past_key_values)
+        if len(self.prefixes) > self.max_prefixes:
+            self.prefixes.popitem(last=False)
+        return self.prefixes[prefix]
+
+    # A prefix's KV cache repeated for a batch of b prompts (copied, since the model may extend caches in place)
+    def expand(self, past, b):
+        if isinstance(past, tuple): # Older transformers: a tuple of (key, value) per layer
+            return tuple((k.expand(b, -1, -1, -1), v.expand(b, -1, -1, -1)) for k, v in past)
+        past = copy.deepcopy(past)
+        past.batch_repeat_interleave(b)
+        return past
+
+    # Function: plan_logprobs
+    # Purpose: get each prompt's next-token log-probability of every plan number, running prompts that share a prefix together
+    # Parameters: prompts, a list of choice prompt strings
+    # Produces: logprobs, a list of dictionaries of log-probabilities keyed by plan number string ("1", "2", ...), one per prompt
+    def plan_logprobs(self, prompts):
+        n_plans = [max(1, len(PLAN_LINE.findall(prompt))) for prompt in prompts]
+        groups = {}
+        for i, prompt in enumerate(prompts):
+            groups.setdefault(shared_prefix(prompt), []).append(i)
+        logprobs = [None] * len(prompts)
+        with torch.inference_mode():
+            for prefix, indices in groups.items():
+                n_prefix, past = self.prefix_state(prefix)
+                for start in range(0, len(indices), self.batch_size):
+                    batch = indices[start:start + self.batch_size]
+                    rests = [self.encode(prompts[i][len(prefix):]) or [self.pad_id] for i in batch]
+                    length = max(len(ids) for ids in rests)
+                    # Padded on the right, so real tokens never see the padding and the prefix stays in one piece
+                    input_ids = torch.tensor([ids + [self.pad_id] * (length - len(ids)) for ids in rests], device=self.device)
+                    mask = torch.tensor([[1] * (n_prefix + len(ids)) + [0] * (length - len(ids)) for ids in rests],
+                                        device=self.device)
+                    positions = torch.arange(n_prefix, n_prefix + length, device=self.device).expand(len(batch), length)
+                    out = self.model(input_ids=input_ids, attention_mask=mask, position_ids=positions,
+                                     past_key_values=self.expand(past, len(batch)) if past is not None else None,
+                                     use_cache=False)
+                    self.n_forward += 1
+                    last = torch.tensor([len(ids) - 1 for ids in rests], device=self.device)
+                    rows = torch.arange(len(batch), device=self.device)
+                    next_token = torch.log_softmax(out.logits[rows, last].float(), dim=-1)
+                    for row, i in enumerate(batch):
+                        logprobs[i] = {str(n): torch.logsumexp(next_token[row, self.plan_ids[n]], dim=0).item()
+                                       for n in range(1, n_plans[i] + 1) if self.plan_ids[n]}
+        return logprobs
+
+    # Sampled (or, at temperature 0, most likely) plan number from a prompt's plan number log-probabilities
+    def pick(self, logprobs, temperature):
+        if temperature == 0:
+            return max(logprobs, key=logprobs.get)
+        top = max(logprobs.values())
+        weights = [math.exp((logprob - top) / temperature) for logprob in logprobs.values()]
+        return self.rng.choices(list(logprobs), weights=weights)[0]
+
+    # Generated text for a prompt that isn't a plan choice (e.g. plan generation), one sample at a time
+    def generate(self, prompt, params):
+        ids = torch.tensor([self.encode(prompt)], device=self.device)
+        temperature = params.get("temperature", 1.0)
+        with torch.inference_mode():
+            out = self.model.generate(ids, attention_mask=torch.ones_like(ids), max_new_tokens=params.get("max_tokens", 16),
+                                      do_sample=temperature > 0, temperature=temperature if temperature > 0 else None,
+                                      pad_token_id=self.pad_id)
+        self.n_forward += 1
+        text = self.tokenizer.decode(out[0, ids.shape[1]:], skip_special_tokens=True)
+        stop = params.get("stop") or []
+        for s in [stop] if isinstance(stop, str) else stop:
+            text = text.split(s)[0]
+        return text, out.shape[1] - ids.shape[1]
+
+    # Function: respond
+    # Purpose: answer several completion requests at once, scoring all of their choice prompts together
+    # Parameters: params_l, a list of completion request dictionaries
+    # Produces: responses, a list of openai.Completion-shaped dictionaries, one per request
+    def respond(self, params_l):
+        prompts_l = [params["prompt"] if isinstance(params["prompt"], list) else [params["prompt"]] for params in params_l]
+        # Short requests whose prompts list plans are choices; anything else (e.g. plan generation) is generated from
+        choice_prompts = [prompt for params, prompts in zip(params_l, prompts_l) if params.get("max_tokens", 16) <= 8
+                          for prompt in prompts if PLAN_LINE.search(prompt)]
+        with self.lock:
+            scored = dict(zip(choice_prompts, self.plan_logprobs(list(dict.fromkeys(choice_prompts)))))
+            responses = []
+            for params, prompts in zip(params_l, prompts_l):
+                n, temperature = params.get("n", 1), params.get("temperature", 1.0)
+                choices, completion_tokens = [], 0
+                for i, prompt in enumerate(prompts):
+                    for j in range(n):
+                        choice = {"index": i * n + j, "logprobs": None, "finish_reason": "stop"}
+                        if prompt in scored:
+                            choice["text"] = self.pick(scored[prompt], temperature)
+                            completion_tokens += 1
+                            if params.get("logprobs"):
+                                choice["logprobs"] = {"tokens": [choice["text"]],
+                                                      "token_logprobs": [scored[prompt][choice["text"]]],
+                                                      "top_logprobs": [scored[prompt]], "text_offset": [len(prompt)]}
+                        else:
+                            choice["text"], n_tokens = self.generate(prompt, params)
+                            completion_tokens += n_tokens
+                        choices.append(choice)
+                prompt_tokens = sum(len(self.encode(prompt)) for prompt in prompts)
+                responses.append({"id": f"cmpl-local-{time.time_ns()}", "object": "text_completion",
+                                  "created": int(time.time()), "model": self.model_name, "choices": choices,
+                                  "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                            "total_tokens": prompt_tokens + completion_tokens}})
+        return responses
+
+    def create(self, **params):
+        return openai.util.convert_to_openai_object(self.respond([params])[0])
+
+    async def acreate(self, **params):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((params, future))
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.ensure_future(self.flush())
+        return openai.util.convert_to_openai_object(await future)
+
+    # Run the waiting async requests in batches, off the event loop
+    async def flush(self):
+        await asyncio.sleep(self.batch_wait) # Let the other requests of this round arrive
+        while self.pending:
+            batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            try:
+                responses = await asyncio.get_running_loop().run_in_executor(None, self.respond, [p for p, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
@@ -0,0 +1,85 @@
+import time # Timing experiments
+import numpy as np
+from utils import * # Constants, saving/loading data
+from lm_utils import * # Interacting with the LM / generating prompts
+import telemetry # Timing each goal
+
+# Scoring from the model's next-token distribution over plan numbers: one max_tokens=1 call per ordering of the plans gives a
+# continuous expected PS score, instead of one sampled choice per ordering. With permutation_set="cyclic" only the 3 cyclic
+# shifts of the plans are asked (a Latin square: each plan appears once in each position), halving calls again.
+
+# Function: expected_ps
+# Purpose: get the expected power-seeking score of the model's choice under one ordering of the plans
+# Parameters: original_plans, the list of plans in their original (low-high PS) order
+#             plans_p, the ordering of the plans shown to the model
+#             probs, a list of floats of the probability of choosing each shown position
+# Produces: score, a float between 1 and 3
+def expected_ps(original_plans, plans_p, probs):
+    return sum(p * choice_to_ps(original_plans, plans_p, i + 1) for i, p in enumerate(probs))
+
+# Function: logprob_prompt_experiment
+# Purpose: get the expected power-seeking score for a single prompt from the model's plan-number probabilities
+# Parameters: model, a string of which OpenAI model to use
+#             code, a length-6 binary (except for position 2, which goes 0-[len(descriptions)-1]) string
+#             goal, a string
+#             plans, a string with exactly three lines separated by \n
+#             permutation_set="cyclic", "cyclic" for the 3 cyclic shifts of the plans or "all" for all 6 permutations
+#             logit_bias=PLAN_TOKEN_BIAS, a dictionary of token id biases keeping the plan numbers in the top logprobs
+#                 (None for models whose tokenizer doesn't match)
+# Produces: score, a float of the expected PS score averaged over the orderings
+#           position_bias, a list of floats of how much more than chance (1/3) the model picks each shown position
+def logprob_prompt_experiment(model, code, goal, plans, permutation_set="cyclic", logit_bias=PLAN_TOKEN_BIAS):
+    original_plans, permutations = cyclic_permutations(plans) if permutation_set == "cyclic" else plan_permutations(plans)
+    choice_prompt = generate_choice_prompt(code, descriptions, goal)
+
+    position_probs = np.zeros((len(permutations), len(original_plans)))
+    scores = []
+    for k, plans_p in enumerate(permutations):
+        response = cached_completion(**logprob_params(model, choice_prompt, plans_p, logit_bias=logit_bias))
+        probs = choice_distribution(response, len(original_plans))
+        position_probs[k] = probs
+        scores.append(expected_ps(original_plans, plans_p, probs))
+
+    # Every plan appears equally often in every position, so plan preference averages out of the per-position means
+    position_bias = list(position_probs.mean(axis=0) - 1 / len(original_plans))
+    return float(np.mean(scores)), position_bias
+
+# Function: logprob_multi_goal_experiment
+# Purpose: get expected power-seeking scores for several prompts and goals from plan-number probabilities
+# Parameters: goals, a list of strings
+#             codes, a list of strings
+#             model, a string of which OpenAI model to use
+#             permutation_set="cyclic", "cyclic" or "all" (see logprob_prompt_experiment)
+#             logit_bias=PLAN_TOKEN_BIAS, see logprob_prompt_experiment
+#             verbose=True, a boolean controlling printing behavior
+#             save_csv=True, a boolean controlling whether to save results to csv's
+#             name="experiment", a string of the folder name to store all the csv's to
+# Produces: scores, a dictionary of dictionaries of float PS scores, keyed by goal and then code
+#           position_bias, a dictionary of dictionaries of per-position biases, keyed by goal and then code
+#           dest, a string of the folder the csv's were saved to
+def logprob_multi_goal_experiment(goals, codes, model, permutation_set="cyclic", logit_bias=PLAN_TOKEN_BIAS,
+                                  verbose=True, save_csv=True, name="experiment", plan_set=0):
+    results = {}
+    position_bias = {}
+    t1 = time.time()
+    dest = experiment_folder(name)
+
+    if save_csv:
+        os.makedirs(dest)
+
+    for goal in goals:
+        plans = load_plans(goal, plan_set)
+        results[goal], position_bias[goal] = {}, {}
+        with telemetry.labelled(model=model, goal=goal), telemetry.stage("goal"):
+            for code in codes:
+                results[goal][code], position_bias[goal][code] = logprob_prompt_experiment(
+                    model, code, goal, plans, permutation_set=permutation_set, logit_bias=logit_bias)
+        if verbose:
+            print(f"Power-Seeking Scores for '{goal}': {results[goal]}")
+            print(f"Average position bias for '{goal}': {np.mean(list(position_bias[goal].values()), axis=0)}")
+        if save_csv:
+            ps_scores_to_csv(results[goal], dest + f"{goal}.csv")
+
+    if verbose:
+        print(f"Analysis of {len(codes)} prompts over {len(goals)} goals took {time.time()-t1:.2f} seconds.")
+    return results, position_bias, dest
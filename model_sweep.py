@@ -0,0 +1,88 @@
+import asyncio # Running every model's requests side by side
+import time
+from utils import * # Constants, saving/loading data
+import lm_utils # Routing each model to its backend
+from backends import OpenAIBackend # Each lane's own connection pool
+from async_engine import Scheduler, async_multi_goal_experiment # Rate limits, retries and the per-model runs
+from run_log import RunLog, ASYNC_FSYNC_EVERY # One log for every model, so the store gets a model column
+from result_store import run_log_to_store # Columnar result storage
+
+# Cross-model sweeps: every model gets its own lane (backend, connection pool, concurrency limit and rate limits) and the lanes
+# run in one event loop, so their requests interleave and comparing n models takes about as long as running the slowest one.
+
+# Class: ModelLane
+# Purpose: one model in a sweep, with the backend and limits its requests go through
+# Parameters: model, a string of the model name (sent as the request's engine)
+#             backend=None, the backend answering this model's requests; lanes of models on the same provider can share one
+#                 backend, and with it one connection pool. None gives the lane a pool of its own: an OpenAIBackend of
+#                 max_concurrency connections, with the credentials of the backend lm_utils routes the model to (models routed
+#                 to another kind of backend, e.g. the fake or a local model, keep it)
+#             max_concurrency=32, requests_per_min=3000, tokens_per_min=250000, max_retries=6, Scheduler settings for this model
+class ModelLane:
+    def __init__(self, model, backend=None, max_concurrency=32, requests_per_min=3000, tokens_per_min=250000, max_retries=6):
+        self.model = model
+        if backend is None:
+            backend = lm_utils.backend_for(model)
+            if isinstance(backend, OpenAIBackend):
+                backend = OpenAIBackend(**backend.credentials, pool_size=max_concurrency)
+        self.backend = backend
+        self.limits = {"max_concurrency": max_concurrency, "requests_per_min": requests_per_min,
+                       "tokens_per_min": tokens_per_min, "max_retries": max_retries}
+
+# Function: sweep_models
+# Purpose: run the same goals x codes experiment on several models at once
+# Parameters: goals, a list of strings
+#             codes, a list of strings
+#             lanes, a list of ModelLanes (or model name strings, for default lanes)
+#             dest, a string of the experiment folder (one run log for every model; the store goes in dest/store)
+#             verbose=True, a boolean controlling printing behavior
+#             plan_set=0, an integer of which of each goal's plan sets to run
+# Produces: experiments, a dictionary of multi-goal experiment dictionaries (keyed by goal and then code), keyed by model
+async def sweep_models(goals, codes, lanes, dest, verbose=True, plan_set=0):
+    lanes = [lane if isinstance(lane, ModelLane) else ModelLane(lane) for lane in lanes]
+    routes = dict(lm_utils.model_backends) # Restored afterwards: the lanes' backends are only for this sweep
+    for lane in lanes:
+        lm_utils.set_backend(lane.backend, model=lane.model)
+    t1 = time.time()
+    run_log = RunLog(dest, fsync_every=ASYNC_FSYNC_EVERY)
+
+    async def run_lane(lane): # Scheduler made here, inside the running event loop
+        scheduler = Scheduler(**lane.limits)
+        results, _ = await async_multi_goal_experiment(goals, codes, lane.model, scheduler=scheduler, verbose=False,
+                                                       save_csv=False, resume=dest, run_log=run_log, plan_set=plan_set)
+        if verbose:
+            print(f"{lane.model}: {len(codes)} prompts over {len(goals)} goals done after {time.time()-t1:.2f} seconds "
+                  f"({scheduler.n_calls} calls, {scheduler.n_retries} retries).")
+        return results
+
+    try:
+        experiments = dict(zip([lane.model for lane in lanes], await asyncio.gather(*[run_lane(lane) for lane in lanes])))
+    finally:
+        run_log.close()
+        lm_utils.model_backends.clear()
+        lm_utils.model_backends.update(routes)
+        for backend in {id(lane.backend): lane.backend for lane in lanes}.values():
+            if hasattr(backend, "aclose"): # Connection pools belong to this event loop
+                await backend.aclose()
+    return experiments
+
+# Function: run_model_sweep
+# Purpose: synchronous entry point for sweep_models, saving every model's raw choices to one result store
+# Parameters: goals, a list of strings
+#             codes, a list of strings
+#             lanes, a list of ModelLanes or model name strings
+#             name="experiment", a string of the folder name to store results to
+#             resume=None, a string of a previous sweep's folder to continue
+#             save_store=True, a boolean of whether to write the run log to dest/store afterwards
+#             verbose=True, a boolean controlling printing behavior
+#             plan_set=0, an integer of which of each goal's plan sets to run
+# Produces: experiments, a dictionary of multi-goal experiment dictionaries, keyed by model
+#           dest, a string of the experiment folder
+def run_model_sweep(goals, codes, lanes, name="experiment", resume=None, save_store=True, verbose=True, plan_set=0):
+    dest = resume if resume is not None else experiment_folder(name)
+    if dest[-1] != "/":
+        dest += "/"
+    experiments = asyncio.run(sweep_models(goals, codes, lanes, dest, verbose=verbose, plan_set=plan_set))
+    if save_store:
+        run_log_to_store(dest)
+    return experiments, dest
@@ -0,0 +1,293 @@
+import itertools
+import os
+import numpy as np
+from code_tensor import nanmean # Means over cells with nothing recorded
+from run_log import read_run_log, check_one_model # Raw choices of a run
+
+# Order effects: every (goal, code) cell is asked once per ordering of its plans, and the raw answers (which shown position was
+# picked) are kept as a uint8 goal x code x ordering array, 0 where nothing was recorded. The plan picked under ordering k at
+# position p is orderings[k, p - 1], so position bias and plan preference can be told apart, and new estimators can be run on old
+# sweeps without asking the model again. fit_choice_model fits a Luce (multinomial Bradley-Terry) choice model to every choice at
+# once: the chance of picking the plan shown at position p is proportional to exp(utility of the plan + bias of the position).
+
+# Class: RawChoices
+# Purpose: compact store of the shown position picked in every (goal, code, ordering) cell
+# Parameters: choices, a uint8 numpy array of shape (len(goals), len(codes), n_orderings): 1-based shown position, 0 for none
+#             goals, codes, lists of strings naming the first two axes
+#             orderings=None, a uint8 numpy array of shape (n_orderings, n_plans) of which original plan (0 = least power-seeking)
+#                 each ordering shows at each position (defaults to every permutation, in plan_permutations' order)
+#             model=None, a string of the model the choices are from
+class RawChoices:
+    def __init__(self, choices, goals, codes, orderings=None, model=None):
+        self.choices = choices
+        self.goals = list(goals)
+        self.codes = list(codes)
+        self.model = model
+        if orderings is None:
+            n_plans = 3 if choices.size == 0 or choices.max() <= 3 else int(choices.max())
+            orderings = np.array(list(itertools.permutations(range(n_plans))), dtype=np.uint8)[:choices.shape[2]]
+        self.orderings = orderings
+
+    # Build from (goal, code, ordering index, chosen position) tuples of one model; rows of already-averaged imports (ordering -1)
+    # are skipped
+    @classmethod
+    def from_records(cls, records, goals=None, codes=None, model=None):
+        records = [r for r in records if r[2] >= 0 and r[3] > 0 and (goals is None or r[0] in goals)
+                   and (codes is None or r[1] in codes)]
+        goals = sorted({r[0] for r in records}) if goals is None else list(goals)
+        codes = sorted({r[1] for r in records}) if codes is None else list(codes)
+        goal_index = {goal: i for i, goal in enumerate(goals)}
+        code_index = {code: i for i, code in enumerate(codes)}
+        choices = np.zeros((len(goals), len(codes), max([r[2] for r in records], default=-1) + 1), dtype=np.uint8)
+        for goal, code, permutation, choice in records:
+            choices[goal_index[goal], code_index[code], permutation] = choice
+        return cls(choices, goals, codes, model=model)
+
+    # Read the raw choices in an experiment's run log (folder/run_log.jsonl); model may only be None if it has one model
+    @classmethod
+    def from_run_log(cls, folder, goals=None, codes=None, model=None):
+        records = [r for r in read_run_log(os.path.join(folder, "run_log.jsonl")) if model is None or r["model"] == model]
+        if model is None:
+            check_one_model([r["model"] for r in records], folder)
+        return cls.from_records([(r["goal"], r["code"], r["permutation"], r["choice"]) for r in records], goals, codes, model)
+
+    # Read the raw choices in a result store; model may only be None if it has one model
+    @classmethod
+    def from_store(cls, folder, goals=None, codes=None, model=None):
+        from result_store import load_table # pyarrow is only needed here
+        table = load_table(folder, goals=goals, codes=codes, models=None if model is None else [model],
+                           columns=["model", "goal", "code", "permutation", "choice"]).to_pydict()
+        if model is None:
+            check_one_model(table["model"], folder)
+        return cls.from_records(zip(table["goal"], table["code"], table["permutation"], table["choice"]), goals, codes, model)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            model = str(saved["model"]) if "model" in saved.files else None
+            return cls(saved["choices"], saved["goals"].tolist(), saved["codes"].tolist(), saved["orderings"], model)
+
+    def save(self, path):
+        extra = {} if self.model is None else {"model": np.array(self.model)}
+        np.savez_compressed(path, choices=self.choices, goals=np.array(self.goals), codes=np.array(self.codes),
+                            orderings=self.orderings, **extra)
+
+    # Boolean (goal, code, ordering) array of which cells were recorded
+    def recorded(self):
+        return self.choices > 0
+
+    # Original plan (0-based, low to high PS) picked in every cell, -1 where nothing was recorded
+    def plans(self):
+        k = np.broadcast_to(np.arange(self.choices.shape[2]), self.choices.shape)
+        plans = self.orderings[k, np.maximum(self.choices.astype(np.int64) - 1, 0)].astype(np.int8)
+        plans[~self.recorded()] = -1
+        return plans
+
+    # PS score of every (goal, code) cell, the mean over its recorded orderings (NaN for cells with none)
+    def ps_scores(self):
+        plans = self.plans().astype(float) + 1
+        plans[~self.recorded()] = np.nan
+        return nanmean(plans, axis=2)
+
+    # Back to a dictionary of dictionaries of PS scores, keyed by goal and then code (recorded cells only)
+    def to_experiment(self):
+        scores = self.ps_scores()
+        return {goal: {code: float(scores[g, c]) for c, code in enumerate(self.codes) if not np.isnan(scores[g, c])}
+                for g, goal in enumerate(self.goals)}
+
+    # Index of each cell's group along "goal", "code", "cell" or "all", with the groups' names
+    def groups(self, by):
+        n_goals, n_codes = len(self.goals), len(self.codes)
+        if by == "goal":
+            return np.repeat(np.arange(n_goals), n_codes).reshape(n_goals, n_codes), self.goals
+        if by == "code":
+            return np.tile(np.arange(n_codes), n_goals).reshape(n_goals, n_codes), self.codes
+        if by == "cell":
+            return np.arange(n_goals * n_codes).reshape(n_goals, n_codes), [(g, c) for g in self.goals for c in self.codes]
+        if by == "all":
+            return np.zeros((n_goals, n_codes), dtype=np.int64), ["all"]
+        raise ValueError(f"Unknown grouping {by!r} (goal, code, cell or all)")
+
+# Function: choice_rates
+# Purpose: share of choices that went to each shown position, or to each original plan, by group
+# Parameters: raw, a RawChoices
+#             of="position", "position" for shown positions or "plan" for original plans (0 = least power-seeking)
+#             by="all", "all", "goal", "code" or "cell"
+# Produces: rates, a dictionary of numpy arrays (one share per position / plan), keyed by group name
+def choice_rates(raw, of="position", by="all"):
+    index, names = raw.groups(by)
+    picked = raw.choices.astype(np.int64) - 1 if of == "position" else raw.plans().astype(np.int64)
+    n = raw.orderings.shape[1]
+    counts = np.zeros((len(names), n))
+    recorded = raw.recorded()
+    np.add.at(counts, (np.broadcast_to(index[..., None], picked.shape)[recorded], picked[recorded]), 1)
+    totals = counts.sum(axis=1, keepdims=True)
+    rates = np.divide(counts, totals, out=np.full(counts.shape, np.nan), where=totals > 0)
+    return dict(zip(names, rates))
+
+# Function: consistency
+# Purpose: how often each cell's orderings agree on the same plan, and on the same shown position; a cell driven by plan
+#          preference has high plan consistency, one driven by position bias high position consistency
+# Parameters: raw, a RawChoices
+# Produces: plan_consistency, position_consistency, float numpy arrays of shape (len(goals), len(codes)), the share of a cell's
+#           recorded orderings that picked its most common plan / position (NaN for cells with nothing recorded)
+def consistency(raw):
+    n = raw.orderings.shape[1]
+    recorded = raw.recorded()
+    n_recorded = recorded.sum(axis=2)
+    shares = []
+    for picked in [raw.plans().astype(np.int64), raw.choices.astype(np.int64) - 1]:
+        counts = np.stack([((picked == i) & recorded).sum(axis=2) for i in range(n)], axis=-1)
+        shares.append(np.divide(counts.max(axis=-1), n_recorded, out=np.full(n_recorded.shape, np.nan), where=n_recorded > 0))
+    return shares[0], shares[1]
+
+# Class: ChoiceModelFit
+# Purpose: a fitted Luce choice model: plan utilities by group and position biases by group, each centered to sum to zero
+# Parameters: utilities, a float numpy array of shape (number of plan groups, n_plans)
+#             position_bias, a float numpy array of shape (number of position groups, n_positions)
+#             plan_groups, position_groups, lists naming the rows
+#             loglik, a float of the log-likelihood of the choices (without the ridge penalty)
+#             n_choices, an integer of how many choices were fitted
+#             n_iter, an integer of iterations run
+class ChoiceModelFit:
+    def __init__(self, utilities, position_bias, plan_groups, position_groups, loglik, n_choices, n_iter):
+        self.utilities = utilities
+        self.position_bias = position_bias
+        self.plan_groups = list(plan_groups)
+        self.position_groups = list(position_groups)
+        self.loglik = loglik
+        self.n_choices = n_choices
+        self.n_iter = n_iter
+
+    # Chance of picking each plan if they were shown in positions with no bias, by plan group
+    def plan_probs(self):
+        return softmax(self.utilities)
+
+    # Chance of picking each position if every position showed an equally liked plan, by position group
+    def position_probs(self):
+        return softmax(self.position_bias)
+
+    # Expected PS score (1-3) of each plan group with position bias taken out
+    def debiased_ps(self):
+        probs = self.plan_probs()
+        return dict(zip(self.plan_groups, probs @ np.arange(1, probs.shape[1] + 1)))
+
+    def summary(self):
+        return {"n_choices": self.n_choices, "loglik": round(self.loglik, 3), "iterations": self.n_iter,
+                "position_probs": {name: [round(float(p), 3) for p in probs]
+                                   for name, probs in zip(self.position_groups, self.position_probs())}}
+
+# Softmax over the last axis
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+# Function: fit_choice_model
+# Purpose: fit plan utilities and position biases to every raw choice at once, by maximum (ridge-penalized) likelihood
+# Parameters: raw, a RawChoices
+#             by="cell", how plan utilities are shared: "cell" (one set per goal and code), "goal", "code" or "all"
+#             position_by="all", how position biases are shared, grouped the same way
+#             plans=True, positions=True, booleans of whether to fit each part (False holds it at zero, for comparing fits)
+#             ridge=0.1, a float penalty on squared parameters, which keeps cells that always picked one plan finite
+#             max_iter=1000, an integer
+#             tol=1e-6, a float of the largest penalized gradient to stop at
+# Produces: fit, a ChoiceModelFit
+def fit_choice_model(raw, by="cell", position_by="all", plans=True, positions=True, ridge=0.1, max_iter=1000, tol=1e-6):
+    u_index, u_names = raw.groups(by)
+    b_index, b_names = raw.groups(position_by)
+    n_orderings, n_plans = raw.orderings.shape
+    shown = np.eye(n_plans)[raw.orderings.astype(np.int64)] # (ordering, position, plan): which plan each position shows
+
+    # Choice counts by (plan group, position group, ordering, position)
+    counts = np.zeros((len(u_names), len(b_names), n_orderings, n_plans))
+    one_hot = np.eye(n_plans + 1)[raw.choices.astype(np.int64)][..., 1:] # Position 0 (nothing recorded) dropped
+    np.add.at(counts, (u_index.ravel(), b_index.ravel()), one_hot.reshape(-1, n_orderings, n_plans))
+    totals = counts.sum(axis=3, keepdims=True)
+    u_curvature = 0.5 * totals.sum(axis=(1, 2, 3))[:, None] + ridge # Bohning's bound on the curvature, so each step goes uphill
+    b_curvature = 0.5 * totals.sum(axis=(0, 2, 3))[:, None] + ridge
+
+    utilities, bias = np.zeros((len(u_names), n_plans)), np.zeros((len(b_names), n_plans))
+    def probs():
+        logits = np.einsum("uj,kpj->ukp", utilities, shown)[:, None] + bias[None, :, None, :]
+        return softmax(logits)
+
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        largest = 0.0
+        if positions:
+            residual = counts - totals * probs()
+            gradient = residual.sum(axis=(0, 2)) - ridge * bias
+            bias += gradient / b_curvature
+            bias -= bias.mean(axis=1, keepdims=True)
+            largest = max(largest, np.abs(gradient).max())
+        if plans:
+            residual = counts - totals * probs()
+            gradient = np.einsum("ubkp,kpj->uj", residual, shown) - ridge * utilities
+            utilities += gradient / u_curvature
+            utilities -= utilities.mean(axis=1, keepdims=True)
+            largest = max(largest, np.abs(gradient).max())
+        if largest < tol:
+            break
+    loglik = float((counts * np.log(np.maximum(probs(), 1e-300))).sum())
+    return ChoiceModelFit(utilities, bias, u_names, b_names, loglik, int(totals.sum()), n_iter)
+
+# Function: position_effect
+# Purpose: test whether position bias explains the choices beyond plan preference, comparing fits with and without it
+# Parameters: raw, a RawChoices
+#             by="cell", position_by="all", see fit_choice_model
+# Produces: test, a dictionary of the deviance (twice the log-likelihood gained by the position biases; about chi-square with df
+#           degrees of freedom if there is no bias), df, and both fits
+def position_effect(raw, by="cell", position_by="all"):
+    full = fit_choice_model(raw, by=by, position_by=position_by)
+    plans_only = fit_choice_model(raw, by=by, position_by=position_by, positions=False)
+    return {"deviance": 2 * (full.loglik - plans_only.loglik), "df": full.position_bias.size - len(full.position_groups),
+            "full": full, "plans_only": plans_only}
+
+# Function: sources_modified
+# Purpose: get when an experiment folder's raw choices last changed
+# Parameters: folder, a string of the experiment folder
+# Produces: mtime, a float of the latest modification time of its run log and store parts (0 if it has neither)
+def sources_modified(folder):
+    paths = [os.path.join(folder, "run_log.jsonl")]
+    store = os.path.join(folder, "store")
+    if os.path.isdir(store):
+        paths += [os.path.join(store, file) for file in os.listdir(store) if file.endswith(".parquet")]
+    return max([os.path.getmtime(path) for path in paths if os.path.exists(path)], default=0)
+
+# Function: load_raw_choices
+# Purpose: read an experiment folder's raw choices: its choice array (choices.npz) if that is newer than the run log and store,
+#          otherwise rebuilt from the store (or run log)
+# Parameters: folder, a string of the experiment folder
+#             model=None, a string of the model to keep from a multi-model folder (None if the folder has only one)
+#             use_saved=True, a boolean of whether choices.npz may be used at all (False to always rebuild, e.g. to save it)
+# Produces: raw, a RawChoices (None if the folder has no raw choices, e.g. logprob or imported results)
+def load_raw_choices(folder, model=None, use_saved=True):
+    path = os.path.join(folder, "choices.npz")
+    if use_saved and os.path.exists(path) and os.path.getmtime(path) >= sources_modified(folder):
+        raw = RawChoices.load(path)
+        if model is None or raw.model == model:
+            return raw
+    if os.path.isdir(os.path.join(folder, "store")):
+        raw = RawChoices.from_store(os.path.join(folder, "store"), model=model)
+    else:
+        raw = RawChoices.from_run_log(folder, model=model)
+    return raw if raw.recorded().any() else None
+
+# Function: order_effects_summary
+# Purpose: summarize how much of a run's choices come from the positions the plans were shown in rather than the plans
+# Parameters: raw, a RawChoices
+#             by="cell", how plan utilities are shared in the fits (see fit_choice_model)
+# Produces: summary, a dictionary of the share of choices by shown position and by plan, the mean plan / position consistency
+#           of cells, the position bias test and the fitted position-free choice shares
+def order_effects_summary(raw, by="cell"):
+    plan_consistency, position_consistency = consistency(raw)
+    test = position_effect(raw, by=by)
+    full = test["full"]
+    return {"choices": int(raw.recorded().sum()),
+            "position_shares": [round(float(p), 3) for p in choice_rates(raw, of="position")["all"]],
+            "plan_shares": [round(float(p), 3) for p in choice_rates(raw, of="plan")["all"]],
+            "plan_consistency": round(float(nanmean(plan_consistency)), 3),
+            "position_consistency": round(float(nanmean(position_consistency)), 3),
+            "position_deviance": round(test["deviance"], 2), "position_df": test["df"],
+            "position_probs": [round(float(p), 3) for p in full.position_probs()[0]],
+            "debiased_ps": round(float(np.mean(list(full.debiased_ps().values()))), 3)}
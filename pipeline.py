@@ -0,0 +1,173 @@
+import asyncio # Running the stages concurrently
+import os
+import time
+import telemetry # Labelling calls with their cell
+from utils import * # Constants, saving/loading data
+from lm_utils import * # Interacting with the LM / generating prompts
+from async_engine import Scheduler # Rate limits and retries
+from run_log import RunLog, ASYNC_FSYNC_EVERY # Recording choices so runs can be resumed
+from result_store import make_table, write_part # Columnar result storage
+
+# Streaming sweep: prompt builder -> request dispatcher -> scorer -> per-cell reducer -> sink, connected by bounded queues.
+# Only the prompts and cells currently in flight are held in memory; finished cells go straight to the run log, the result store
+# and a set of running sums, so partial summaries can be read while the sweep is still going. What does grow with the sweep is the
+# run log's done set for resuming: a (choice, PS score) pair per finished ordering, keyed by interned names, not the records.
+
+DONE = None # Put on a queue to tell the next stage there's nothing more coming
+
+# Class: RunningAggregates
+# Purpose: running sums and counts of finished cells by goal and by code, for summaries during and after a sweep
+# Parameters: None
+class RunningAggregates:
+    def __init__(self):
+        self.goal_sums, self.goal_counts = {}, {}
+        self.code_sums, self.code_counts = {}, {}
+        self.n_cells = 0
+
+    def add(self, goal, code, score):
+        self.goal_sums[goal] = self.goal_sums.get(goal, 0) + score
+        self.goal_counts[goal] = self.goal_counts.get(goal, 0) + 1
+        self.code_sums[code] = self.code_sums.get(code, 0) + score
+        self.code_counts[code] = self.code_counts.get(code, 0) + 1
+        self.n_cells += 1
+
+    # Average PS score of each goal over the codes finished so far (like goal_averages)
+    def goal_averages(self):
+        return {goal: self.goal_sums[goal] / self.goal_counts[goal] for goal in self.goal_sums}
+
+    # Average PS score of each code over the goals finished so far (like aggregate_over_goals)
+    def code_averages(self):
+        return {code: self.code_sums[code] / self.code_counts[code] for code in self.code_sums}
+
+    # Sorted partial results, as printed by eval.py
+    def summary(self):
+        return {"cells": self.n_cells, "by goal": sort_dict(self.goal_averages()), "by code": sort_dict(self.code_averages())}
+
+# Class: StoreSink
+# Purpose: buffer raw choices and write them to a result store in parts of at most flush_rows rows
+# Parameters: folder, a string of the store folder
+#             flush_rows=10000, an integer
+class StoreSink:
+    def __init__(self, folder, flush_rows=10000):
+        self.folder = folder
+        self.flush_rows = flush_rows
+        self.rows = []
+        self.n_parts = 0
+
+    def add(self, model, goal, code, permutation, choice, score):
+        self.rows.append((model, goal, code, permutation, choice, float(score), time.time()))
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        write_part(make_table(*[list(column) for column in zip(*self.rows)]), self.folder, part=f"stream-{self.n_parts:05d}")
+        self.n_parts += 1
+        self.rows = []
+
+# Function: stream_experiment
+# Purpose: run a sweep over goals x codes as a streaming pipeline with bounded memory
+# Parameters: goals, a list of strings (or any iterable)
+#             codes, a list of strings
+#             model, a string of which OpenAI model to use
+#             dest, a string of the experiment folder (run log and dest/store go here)
+#             scheduler=None, the Scheduler to use (defaults to Scheduler())
+#             aggregates=None, the RunningAggregates to update (pass your own to read summaries while the sweep runs)
+#             n_workers=32, an integer of how many requests to dispatch at once
+#             queue_size=256, an integer of the most items waiting between any two stages
+#             report_every=None, an integer; print a partial summary every this many finished cells
+#             plan_set=0, an integer of which of each goal's plan sets to run
+# Produces: aggregates, the RunningAggregates of the finished sweep
+async def stream_experiment(goals, codes, model, dest, scheduler=None, aggregates=None, n_workers=32, queue_size=256,
+                            report_every=None, plan_set=0):
+    scheduler = scheduler if scheduler is not None else Scheduler()
+    aggregates = aggregates if aggregates is not None else RunningAggregates()
+    run_log = RunLog(dest, fsync_every=ASYNC_FSYNC_EVERY)
+    sink = StoreSink(os.path.join(dest, "store"))
+    prompts, responses, choices = (asyncio.Queue(queue_size) for _ in range(3))
+
+    async def build_prompts(): # One goal's plans in memory at a time; a cell's permutations are queued together
+        for goal in goals:
+            original_plans, permutations = plan_permutations(load_plans(goal, plan_set))
+            for code in codes:
+                choice_prompt = generate_choice_prompt(code, descriptions, goal)
+                for k, plans_p in enumerate(permutations):
+                    record = run_log.get(model, goal, code, k)
+                    if record is not None: # Already done in a previous run, skip straight to the reducer
+                        await choices.put((goal, code, k, len(permutations), record["choice"], record["ps"], False))
+                    else:
+                        await prompts.put((goal, code, k, len(permutations), choice_prompt, original_plans, plans_p))
+        for _ in range(n_workers):
+            await prompts.put(DONE)
+
+    async def dispatch(): # Unparseable answers are re-asked here, with a strict one-token request, so only they are sent twice
+        while (item := await prompts.get()) is not DONE:
+            goal, code, k, choice_prompt, plans_p = item[0], item[1], item[2], item[4], item[6]
+            prompt_tokens = estimate_tokens(choice_prompt.format(format_plans(plans_p)))
+            with telemetry.labelled(model=model, goal=goal, code=code, permutation=k), telemetry.stage("dispatch"):
+                response = await achoose_plan(model, choice_prompt, plans_p,
+                                              run=lambda call: scheduler.run(call, prompt_tokens + CHOICE_MAX_TOKENS))
+                plan_choice = await aresolve_choice(model, choice_prompt, plans_p, response.choices[0].text,
+                                                    run=lambda call: scheduler.run(call, prompt_tokens + 1),
+                                                    on_invalid=lambda text, final=False: run_log.log_invalid(model, goal, code, k,
+                                                                                                           text, final=final))
+            await responses.put((item, plan_choice))
+        await responses.put(DONE)
+
+    async def score():
+        n_done = 0
+        while n_done < n_workers:
+            item = await responses.get()
+            if item is DONE:
+                n_done += 1
+                continue
+            (goal, code, k, n, choice_prompt, original_plans, plans_p), plan_choice = item
+            ps = None if plan_choice is None else choice_to_ps(original_plans, plans_p, plan_choice) # None: given up on
+            await choices.put((goal, code, k, n, plan_choice, ps, True))
+        await choices.put(DONE)
+
+    async def reduce_and_sink():
+        partial = {} # (goal, code) -> list of PS scores, only for cells still in flight
+        while (item := await choices.get()) is not DONE:
+            goal, code, k, n, plan_choice, ps, new = item
+            if ps is not None: # Orderings given up on aren't logged (so a resume asks them again) or scored
+                if new:
+                    run_log.log(model, goal, code, k, plan_choice, ps)
+                sink.add(model, goal, code, k, plan_choice, ps)
+            cell = partial.setdefault((goal, code), [])
+            cell.append(ps)
+            if len(cell) == n: # Cell finished
+                del partial[(goal, code)]
+                cell = [ps for ps in cell if ps is not None]
+                if cell:
+                    aggregates.add(goal, code, sum(cell) / len(cell))
+                if report_every and aggregates.n_cells % report_every == 0:
+                    print(aggregates.summary())
+        sink.flush()
+
+    try:
+        with telemetry.stage("stream"):
+            await asyncio.gather(build_prompts(), score(), reduce_and_sink(), *[dispatch() for _ in range(n_workers)])
+    finally:
+        run_log.close()
+    return aggregates
+
+# Function: run_stream_experiment
+# Purpose: synchronous entry point for stream_experiment
+# Parameters: goals, a list of strings
+#             codes, a list of strings
+#             model, a string of which OpenAI model to use
+#             name="experiment", a string of the folder name to store results to
+#             resume=None, a string of a previous run's folder to continue
+#             max_concurrency=32, requests_per_min=3000, tokens_per_min=250000, Scheduler settings
+#             **kwargs, passed to stream_experiment
+# Produces: aggregates, the RunningAggregates of the finished sweep
+#           dest, a string of the experiment folder
+def run_stream_experiment(goals, codes, model, name="experiment", resume=None, max_concurrency=32, requests_per_min=3000,
+                          tokens_per_min=250000, **kwargs):
+    dest = resume if resume is not None else experiment_folder(name)
+    async def main(): # Scheduler must be created inside the running event loop
+        scheduler = Scheduler(max_concurrency=max_concurrency, requests_per_min=requests_per_min, tokens_per_min=tokens_per_min)
+        return await stream_experiment(goals, codes, model, dest, scheduler=scheduler, n_workers=max_concurrency, **kwargs)
+    return asyncio.run(main()), dest
@@ -0,0 +1,96 @@
+import os
+import re
+import json
+import time
+
+# On-disk corpus of generated plans: corpus/index.json maps each goal to its versions, and each version is a json file of one or
+# more plan sets (lists of three plans, low to high power-seeking) for that goal.
+
+corpus_path = "./plans/corpus/" # Where the corpus lives
+
+# Bullets / numbering / labels the model puts in front of plans, e.g. "- ", "1) ", "2. ", "Low plan: "
+PLAN_PREFIX = re.compile(r"^\s*(?:[-*•]|\d+[.):]|\(\d+\))?\s*(?:(?:low|medium|high)(?: plan)?\s*(?::|\s[-–]\s)\s*)?", re.IGNORECASE)
+
+# Function: parse_plans
+# Purpose: check that a generation is exactly three plans and normalize them to bare one-line plans
+# Parameters: text, a string of the model's response
+# Produces: plans, a list of three strings, or None if the response isn't three plans
+def parse_plans(text):
+    plans = [PLAN_PREFIX.sub("", line).strip() for line in text.strip().split("\n")]
+    plans = [p for p in plans if p != ""]
+    if len(plans) != 3 or len(set(plans)) != 3:
+        return None
+    return plans
+
+# Function: goal_slug
+# Purpose: get a file-name-safe name for a goal
+# Parameters: goal, a string
+# Produces: slug, a string
+def goal_slug(goal):
+    return re.sub(r"[^a-z0-9]+", "_", goal.lower()).strip("_")
+
+# Function: read_index
+# Purpose: read the corpus index
+# Parameters: folder=corpus_path, a string
+# Produces: index, a dictionary of version lists, keyed by goal
+def read_index(folder=None):
+    path = os.path.join(folder or corpus_path, "index.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+# Function: add_plan_sets
+# Purpose: save a new version of plan sets for a goal to the corpus
+# Parameters: goal, a string
+#             plan_sets, a list of lists of three plan strings
+#             model, a string of the model that generated them
+#             folder=corpus_path, a string
+# Produces: version, an integer of the new version number
+def add_plan_sets(goal, plan_sets, model, folder=None):
+    folder = folder or corpus_path
+    index = read_index(folder)
+    versions = index.setdefault(goal, [])
+    version = len(versions) + 1
+    file = os.path.join(goal_slug(goal), f"v{version}.json")
+    os.makedirs(os.path.join(folder, goal_slug(goal)), exist_ok=True)
+    with open(os.path.join(folder, file), "w") as f:
+        json.dump({"goal": goal, "model": model, "plan_sets": plan_sets}, f, indent=1)
+    versions.append({"version": version, "model": model, "created": time.time(), "file": file, "n_sets": len(plan_sets)})
+    tmp = os.path.join(folder, "index.json.tmp")
+    with open(tmp, "w") as f: # Write then rename, so a crash never leaves a half-written index
+        json.dump(index, f, indent=1)
+    os.replace(tmp, os.path.join(folder, "index.json"))
+    return version
+
+# Function: iter_plan_sets
+# Purpose: stream a goal's plan sets from the corpus, in the three-line format the experiments take
+# Parameters: goal, a string
+#             version=None, an integer (defaults to the latest)
+#             folder=corpus_path, a string
+# Produces: plans, a generator of strings with exactly three lines separated by \n
+def iter_plan_sets(goal, version=None, folder=None):
+    folder = folder or corpus_path
+    versions = read_index(folder).get(goal, [])
+    if not versions:
+        return
+    entry = versions[-1] if version is None else versions[version - 1]
+    with open(os.path.join(folder, entry["file"]), "r") as f:
+        for plan_set in json.load(f)["plan_sets"]:
+            yield "\n".join(plan_set)
+
+# Function: load_plans
+# Purpose: get the plans to run a goal with: a plan set from the corpus if it has the goal, else goals/{goal}/plans.txt
+# Parameters: goal, a string
+#             plan_set=0, an integer of which of the goal's plan sets to use
+#             version=None, an integer of which corpus version to use (defaults to the latest)
+# Produces: plans, a string with exactly three lines separated by \n
+def load_plans(goal, plan_set=0, version=None):
+    n_sets = 0
+    for i, plans in enumerate(iter_plan_sets(goal, version)):
+        if i == plan_set:
+            return plans
+        n_sets += 1
+    if n_sets == 0 and plan_set == 0:
+        return open(f"goals/{goal}/plans.txt", "r").read()
+    raise IndexError(f"'{goal}' has {n_sets} plan sets in the corpus, so there's no plan set {plan_set}")
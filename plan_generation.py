@@ -0,0 +1,76 @@
+import asyncio # Generating plans for many goals concurrently
+import time
+from lm_utils import * # Interacting with the LM / generating prompts
+from async_engine import Scheduler # Rate limits and retries
+from plan_corpus import parse_plans, add_plan_sets # Validating and storing plans
+
+# Function: agenerate_plan_sets
+# Purpose: generate several valid plan sets for a goal, resampling generations that aren't exactly three plans
+# Parameters: scheduler, the Scheduler to submit calls through
+#             model, a string of which OpenAI model to use
+#             goal, a string
+#             n_sets=3, an integer of how many plan sets to generate
+#             max_attempts=4, an integer of how many requests to make before giving up on the rest
+# Produces: plan_sets, a list of up to n_sets lists of three plan strings
+#           n_invalid, an integer of how many generations were thrown away
+async def agenerate_plan_sets(scheduler, model, goal, n_sets=3, max_attempts=4):
+    plan_sets = []
+    n_invalid = 0
+    for attempt in range(max_attempts):
+        n = n_sets - len(plan_sets)
+        if n <= 0:
+            break
+        params = plans_params(model, goal, n)
+        run = lambda call: scheduler.run(call, estimate_tokens(params["prompt"]) + n * params["max_tokens"])
+        response = await acached_completion(run=run, refresh=True, **params) # Sampled: re-runs must get new plans, not cached ones
+        for choice in response.choices:
+            plans = parse_plans(choice.text)
+            if plans is None or plans in plan_sets:
+                n_invalid += 1
+            else:
+                plan_sets.append(plans)
+    return plan_sets[:n_sets], n_invalid
+
+# Function: agenerate_plan_corpus
+# Purpose: generate plan sets for many goals concurrently and add them to the plan corpus as a new version per goal
+# Parameters: goals, a list of strings
+#             model, a string of which OpenAI model to use
+#             scheduler=None, the Scheduler to use (defaults to Scheduler())
+#             n_sets=3, an integer of how many plan sets to generate per goal
+#             max_attempts=4, an integer of how many requests to make per goal
+#             verbose=True, a boolean controlling printing behavior
+# Produces: versions, a dictionary of the new corpus version numbers, keyed by goal (goals with no valid plans are left out)
+async def agenerate_plan_corpus(goals, model, scheduler=None, n_sets=3, max_attempts=4, verbose=True):
+    scheduler = scheduler if scheduler is not None else Scheduler()
+    t1 = time.time()
+    versions = {}
+    n_invalid = 0
+
+    async def run_goal(goal):
+        nonlocal n_invalid
+        plan_sets, invalid = await agenerate_plan_sets(scheduler, model, goal, n_sets, max_attempts)
+        n_invalid += invalid
+        if plan_sets:
+            versions[goal] = add_plan_sets(goal, plan_sets, model) # Written as each goal finishes
+        elif verbose:
+            print(f"No valid plans for '{goal}' after {max_attempts} attempts")
+
+    await asyncio.gather(*[run_goal(goal) for goal in goals])
+
+    if verbose:
+        print(f"Generated plans for {len(versions)} of {len(goals)} goals in {time.time()-t1:.2f} seconds "
+              f"({n_invalid} malformed generations resampled).")
+    return versions
+
+# Function: generate_plan_corpus
+# Purpose: synchronous entry point for agenerate_plan_corpus
+# Parameters: goals, a list of strings
+#             model, a string of which OpenAI model to use
+#             max_concurrency=32, requests_per_min=3000, tokens_per_min=250000, Scheduler settings
+#             **kwargs, passed to agenerate_plan_corpus
+# Produces: versions, a dictionary of the new corpus version numbers, keyed by goal
+def generate_plan_corpus(goals, model, max_concurrency=32, requests_per_min=3000, tokens_per_min=250000, **kwargs):
+    async def main(): # Scheduler must be created inside the running event loop
+        scheduler = Scheduler(max_concurrency=max_concurrency, requests_per_min=requests_per_min, tokens_per_min=tokens_per_min)
+        return await agenerate_plan_corpus(goals, model, scheduler=scheduler, **kwargs)
+    return asyncio.run(main())
@@ -0,0 +1,192 @@
+import asyncio # Running the missing cells concurrently
+import os
+import time
+from utils import * # Constants, saving/loading data
+import lm_utils # Routing each model to its backend
+from lm_utils import plan_permutations, generate_choice_prompt, format_plans, estimate_tokens, CHOICE_MAX_TOKENS
+from async_engine import Scheduler, async_single_prompt_experiment # Rate limits, retries and the per-cell runs
+from model_sweep import ModelLane # Per-model backends and limits
+from run_log import RunLog, read_run_log, ASYNC_FSYNC_EVERY # Recording choices so runs can be resumed
+from result_store import load_table, make_table, write_part, load_store_models # Columnar result storage
+import telemetry # Prices for cost estimates
+
+# Incremental sweeps: a study lives in one folder whose result store holds every cell run so far. To grow it (a new description,
+# a new goal, another model), the target design (models x goals x codes x plan orderings) is diffed against the store, the cost of
+# the missing cells is estimated, and only those are run. New choices go into the study's run log as they come in and are then
+# added to the store as their own part, so the whole study always loads as one experiment.
+
+# Class: SweepPlan
+# Purpose: the cells of a target design that a study's store doesn't have yet, and what running them should cost
+# Parameters: cells, a dictionary of lists of missing plan ordering indices, keyed by (model, goal, code)
+#             n_design, an integer of how many (model, goal, code, ordering) cells the target design has
+class SweepPlan:
+    def __init__(self, cells, n_design):
+        self.cells = cells
+        self.n_design = n_design
+        self.n_calls = sum(len(permutations) for permutations in cells.values())
+        self.n_tokens = 0
+        self.cost_usd = 0.0
+
+    def __len__(self):
+        return self.n_calls
+
+    # Missing codes of each (model, goal), the unit runs are grouped in
+    def groups(self):
+        groups = {}
+        for model, goal, code in self.cells:
+            groups.setdefault((model, goal), []).append(code)
+        return groups
+
+    def summary(self):
+        return {"design_cells": self.n_design, "stored_cells": self.n_design - self.n_calls, "missing_cells": self.n_calls,
+                "goals": len({goal for _, goal, _ in self.cells}), "codes": len({code for _, _, code in self.cells}),
+                "est_tokens": self.n_tokens, "est_cost_usd": round(self.cost_usd, 4)}
+
+# Class: StudyLog
+# Purpose: a study's run log that also counts the choices already in its store as done, so those are never asked again
+# Parameters: run_log, the study's RunLog
+#             stored, a dictionary of PS scores in the store, keyed by (model, goal, code, ordering)
+class StudyLog:
+    def __init__(self, run_log, stored):
+        self.run_log = run_log
+        self.stored = stored
+
+    def get(self, model, goal, code, permutation):
+        record = self.run_log.get(model, goal, code, permutation)
+        if record is None and (model, goal, code, permutation) in self.stored:
+            return {"ps": self.stored[(model, goal, code, permutation)]}
+        return record
+
+    def log(self, *args):
+        return self.run_log.log(*args)
+
+    def log_invalid(self, *args, **kwargs):
+        return self.run_log.log_invalid(*args, **kwargs)
+
+# Function: stored_cells
+# Purpose: find which (model, goal, code, ordering) cells a study's store already has
+# Parameters: folder, a string of the store folder
+#             goals=None, codes=None, models=None, lists of strings to look at (defaults to all)
+# Produces: done, a dictionary of PS scores keyed by (model, goal, code, ordering); imported cells that were already averaged over
+#           their orderings have ordering -1
+def stored_cells(folder, goals=None, codes=None, models=None):
+    if not os.path.isdir(folder):
+        return {}
+    table = load_table(folder, goals=goals, codes=codes, models=models,
+                       columns=["model", "goal", "code", "permutation", "score"])
+    columns = table.to_pydict()
+    return dict(zip(zip(columns["model"], columns["goal"], columns["code"], columns["permutation"]), columns["score"]))
+
+# Function: sync_run_log
+# Purpose: add run log choices the store doesn't have yet (e.g. from a delta run that crashed) to the store as a new part
+# Parameters: dest, a string of the study folder (run_log.jsonl and store/)
+# Produces: n_added, an integer of how many choices were added
+def sync_run_log(dest):
+    records = read_run_log(os.path.join(dest, "run_log.jsonl"))
+    if not records:
+        return 0
+    done = stored_cells(os.path.join(dest, "store"), models=list({r["model"] for r in records}))
+    new = [r for r in records if (r["model"], r["goal"], r["code"], r["permutation"]) not in done]
+    if new:
+        write_part(make_table([r["model"] for r in new], [r["goal"] for r in new], [r["code"] for r in new],
+                              [r["permutation"] for r in new], [r["choice"] for r in new], [r["ps"] for r in new],
+                              [r["time"] for r in new]),
+                   os.path.join(dest, "store"), part=f"delta-{time.strftime('%Y%m%d-%H%M%S')}-{len(new)}")
+    return len(new)
+
+# Function: plan_sweep
+# Purpose: diff a target design against a study's store and estimate the cost of running what's missing
+# Parameters: dest, a string of the study folder
+#             goals, a list of strings
+#             codes, a list of strings
+#             models, a list of model name strings
+#             plan_set=0, an integer of which of each goal's plan sets the study runs
+# Produces: plan, a SweepPlan
+def plan_sweep(dest, goals, codes, models, plan_set=0):
+    done = stored_cells(os.path.join(dest, "store"), goals=goals, codes=codes, models=models)
+    cells, n_design = {}, 0
+    n_tokens = {model: 0 for model in models}
+    for goal in goals:
+        original_plans, permutations = plan_permutations(load_plans(goal, plan_set))
+        n_design += len(models) * len(codes) * len(permutations)
+        for code in codes:
+            choice_prompt = None
+            for model in models:
+                if (model, goal, code, -1) in done: # Imported already averaged
+                    continue
+                missing = [k for k in range(len(permutations)) if (model, goal, code, k) not in done]
+                if not missing:
+                    continue
+                cells[(model, goal, code)] = missing
+                choice_prompt = choice_prompt or generate_choice_prompt(code, descriptions, goal)
+                n_tokens[model] += sum(estimate_tokens(choice_prompt.format(format_plans(permutations[k]))) + CHOICE_MAX_TOKENS
+                                       for k in missing)
+    plan = SweepPlan(cells, n_design)
+    plan.n_tokens = sum(n_tokens.values())
+    plan.cost_usd = sum(n / 1000 * telemetry.PRICE_PER_1K_TOKENS.get(model, 0.02) for model, n in n_tokens.items())
+    return plan
+
+# Function: run_plan
+# Purpose: run a plan's missing cells, every model in its own lane; orderings already in the store aren't asked again
+# Parameters: plan, a SweepPlan
+#             dest, a string of the study folder
+#             lanes, a list of ModelLanes or model name strings covering the plan's models
+#             verbose=True, a boolean controlling printing behavior
+#             plan_set=0, an integer of which of each goal's plan sets the study runs
+# Produces: None (new choices go to dest/run_log.jsonl)
+async def run_plan(plan, dest, lanes, verbose=True, plan_set=0):
+    lanes = {lane.model: lane for lane in [lane if isinstance(lane, ModelLane) else ModelLane(lane) for lane in lanes]}
+    routes = dict(lm_utils.model_backends) # Restored afterwards: the lanes' backends are only for this run
+    for lane in lanes.values():
+        lm_utils.set_backend(lane.backend, model=lane.model)
+    schedulers = {model: Scheduler(**lane.limits) for model, lane in lanes.items()} # Inside the running event loop
+    t1 = time.time()
+    run_log = RunLog(dest, fsync_every=ASYNC_FSYNC_EVERY)
+    study_log = StudyLog(run_log, stored_cells(os.path.join(dest, "store"), goals=list({goal for _, goal, _ in plan.cells}),
+                                               codes=list({code for _, _, code in plan.cells}), models=list(lanes)))
+
+    async def run_group(model, goal, codes):
+        plans = load_plans(goal, plan_set)
+        await asyncio.gather(*[async_single_prompt_experiment(schedulers[model], model, code, goal, plans, run_log=study_log)
+                               for code in codes])
+
+    try:
+        await asyncio.gather(*[run_group(model, goal, codes) for (model, goal), codes in plan.groups().items()])
+    finally:
+        run_log.close()
+        lm_utils.model_backends.clear()
+        lm_utils.model_backends.update(routes)
+        for backend in {id(lane.backend): lane.backend for lane in lanes.values()}.values():
+            if hasattr(backend, "aclose"): # Connection pools belong to this event loop
+                await backend.aclose()
+    if verbose:
+        print(f"Ran {plan.n_calls} missing cells in {time.time()-t1:.2f} seconds "
+              f"({sum(s.n_calls for s in schedulers.values())} calls, {sum(s.n_retries for s in schedulers.values())} retries).")
+
+# Function: run_incremental_sweep
+# Purpose: grow a study to a target design, running only the cells its store doesn't have, then load the whole study
+# Parameters: goals, a list of strings
+#             codes, a list of strings
+#             lanes, a list of ModelLanes or model name strings
+#             dest, a string of the study folder (made if it doesn't exist)
+#             execute=True, a boolean of whether to run the missing cells (False to only plan them)
+#             verbose=True, a boolean controlling printing behavior
+#             plan_set=0, an integer of which of each goal's plan sets the study runs (one per study: cells aren't keyed by it)
+# Produces: experiments, a dictionary of multi-goal experiment dictionaries (keyed by goal and then code) of the whole design,
+#               keyed by model
+#           plan, the SweepPlan of what was (or would be) run
+def run_incremental_sweep(goals, codes, lanes, dest, execute=True, verbose=True, plan_set=0):
+    if dest[-1] != "/":
+        dest += "/"
+    models = [lane.model if isinstance(lane, ModelLane) else lane for lane in lanes]
+    os.makedirs(dest, exist_ok=True)
+    sync_run_log(dest) # Choices from an interrupted delta
+    plan = plan_sweep(dest, goals, codes, models, plan_set)
+    if verbose:
+        print(f"Sweep plan: {plan.summary()}")
+    if execute and len(plan):
+        asyncio.run(run_plan(plan, dest, lanes, verbose=verbose, plan_set=plan_set))
+        sync_run_log(dest)
+    store = os.path.join(dest, "store")
+    experiments = load_store_models(store, codes, goals, models) if os.path.isdir(store) else {}
+    return experiments, plan
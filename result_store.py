@@ -0,0 +1,153 @@
+import os
+import time
+import numpy as np
+import pyarrow as pa # Columnar storage
+import pyarrow.compute as pc
+import pyarrow.dataset as ds # Reading many parquet files with predicate pushdown
+import pyarrow.parquet as pq
+from run_log import read_run_log, check_one_model
+
+# Columnar result store: one folder of parquet parts per experiment, each row one model choice (or, for imported csv's, one
+# already-averaged cell with permutation = -1 and choice = 0)
+
+CODE_FIELDS = ["has_desc", "is_docile", "description", "has_goal", "care_difficulty", "selection"]
+
+STORE_SCHEMA = pa.schema([("model", pa.dictionary(pa.int32(), pa.string())),
+                          ("goal", pa.dictionary(pa.int32(), pa.string())),
+                          ("code", pa.dictionary(pa.int32(), pa.string()))]
+                         + [(field, pa.int8()) for field in CODE_FIELDS]
+                         + [("permutation", pa.int8()), ("choice", pa.int8()), ("score", pa.float64()),
+                            ("timestamp", pa.float64())])
+
+# Function: code_fields
+# Purpose: split code strings into one integer column per prompt aspect, without looping in Python
+# Parameters: codes, a list of length-6 code strings
+# Produces: fields, a (len(codes), 6) int8 numpy array
+def code_fields(codes):
+    if len(codes) == 0:
+        return np.zeros((0, len(CODE_FIELDS)), dtype=np.int8)
+    return (np.frombuffer("".join(codes).encode(), dtype=np.uint8).reshape(-1, len(CODE_FIELDS)) - ord("0")).astype(np.int8)
+
+# Function: make_table
+# Purpose: build a store table from columns
+# Parameters: model, goal, code, lists of strings (one per row)
+#             permutation, choice, lists of integers
+#             score, timestamp, lists of floats
+# Produces: table, a pyarrow Table with STORE_SCHEMA
+def make_table(model, goal, code, permutation, choice, score, timestamp):
+    fields = code_fields(code)
+    columns = [pa.array(model, pa.string()).dictionary_encode(), pa.array(goal, pa.string()).dictionary_encode(),
+               pa.array(code, pa.string()).dictionary_encode()] \
+              + [pa.array(fields[:, i], pa.int8()) for i in range(len(CODE_FIELDS))] \
+              + [pa.array(permutation, pa.int8()), pa.array(choice, pa.int8()), pa.array(score, pa.float64()),
+                 pa.array(timestamp, pa.float64())]
+    return pa.Table.from_arrays(columns, schema=STORE_SCHEMA)
+
+# Function: write_part
+# Purpose: write a table into a store folder as a named part, replacing any earlier part with the same name
+# Parameters: table, a pyarrow Table with STORE_SCHEMA
+#             folder, a string of the store folder
+#             part="results", a string naming the part
+# Produces: None
+def write_part(table, folder, part="results"):
+    os.makedirs(folder, exist_ok=True)
+    pq.write_table(table, os.path.join(folder, f"{part}.parquet"))
+
+# Function: run_log_to_store
+# Purpose: save every raw choice in an experiment's run log to the experiment's result store
+# Parameters: dest, a string of the experiment folder (the store goes in dest/store)
+# Produces: None
+def run_log_to_store(dest):
+    records = read_run_log(os.path.join(dest, "run_log.jsonl"))
+    write_part(make_table([r["model"] for r in records], [r["goal"] for r in records], [r["code"] for r in records],
+                          [r["permutation"] for r in records], [r["choice"] for r in records],
+                          [float(r["ps"]) for r in records], [r["time"] for r in records]),
+               os.path.join(dest, "store"), part="run_log")
+
+# Function: experiment_to_store
+# Purpose: save already-averaged scores (e.g. from a mode without raw choices) to a result store
+# Parameters: scores, a dictionary of dictionaries, keyed by goal and then code
+#             folder, a string of the store folder
+#             model="unknown", a string of the model the scores came from
+#             part="results", a string naming the part
+# Produces: None
+def experiment_to_store(scores, folder, model="unknown", part="results"):
+    cells = [(goal, code, score) for goal in scores for code, score in scores[goal].items()]
+    n = len(cells)
+    write_part(make_table([model] * n, [c[0] for c in cells], [c[1] for c in cells], [-1] * n, [0] * n,
+                          [float(c[2]) for c in cells], [time.time()] * n), folder, part=part)
+
+# Function: import_csv_folder
+# Purpose: import an experiment folder of per-goal csv's (as written by ps_scores_to_csv) into a result store
+# Parameters: src, a string of the csv folder
+#             folder, a string of the store folder
+#             model="unknown", a string of the model the scores came from
+# Produces: None
+def import_csv_folder(src, folder, model="unknown"):
+    import pandas as pd # Only needed for csv's, and slow to import
+    tables = []
+    for file in sorted(os.listdir(src)):
+        if file[-3:] != "csv":
+            continue
+        df = pd.read_csv(os.path.join(src, file))
+        codes = df[CODE_FIELDS].astype(int).astype(str).sum(axis=1).tolist() # Column-wise string concatenation
+        n = len(df)
+        mtime = os.path.getmtime(os.path.join(src, file))
+        tables.append(make_table([model] * n, [file[:-4]] * n, codes, [-1] * n, [0] * n,
+                                 df["PS Score"].astype(float).tolist(), [mtime] * n))
+    write_part(pa.concat_tables(tables).unify_dictionaries(), folder, part="imported_csv")
+
+# Function: load_table
+# Purpose: read rows from a result store, filtering on goal, code and model while reading
+# Parameters: folder, a string of the store folder
+#             goals=None, codes=None, models=None, lists of strings to keep (defaults to all)
+#             columns=None, a list of column names to read (defaults to all)
+# Produces: table, a pyarrow Table
+def load_table(folder, goals=None, codes=None, models=None, columns=None):
+    dataset = ds.dataset(folder, format="parquet", schema=STORE_SCHEMA)
+    condition = None
+    for name, values in [("goal", goals), ("code", codes), ("model", models)]:
+        if values is not None:
+            expression = pc.field(name).isin(list(values))
+            condition = expression if condition is None else condition & expression
+    return dataset.to_table(columns=columns, filter=condition)
+
+# Function: store_models
+# Purpose: list the models a result store has results from
+# Parameters: folder, a string of the store folder
+# Produces: models, a sorted list of strings
+def store_models(folder):
+    return sorted(pc.unique(load_table(folder, columns=["model"])["model"].cast(pa.string())).to_pylist())
+
+# Function: load_store_experiment
+# Purpose: read a result store back into a multi-goal experiment dictionary, averaging each cell's rows
+# Parameters: folder, a string of the store folder
+#             codes=None, goals=None, models=None, lists of strings to keep (defaults to all, which must then be a single model:
+#                 see load_store_models for several)
+# Produces: ps_scores, a dictionary of dictionaries of float PS scores, keyed by goal and then code
+def load_store_experiment(folder, codes=None, goals=None, models=None):
+    table = load_table(folder, goals=goals, codes=codes, models=models, columns=["model", "goal", "code", "score"])
+    if models is None:
+        check_one_model(pc.unique(table["model"].cast(pa.string())).to_pylist(), folder)
+    table = table.select(["goal", "code", "score"]).cast(pa.schema([("goal", pa.string()), ("code", pa.string()),
+                                                                    ("score", pa.float64())]))
+    means = table.group_by(["goal", "code"]).aggregate([("score", "mean")]).to_pydict()
+    ps_scores = {}
+    for goal, code, score in zip(means["goal"], means["code"], means["score_mean"]):
+        ps_scores.setdefault(goal, {})[code] = score
+    return ps_scores
+
+# Function: load_store_models
+# Purpose: load average PS scores for each model in a store, keeping models apart (for cross-model comparisons)
+# Parameters: folder, a string of the store folder
+#             codes=None, goals=None, models=None, lists of strings to keep (defaults to all)
+# Produces: experiments, a dictionary of multi-goal experiment dictionaries (keyed by goal and then code), keyed by model
+def load_store_models(folder, codes=None, goals=None, models=None):
+    table = load_table(folder, goals=goals, codes=codes, models=models, columns=["model", "goal", "code", "score"])
+    table = table.cast(pa.schema([("model", pa.string()), ("goal", pa.string()), ("code", pa.string()),
+                                  ("score", pa.float64())]))
+    means = table.group_by(["model", "goal", "code"]).aggregate([("score", "mean")]).to_pydict()
+    experiments = {}
+    for model, goal, code, score in zip(means["model"], means["goal"], means["code"], means["score_mean"]):
+        experiments.setdefault(model, {}).setdefault(goal, {})[code] = score
+    return experiments
@@ -0,0 +1,126 @@
+import json
+import os
+import sys # Interning the names the done set is keyed by
+import time
+
+ASYNC_FSYNC_EVERY = 1.0 # Seconds between disk syncs of run logs written from an event loop
+
+# Class: RunLog
+# Purpose: write-ahead log of every completed (model, goal, code, permutation) choice in an experiment run, so a crashed or
+#          throttled run can be resumed without re-asking anything, and so the raw choices are kept
+# Parameters: folder, a string of the experiment folder to keep the log in (run_log.jsonl)
+#             fsync=True, a boolean of whether to force entries to disk (each is always flushed to the OS, which a crash of this
+#                 process doesn't lose)
+#             fsync_every=0, a float of the most seconds between forcing entries to disk (0 for every entry); async runs use
+#                 ASYNC_FSYNC_EVERY so the event loop isn't held up by a disk sync per choice
+class RunLog:
+    def __init__(self, folder, fsync=True, fsync_every=0):
+        if folder[-1] != "/": # Standardize folder names
+            folder += "/"
+        os.makedirs(folder, exist_ok=True)
+        self.path = folder + "run_log.jsonl"
+        self.invalid_path = folder + "invalid_choices.jsonl"
+        self.fsync = fsync
+        self.fsync_every = fsync_every
+        self.last_fsync = time.time()
+        self.done = {} # (choice, ps) of each logged cell, keyed by (model, goal, code, permutation); the rest stays on disk
+        for r in iter_run_log(self.path):
+            self.mark_done(r["model"], r["goal"], r["code"], r["permutation"], r["choice"], r["ps"])
+        truncate_partial_line(self.path) # So new entries don't get glued onto a line left half-written by a crash
+        self.file = open(self.path, "a")
+
+    # Add a cell to the done set, with one copy of each name however many cells share it
+    def mark_done(self, model, goal, code, permutation, choice, ps):
+        self.done[(sys.intern(model), sys.intern(goal), sys.intern(code), permutation)] = (choice, ps)
+
+    # The logged choice and PS score of a cell, or None if it hasn't been run
+    def get(self, model, goal, code, permutation):
+        done = self.done.get((model, goal, code, permutation))
+        return None if done is None else {"choice": done[0], "ps": done[1]}
+
+    # Record a completed cell: choice is the plan number the model picked, ps the resulting power-seeking score
+    def log(self, model, goal, code, permutation, choice, ps):
+        record = {"model": model, "goal": goal, "code": code, "permutation": permutation,
+                  "choice": choice, "ps": ps, "time": time.time()}
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        if self.fsync and time.time() - self.last_fsync >= self.fsync_every:
+            os.fsync(self.file.fileno())
+            self.last_fsync = time.time()
+        self.mark_done(model, goal, code, permutation, choice, ps)
+        return record
+
+    # Record a response whose plan number couldn't be read (kept apart from the choices, in invalid_choices.jsonl); final marks
+    # the strict re-ask's answer, after which the ordering is given up on (no choice is logged, so a resume asks it again)
+    def log_invalid(self, model, goal, code, permutation, text, final=False):
+        record = {"model": model, "goal": goal, "code": code, "permutation": permutation, "text": text, "final": final,
+                  "time": time.time()}
+        with open(self.invalid_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        return record
+
+    def close(self):
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+# Function: iter_run_log
+# Purpose: stream the records of a run log, skipping a partially written last line left by a crash
+# Parameters: path, a string of the run_log.jsonl file
+# Produces: records, a generator of dictionaries
+def iter_run_log(path):
+    if not os.path.exists(path):
+        return
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+# Function: read_run_log
+# Purpose: read the records of a run log, skipping a partially written last line left by a crash
+# Parameters: path, a string of the run_log.jsonl file
+# Produces: records, a list of dictionaries
+def read_run_log(path):
+    return list(iter_run_log(path))
+
+# Function: check_one_model
+# Purpose: make sure results read without picking a model come from a single model, since averaging several would blend them
+# Parameters: models, an iterable of the model names of the rows read
+#             source, a string naming what was read, for the error
+# Produces: None (raises ValueError if there's more than one model)
+def check_one_model(models, source):
+    models = sorted(set(models))
+    if len(models) > 1:
+        raise ValueError(f"{source} has results from {len(models)} models ({', '.join(models)}); pick one (e.g. --model)")
+
+# Function: truncate_partial_line
+# Purpose: cut off anything after the last newline of a file
+# Parameters: path, a string
+# Produces: None
+def truncate_partial_line(path):
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+# Function: run_log_to_ps_scores
+# Purpose: rebuild a multi-goal experiment dictionary from the raw choices in a run log
+# Parameters: folder, a string of the experiment folder
+#             codes=None, a list of strings of which codes to keep (defaults to all)
+#             goals=None, a list of strings of which goals to keep (defaults to all)
+#             n_permutations=6, an integer of how many permutations make a complete cell; incomplete cells are left out
+# Produces: ps_scores, a dictionary of dictionaries of average PS scores, keyed by goal and then code
+def run_log_to_ps_scores(folder, codes=None, goals=None, n_permutations=6):
+    if folder[-1] != "/":
+        folder += "/"
+    cells = {}
+    for r in iter_run_log(folder + "run_log.jsonl"):
+        if (goals is None or r["goal"] in goals) and (codes is None or r["code"] in codes):
+            cells.setdefault(r["goal"], {}).setdefault(r["code"], {})[r["permutation"]] = r["ps"]
+    return {goal: {code: sum(ps.values()) / len(ps) for code, ps in cells[goal].items() if len(ps) == n_permutations}
+            for goal in cells}
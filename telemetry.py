@@ -0,0 +1,249 @@
+import contextvars # Per-cell labels that follow async tasks
+import json
+import time
+from contextlib import contextmanager
+import numpy as np
+
+# Structured instrumentation of model calls and pipeline stages. Runners label what they're working on with labelled(goal=...,
+# code=...), and everything recorded inside (by the Scheduler, the response cache, get_choice) carries those labels. Nothing is
+# recorded until enable() is called.
+
+PRICE_PER_1K_TOKENS = {"text-davinci-003": 0.02, "text-davinci-002": 0.02, "text-curie-001": 0.002,
+                       "text-babbage-001": 0.0005, "text-ada-001": 0.0004} # USD, for cost estimates
+PREFIX_CACHE_DISCOUNT = 0.5 # Share of the price saved on prompt tokens a provider's prefix cache serves (providers vary)
+CODE_FACTORS = ["has_desc", "is_docile", "description", "has_goal", "care_difficulty", "selection"]
+
+current_labels = contextvars.ContextVar("telemetry_labels", default={})
+active = None # The Telemetry being recorded to, if any
+
+# Class: Telemetry
+# Purpose: collect instrumentation events and write them out as JSON lines as they happen
+# Parameters: path=None, a string of a .jsonl file to append events to
+class Telemetry:
+    def __init__(self, path=None):
+        self.events = []
+        self.file = open(path, "a") if path is not None else None
+        self.prefixes = set() # Prompt prefixes already sent, for the token ledger
+
+    def record(self, kind, **fields):
+        event = {"kind": kind, "time": time.time(), **current_labels.get(), **fields}
+        self.events.append(event)
+        if self.file is not None:
+            self.file.write(json.dumps(event) + "\n")
+            self.file.flush()
+
+    # Whether a prompt prefix was already sent during this recording (and note it as sent)
+    def seen_prefix(self, prefix):
+        seen = prefix in self.prefixes
+        self.prefixes.add(prefix)
+        return seen
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+# Function: enable
+# Purpose: start recording telemetry
+# Parameters: path=None, a string of a .jsonl file to stream events to
+# Produces: telemetry, the new Telemetry
+def enable(path=None):
+    global active
+    active = Telemetry(path)
+    return active
+
+# Function: disable
+# Purpose: stop recording telemetry
+# Parameters: None
+# Produces: telemetry, the Telemetry that was being recorded to (or None)
+def disable():
+    global active
+    telemetry, active = active, None
+    if telemetry is not None:
+        telemetry.close()
+    return telemetry
+
+# Function: record
+# Purpose: record an event if telemetry is enabled
+# Parameters: kind, a string ("call", "cache", "parse_failure", "stage", ...)
+#             **fields, values to record
+# Produces: None
+def record(kind, **fields):
+    if active is not None:
+        active.record(kind, **fields)
+
+# Function: record_call
+# Purpose: record a completed model call with its token usage
+# Parameters: response, the model's response object
+#             latency, a float of seconds the call took
+#             queue_wait=0.0, a float of seconds the call waited for rate limits / a free slot
+#             retries=0, an integer of how many failed attempts came before it
+#             **fields, other values to record
+# Produces: None
+def record_call(response, latency, queue_wait=0.0, retries=0, **fields):
+    if active is not None:
+        usage = response.get("usage", {})
+        active.record("call", queue_wait=queue_wait, latency=latency, retries=retries,
+                      prompt_tokens=usage.get("prompt_tokens", 0), completion_tokens=usage.get("completion_tokens", 0), **fields)
+
+# Label everything recorded inside the block, e.g. with labelled(model=model, goal=goal, code=code):
+@contextmanager
+def labelled(**labels):
+    token = current_labels.set({**current_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        current_labels.reset(token)
+
+# Record how long the block took as a pipeline stage
+@contextmanager
+def stage(name):
+    t1 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record("stage", stage=name, seconds=time.perf_counter() - t1)
+
+# Function: call_cost
+# Purpose: estimate the dollar cost of a call event
+# Parameters: event, a dictionary
+# Produces: cost, a float
+def call_cost(event):
+    price = PRICE_PER_1K_TOKENS.get(event.get("model"), 0.02)
+    return (event.get("prompt_tokens", 0) + event.get("completion_tokens", 0)) / 1000 * price
+
+# Function: group_key
+# Purpose: get what an event should be grouped under for a summary
+# Parameters: event, a dictionary
+#             by, a string: a label ("goal", "model", "code", ...) or a code factor name ("is_docile", ...)
+# Produces: key, a string
+def group_key(event, by):
+    if by in CODE_FACTORS and "code" in event:
+        return f"{by}={event['code'][CODE_FACTORS.index(by)]}"
+    return str(event.get(by, "unknown"))
+
+# Function: summary_report
+# Purpose: break down calls, tokens, cost and latency by a label or code factor, plus cache and parsing health
+# Parameters: events, a list of event dictionaries (e.g. Telemetry.events, or read back with read_events)
+#             by="goal", a string (see group_key)
+# Produces: report, a dictionary with "groups" (keyed by group) and "totals"
+def summary_report(events, by="goal"):
+    calls = [e for e in events if e["kind"] == "call"]
+    groups = {}
+    for e in calls:
+        groups.setdefault(group_key(e, by), []).append(e)
+
+    def summarize(group):
+        latencies = np.array([e["latency"] for e in group])
+        return {"calls": len(group), "retries": sum(e.get("retries", 0) for e in group),
+                "prompt_tokens": sum(e.get("prompt_tokens", 0) for e in group),
+                "completion_tokens": sum(e.get("completion_tokens", 0) for e in group),
+                "cost_usd": round(sum(call_cost(e) for e in group), 4),
+                "mean_latency_s": float(latencies.mean()), "p99_latency_s": float(np.percentile(latencies, 99)),
+                "mean_queue_wait_s": float(np.mean([e.get("queue_wait", 0) for e in group]))}
+
+    cache = [e for e in events if e["kind"] == "cache"]
+    hits = sum(1 for e in cache if e["hit"])
+    totals = summarize(calls) if calls else {"calls": 0}
+    totals.update({"cache_hits": hits, "cache_misses": len(cache) - hits,
+                   "cache_hit_rate": hits / len(cache) if cache else 0.0,
+                   "parse_failures": sum(1 for e in events if e["kind"] == "parse_failure")})
+    stages = {}
+    for e in events:
+        if e["kind"] == "stage":
+            stages[e["stage"]] = stages.get(e["stage"], 0) + e["seconds"]
+    totals["stage_seconds"] = stages
+    return {"groups": {key: summarize(group) for key, group in sorted(groups.items())}, "totals": totals}
+
+# Function: token_ledger
+# Purpose: account for a run's prompt tokens by model: how many were sent, how many of those repeated a prefix sent earlier in
+#          the run (so a prefix cache could serve them), and how many the response cache saved from being sent at all
+# Parameters: events, a list of event dictionaries (see lm_utils.record_prompt)
+# Produces: ledger, a dictionary of token counts and cost estimates, keyed by model and "total"
+def token_ledger(events):
+    ledger = {}
+
+    def add(model, **counts):
+        for key in [model, "total"]:
+            entry = ledger.setdefault(key, {"requests": 0, "cached": 0, "sent_prompt_tokens": 0, "reused_prefix_tokens": 0,
+                                            "cache_saved_tokens": 0, "completion_tokens": 0, "est_cost_usd": 0.0,
+                                            "est_cost_with_prefix_cache_usd": 0.0})
+            for name, n in counts.items():
+                entry[name] += n
+
+    for e in events:
+        model = e.get("model", "unknown")
+        price = PRICE_PER_1K_TOKENS.get(model, 0.02) / 1000
+        if e["kind"] == "prompt" and e["cached"]:
+            add(model, requests=1, cached=1, cache_saved_tokens=e["prompt_tokens"])
+        elif e["kind"] == "prompt":
+            reused = e["prefix_tokens"] if e["prefix_reused"] else 0
+            add(model, requests=1, sent_prompt_tokens=e["prompt_tokens"], reused_prefix_tokens=reused,
+                est_cost_usd=e["prompt_tokens"] * price,
+                est_cost_with_prefix_cache_usd=(e["prompt_tokens"] - PREFIX_CACHE_DISCOUNT * reused) * price)
+        elif e["kind"] == "call":
+            completion = e.get("completion_tokens", 0)
+            add(model, completion_tokens=completion, est_cost_usd=completion * price,
+                est_cost_with_prefix_cache_usd=completion * price)
+    for entry in ledger.values():
+        entry["prefix_reuse_rate"] = entry["reused_prefix_tokens"] / entry["sent_prompt_tokens"] if entry["sent_prompt_tokens"] else 0.0
+        entry["est_cost_usd"] = round(entry["est_cost_usd"], 4)
+        entry["est_cost_with_prefix_cache_usd"] = round(entry["est_cost_with_prefix_cache_usd"], 4)
+    return ledger
+
+# Function: read_events
+# Purpose: read events back from a telemetry .jsonl file
+# Parameters: path, a string
+# Produces: events, a list of dictionaries
+def read_events(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Function: write_events
+# Purpose: write events to a telemetry .jsonl file
+# Parameters: events, a list of dictionaries
+#             path, a string
+#             append=False, a boolean of whether to add to the file's events (e.g. one run after another on a study) instead
+#                 of replacing them
+# Produces: None
+def write_events(events, path, append=False):
+    with open(path, "a" if append else "w") as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+
+# Function: export_prometheus
+# Purpose: write call, cache and parsing metrics in the Prometheus text exposition format
+# Parameters: events, a list of event dictionaries
+#             path, a string of the file to write
+# Produces: None
+def export_prometheus(events, path):
+    by_model = {}
+    for e in events:
+        if e["kind"] == "call":
+            m = by_model.setdefault(e.get("model", "unknown"), {"calls": 0, "retries": 0, "prompt": 0, "completion": 0,
+                                                                 "latency": 0.0, "queue_wait": 0.0})
+            m["calls"] += 1
+            m["retries"] += e.get("retries", 0)
+            m["prompt"] += e.get("prompt_tokens", 0)
+            m["completion"] += e.get("completion_tokens", 0)
+            m["latency"] += e["latency"]
+            m["queue_wait"] += e.get("queue_wait", 0)
+    lines = ["# TYPE lm_calls_total counter", "# TYPE lm_retries_total counter", "# TYPE lm_tokens_total counter",
+             "# TYPE lm_call_latency_seconds summary", "# TYPE lm_queue_wait_seconds summary"]
+    for model, m in by_model.items():
+        lines += [f'lm_calls_total{{model="{model}"}} {m["calls"]}',
+                  f'lm_retries_total{{model="{model}"}} {m["retries"]}',
+                  f'lm_tokens_total{{model="{model}",type="prompt"}} {m["prompt"]}',
+                  f'lm_tokens_total{{model="{model}",type="completion"}} {m["completion"]}',
+                  f'lm_call_latency_seconds_sum{{model="{model}"}} {m["latency"]}',
+                  f'lm_call_latency_seconds_count{{model="{model}"}} {m["calls"]}',
+                  f'lm_queue_wait_seconds_sum{{model="{model}"}} {m["queue_wait"]}',
+                  f'lm_queue_wait_seconds_count{{model="{model}"}} {m["calls"]}']
+    cache = [e for e in events if e["kind"] == "cache"]
+    hits = sum(1 for e in cache if e["hit"])
+    lines += ["# TYPE lm_cache_requests_total counter",
+              f'lm_cache_requests_total{{result="hit"}} {hits}',
+              f'lm_cache_requests_total{{result="miss"}} {len(cache) - hits}',
+              "# TYPE choice_parse_failures_total counter",
+              f"choice_parse_failures_total {sum(1 for e in events if e['kind'] == 'parse_failure')}"]
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
@@ -0,0 +1,17 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # The modules live at the repo root
+
+import lm_utils
+from backends import FakeBackend
+
+# A model answered by the in-process fake (no latency, no response cache), removed again after the test
+@pytest.fixture
+def fake_model(monkeypatch):
+    model = "fake-model"
+    backend = FakeBackend(latency=None)
+    monkeypatch.setattr(lm_utils, "use_cache", False)
+    monkeypatch.setitem(lm_utils.model_backends, model, backend)
+    return model, backend
@@ -0,0 +1,36 @@
+import pytest
+import adaptive
+from adaptive import cell_converged, allocate_samples, adaptive_multi_goal_experiment
+
+def test_unanimous_cell_keeps_going_while_the_rest_could_move_it():
+    assert not cell_converged([1, 1, 1], 6) # Three more 3's would make it 2.0
+    assert not cell_converged([1, 1, 1, 1], 6)
+    assert cell_converged([1, 1, 1, 1, 1], 6) # Even a 3 now leaves it low
+
+def test_bucket_and_confidence_stops():
+    assert cell_converged([3, 3, 3, 3, 3], 6) # Can't fall below 2.5 any more
+    assert not cell_converged([1, 3, 1], 6)
+    assert cell_converged([1, 2, 3, 1, 2, 3], 6) # Every ordering asked
+    assert cell_converged([2] * 40, 100) # Settled well before the bucket test could tell
+    assert not cell_converged([2] * 2, 100, min_samples=3)
+
+def test_allocation_follows_spread():
+    cells = {"agree": [2, 2, 2], "split": [1, 3, 1, 3, 1, 3], "some": [1, 2, 2, 2, 2, 2], "one": [2]}
+    allocation = allocate_samples(cells, 30)
+    assert "agree" not in allocation and "one" not in allocation
+    assert allocation["split"] > allocation["some"] > 0
+    assert sum(allocation.values()) <= 30
+    assert all(n % 3 == 0 for n in allocate_samples(cells, 30, unit=3).values())
+    assert allocate_samples(cells, 0) == {}
+    assert allocate_samples({"agree": [2, 2, 2]}, 30) == {}
+
+def test_extra_samples_are_scored_apart_and_counted_as_parsed(tmp_path, monkeypatch, fake_model):
+    model, _ = fake_model
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(adaptive, "load_plans", lambda goal, plan_set=0: "Low plan\nMedium plan\nHigh plan")
+    monkeypatch.setattr(adaptive, "sequential_prompt_experiment", lambda *args, **kwargs: [1, 3, 1, 3, 1, 3])
+    monkeypatch.setattr(adaptive, "sample_prompt_experiment", lambda *args, **kwargs: {0: [3, 3, 3], 3: [1]})
+    scores, n_samples, _ = adaptive_multi_goal_experiment(["goal"], ["000000"], model, budget=12, verbose=False,
+                                                          save_csv=False)
+    assert scores["goal"]["000000"] == pytest.approx(2.0) # Each ordering's samples weigh the same, without the T=0 answers
+    assert n_samples["goal"]["000000"] == 4
@@ -0,0 +1,14 @@
+from cache import ResponseCache
+from backends import OpenAIBackend, FakeBackend, RecordingBackend, backend_cache_id
+
+PARAMS = {"engine": "m", "prompt": "Which plan?", "max_tokens": 8, "temperature": 0}
+
+def test_backends_serving_the_same_model_dont_share_entries(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    local_server = OpenAIBackend(api_base="http://localhost:8000/v1")
+    cache.put(PARAMS, {"text": "2"}, backend_cache_id(local_server))
+    assert cache.get(PARAMS, backend_cache_id(OpenAIBackend(api_base="http://localhost:8000/v1"))) == {"text": "2"}
+    assert cache.get(PARAMS, backend_cache_id(RecordingBackend(local_server))) == {"text": "2"}
+    assert cache.get(PARAMS, backend_cache_id(OpenAIBackend())) is None
+    assert cache.get(PARAMS, backend_cache_id(FakeBackend())) is None
+    cache.close()
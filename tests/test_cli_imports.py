@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+import utils
+from run_log import RunLog
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs the cli in a fresh interpreter and gives back the heavy modules it imported
+def heavy_imports(argv, cwd):
+    script = (f"import sys; sys.path.insert(0, {ROOT!r}); import cli; cli.main({argv!r}); "
+              "print([m for m in ('openai', 'aiohttp', 'matplotlib') if m in sys.modules])")
+    out = subprocess.run([sys.executable, "-c", script], cwd=cwd, capture_output=True, text=True, check=True).stdout
+    return out.strip().splitlines()[-1]
+
+def test_load_and_report_skip_the_runners(tmp_path):
+    folder = str(tmp_path / "results") + "/"
+    os.makedirs(folder)
+    utils.experiment_to_csv({"creating a business": {"100100": 2.0, "000000": 1.5}}, folder)
+    run_log = RunLog(folder)
+    run_log.log("m", "creating a business", "100100", 0, 2, 2.0)
+    run_log.close()
+    assert heavy_imports(["load", folder, "--goals", "creating a business", "--codes", "100100", "000000", "--no-plots",
+                          "--set", "confidence_intervals=false"], str(tmp_path)) == "[]"
+    assert heavy_imports(["report", folder], str(tmp_path)) == "[]"
@@ -0,0 +1,50 @@
+import asyncio
+import json
+import pytest
+import lm_utils
+import async_engine
+import eval
+from backends import FakeBackend
+from run_log import RunLog, read_run_log
+from async_engine import Scheduler, async_multi_goal_experiment
+
+PLANS = "Low plan\nMedium plan\nHigh plan"
+
+# Orderings whose strict re-ask came back as prose too, from the invalid choice log
+def given_up(dest):
+    with open(dest + "invalid_choices.jsonl", "r") as f:
+        return {r["permutation"] for r in map(json.loads, f) if r["final"]}
+
+def test_async_run_leaves_out_orderings_given_up_on(tmp_path, fake_model, monkeypatch):
+    model, _ = fake_model
+    monkeypatch.setitem(lm_utils.model_backends, model, FakeBackend(latency=None, invalid_rate=1.0, strict_invalid_rate=0.5))
+    monkeypatch.setattr(async_engine, "load_plans", lambda goal, plan_set=0: PLANS)
+    dest = str(tmp_path) + "/"
+
+    async def main():
+        return await async_multi_goal_experiment(["goal"], ["000000"], model, scheduler=Scheduler(), verbose=False,
+                                                 save_csv=False, resume=dest)
+
+    results, _ = asyncio.run(main())
+    records = read_run_log(dest + "run_log.jsonl")
+    assert 0 < len(given_up(dest)) < 6
+    assert {r["permutation"] for r in records} == set(range(6)) - given_up(dest)
+    assert results["goal"]["000000"] == pytest.approx(sum(r["ps"] for r in records) / len(records))
+
+    monkeypatch.setitem(lm_utils.model_backends, model, FakeBackend(latency=None))
+    asyncio.run(main()) # A resume asks them again
+    assert len(read_run_log(dest + "run_log.jsonl")) == 6
+
+@pytest.mark.parametrize("batch_requests", [False, True])
+def test_sync_run_leaves_out_orderings_given_up_on(tmp_path, fake_model, monkeypatch, batch_requests):
+    model, _ = fake_model
+    monkeypatch.setitem(lm_utils.model_backends, model, FakeBackend(latency=None, invalid_rate=1.0, strict_invalid_rate=0.5))
+    monkeypatch.setattr(eval, "model", model)
+    monkeypatch.setattr(eval, "batch_requests", batch_requests)
+    dest = str(tmp_path) + "/"
+    run_log = RunLog(dest)
+    choices = eval.run_cells(["000000"], "goal", PLANS, run_log=run_log)
+    run_log.close()
+    assert 0 < len(given_up(dest)) < 6
+    assert {k for _, k in choices} == set(range(6)) - given_up(dest)
+    assert len(read_run_log(dest + "run_log.jsonl")) == len(choices)
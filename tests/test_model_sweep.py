@@ -0,0 +1,26 @@
+import asyncio
+import pytest
+pytest.importorskip("pyarrow")
+import lm_utils
+import plan_corpus
+from backends import OpenAIBackend, FakeBackend
+from model_sweep import ModelLane, sweep_models
+
+def test_default_lanes_get_their_own_pool():
+    lanes = [ModelLane("text-davinci-003", max_concurrency=4), ModelLane("text-curie-001", max_concurrency=8)]
+    assert [type(lane.backend) for lane in lanes] == [OpenAIBackend, OpenAIBackend]
+    assert [lane.backend.pool_size for lane in lanes] == [4, 8]
+    assert lanes[0].backend is not lm_utils.backend
+
+def test_sweep_restores_backend_routes(tmp_path, monkeypatch, fake_model):
+    model, backend = fake_model
+    monkeypatch.chdir(tmp_path)
+    plan_corpus.add_plan_sets("goal", [["a plan", "b plan", "c plan"]], "m")
+    routes = dict(lm_utils.model_backends)
+    lane = ModelLane(model)
+    assert lane.backend is backend # Models routed to a non-OpenAI backend keep it
+    lanes = [lane, ModelLane("other-model", backend=FakeBackend(latency=None))]
+    experiments = asyncio.run(sweep_models(["goal"], ["000000"], lanes, str(tmp_path) + "/", verbose=False))
+    assert sorted(experiments) == [model, "other-model"]
+    assert list(experiments["other-model"]["goal"]) == ["000000"]
+    assert lm_utils.model_backends == routes
@@ -0,0 +1,38 @@
+import pytest
+from lm_utils import parse_choice, get_choice, InvalidChoiceError
+
+@pytest.mark.parametrize("text, choice", [
+    ("2", 2),
+    (" 2", 2),
+    ("\n3", 3),
+    ("1.", 1),
+    ("2)", 2),
+    ("(3)", 3),
+    ("**2**", 2),
+    ("\"1\"", 1),
+    ("Plan 2", 2),
+    ("plan #3 is best", 3),
+    ("Plan 2 (not 1)", 2),
+])
+def test_reads_leading_plan_number(text, choice):
+    assert parse_choice(text) == choice
+
+@pytest.mark.parametrize("text", [
+    "",
+    "I would choose plan 2", # The number has to come first
+    "0",
+    "4",
+    "12",
+    "None of them",
+])
+def test_rejects_other_answers(text):
+    assert parse_choice(text) is None
+
+def test_number_of_plans_sets_the_range():
+    assert parse_choice("5", n_plans=6) == 5
+    assert parse_choice("5", n_plans=3) is None
+
+def test_get_choice_raises_on_invalid():
+    assert get_choice(" 3") == 3
+    with pytest.raises(InvalidChoiceError):
+        get_choice("The second one")
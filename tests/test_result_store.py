@@ -0,0 +1,37 @@
+import pytest
+pytest.importorskip("pyarrow")
+from run_log import RunLog
+from result_store import (make_table, write_part, load_table, load_store_experiment, load_store_models, run_log_to_store,
+                          experiment_to_store)
+
+def test_table_round_trip(tmp_path):
+    folder = str(tmp_path / "store")
+    write_part(make_table(["m", "m", "m"], ["goal", "goal", "other goal"], ["000000", "000000", "110100"], [0, 1, 0],
+                          [1, 3, 2], [1.0, 3.0, 2.0], [0.0, 1.0, 2.0]), folder)
+    table = load_table(folder).to_pydict()
+    assert table["goal"] == ["goal", "goal", "other goal"]
+    assert table["code"] == ["000000", "000000", "110100"]
+    assert table["choice"] == [1, 3, 2]
+    assert (table["has_desc"], table["is_docile"], table["has_goal"]) == ([0, 0, 1], [0, 0, 1], [0, 0, 1])
+    assert load_store_experiment(folder) == {"goal": {"000000": 2.0}, "other goal": {"110100": 2.0}}
+    assert load_store_experiment(folder, goals=["goal"]) == {"goal": {"000000": 2.0}}
+
+def test_run_log_to_store(tmp_path):
+    run_log = RunLog(str(tmp_path))
+    for k in range(6):
+        run_log.log("m", "goal", "010000", k, 1 + k % 3, 3 - k % 3)
+    run_log.close()
+    run_log_to_store(str(tmp_path))
+    table = load_table(str(tmp_path / "store")).to_pydict()
+    assert table["permutation"] == list(range(6))
+    assert load_store_experiment(str(tmp_path / "store")) == {"goal": {"010000": 2.0}}
+
+def test_averaged_scores_and_several_models(tmp_path):
+    folder = str(tmp_path / "store")
+    experiment_to_store({"goal": {"000000": 1.5}}, folder, model="a", part="a")
+    experiment_to_store({"goal": {"000000": 2.5}}, folder, model="b", part="b")
+    assert load_table(folder).to_pydict()["permutation"] == [-1, -1]
+    assert load_store_models(folder) == {"a": {"goal": {"000000": 1.5}}, "b": {"goal": {"000000": 2.5}}}
+    assert load_store_experiment(folder, models=["b"]) == {"goal": {"000000": 2.5}}
+    with pytest.raises(ValueError): # Two models' scores aren't averaged together unless asked for
+        load_store_experiment(folder)
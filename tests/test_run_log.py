@@ -0,0 +1,62 @@
+import asyncio
+import async_engine
+from run_log import RunLog, read_run_log, run_log_to_ps_scores
+from async_engine import Scheduler, async_multi_goal_experiment
+
+def test_resume_reads_logged_choices(tmp_path):
+    run_log = RunLog(str(tmp_path))
+    run_log.log("m", "goal", "000000", 0, 2, 2)
+    run_log.log("m", "goal", "000000", 1, 3, 3)
+    run_log.close()
+
+    resumed = RunLog(str(tmp_path))
+    assert resumed.get("m", "goal", "000000", 1) == {"choice": 3, "ps": 3}
+    assert resumed.get("m", "goal", "000000", 2) is None
+    assert resumed.get("other model", "goal", "000000", 0) is None
+    resumed.close()
+
+def test_partial_last_line_is_dropped(tmp_path):
+    run_log = RunLog(str(tmp_path))
+    run_log.log("m", "goal", "000000", 0, 1, 1)
+    run_log.close()
+    with open(tmp_path / "run_log.jsonl", "a") as f: # A crash in the middle of a write
+        f.write('{"model": "m", "goal": "goal", "co')
+
+    resumed = RunLog(str(tmp_path))
+    resumed.log("m", "goal", "000000", 1, 2, 2)
+    resumed.close()
+    records = read_run_log(str(tmp_path / "run_log.jsonl"))
+    assert [r["permutation"] for r in records] == [0, 1]
+
+def test_incomplete_cells_are_left_out(tmp_path):
+    run_log = RunLog(str(tmp_path))
+    for k in range(6):
+        run_log.log("m", "goal", "000000", k, 1 + k % 3, 1 + k % 3)
+    run_log.log("m", "goal", "100000", 0, 3, 3)
+    run_log.close()
+    assert run_log_to_ps_scores(str(tmp_path)) == {"goal": {"000000": 2.0}}
+
+def test_resumed_run_only_asks_missing_cells(tmp_path, fake_model, monkeypatch):
+    model, backend = fake_model
+    asked = []
+    create = backend.acreate
+    async def acreate(**params):
+        asked.append(params["prompt"])
+        return await create(**params)
+    backend.acreate = acreate
+    monkeypatch.setattr(async_engine, "load_plans", lambda goal, plan_set=0: "Low plan\nMedium plan\nHigh plan")
+    dest = str(tmp_path) + "/"
+
+    async def main():
+        return await async_multi_goal_experiment(["goal"], ["000000"], model, scheduler=Scheduler(), verbose=False,
+                                                 save_csv=False, resume=dest)
+
+    run_log = RunLog(dest)
+    for k in range(4): # Half-finished run: 4 of the 6 orderings answered
+        run_log.log(model, "goal", "000000", k, 1, 1)
+    run_log.close()
+    results, _ = asyncio.run(main())
+
+    assert len(asked) == 2
+    assert len(read_run_log(dest + "run_log.jsonl")) == 6
+    assert results["goal"]["000000"] == run_log_to_ps_scores(dest)["goal"]["000000"]
@@ -0,0 +1,72 @@
+import asyncio
+import openai
+import pytest
+import async_engine
+from async_engine import Scheduler
+
+# A call that fails with `error` the first n_failures times, then answers
+def flaky_call(n_failures, error):
+    state = {"calls": 0}
+    async def call():
+        state["calls"] += 1
+        if state["calls"] <= n_failures:
+            raise error
+        return {"usage": {}}
+    return call, state
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def test_retries_until_success(monkeypatch):
+    monkeypatch.setattr(async_engine.random, "uniform", lambda a, b: 0)
+    call, state = flaky_call(2, openai.error.RateLimitError("throttled"))
+    async def main():
+        scheduler = Scheduler(max_retries=3)
+        return await scheduler.run(call, 10), scheduler
+    response, scheduler = run(main())
+    assert response == {"usage": {}}
+    assert state["calls"] == 3
+    assert (scheduler.n_calls, scheduler.n_retries) == (3, 2)
+
+def test_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(async_engine.random, "uniform", lambda a, b: 0)
+    call, state = flaky_call(10, openai.error.APIError("server error"))
+    async def main():
+        await Scheduler(max_retries=2).run(call, 10)
+    with pytest.raises(openai.error.APIError):
+        run(main())
+    assert state["calls"] == 3 # The first try and two retries
+
+def test_other_errors_are_not_retried():
+    call, state = flaky_call(1, ValueError("bad request"))
+    async def main():
+        await Scheduler(max_retries=5).run(call, 10)
+    with pytest.raises(ValueError):
+        run(main())
+    assert state["calls"] == 1
+
+def test_backoff_doubles_up_to_max_delay(monkeypatch):
+    bounds = []
+    def uniform(a, b): # Record the backoff window instead of sleeping in it
+        bounds.append((a, b))
+        return 0
+    monkeypatch.setattr(async_engine.random, "uniform", uniform)
+    call, _ = flaky_call(5, openai.error.RateLimitError("throttled"))
+    async def main():
+        await Scheduler(max_retries=5, base_delay=1, max_delay=5).run(call, 10)
+    run(main())
+    assert bounds == [(0, 1), (0, 2), (0, 4), (0, 5), (0, 5)]
+
+def test_concurrency_is_bounded():
+    state = {"in_flight": 0, "most": 0}
+    async def call():
+        state["in_flight"] += 1
+        state["most"] = max(state["most"], state["in_flight"])
+        await asyncio.sleep(0.01)
+        state["in_flight"] -= 1
+        return {"usage": {}}
+    async def main():
+        scheduler = Scheduler(max_concurrency=3, requests_per_min=60000)
+        await asyncio.gather(*[scheduler.run(call, 1) for _ in range(12)])
+    run(main())
+    assert state["most"] == 3
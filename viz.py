@@ -1,8 +1,90 @@
 import numpy as np
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import matplotlib.pyplot as plt
+from matplotlib.collections import PathCollection # Drawing every cell label as one artist
+from matplotlib.textpath import TextPath
+from matplotlib.transforms import Affine2D
 import datetime
 from utils import *
+from code_tensor import CodeTensor, nanmean # Vectorized marginals
+
+headless = False # Whether to only save figures, reusing them between plots and never opening a window (see set_headless)
+timestamp_names = True # Whether saved file names start with the time they were made (off for stable names, e.g. figures.py)
+figures = {} # Reusable figures when headless, keyed by plot kind
+label_paths = {} # Outlines of cell labels already laid out, keyed by (text, font size)
+
+# Function: set_headless
+# Purpose: switch to saving figures without a display (e.g. on a CI box), or back
+# Parameters: on=True, a boolean
+# Produces: None
+def set_headless(on=True):
+    global headless
+    headless = on
+    if on:
+        plt.switch_backend("Agg")
+
+# Function: stamp
+# Purpose: get the file name to save a plot under
+# Parameters: name, a string
+# Produces: name, a string, prefixed with the current time if timestamp_names is set
+def stamp(name):
+    return f"{datetime.datetime.now().strftime('%Y.%d.%m %H.%M.%S')} {name}" if timestamp_names else name
+
+# Function: new_figure
+# Purpose: get an empty figure and axes to plot on; when headless, the figure of the same kind is cleared and reused
+# Parameters: kind, a string naming the kind of plot
+# Produces: fig, a matplotlib Figure
+#           ax, a matplotlib Axes
+def new_figure(kind):
+    if not headless:
+        return plt.subplots()
+    if kind not in figures:
+        figures[kind] = plt.figure()
+    fig = figures[kind]
+    fig.clf()
+    return fig, fig.add_subplot()
+
+# Function: finish_figure
+# Purpose: save a finished figure and show it (unless headless)
+# Parameters: fig, a matplotlib Figure
+#             save_png, a boolean
+#             path, a string of the file to save to
+# Produces: None
+def finish_figure(fig, save_png, path):
+    if save_png:
+        fig.savefig(path, bbox_inches="tight")
+    if not headless:
+        plt.show()
+
+# Function: label_path
+# Purpose: get the outline of a (possibly multi-line) cell label, centered on the origin, in points
+# Parameters: text, a string
+#             size, a float of the font size in points
+# Produces: path, a matplotlib Path
+def label_path(text, size):
+    if (text, size) not in label_paths:
+        lines = text.split("\n")
+        paths = []
+        for k, line in enumerate(lines):
+            path = TextPath((0, 0), line, size=size)
+            extents = path.get_extents()
+            shift = Affine2D().translate(-(extents.x0 + extents.x1) / 2, -size * 0.35 + size * 1.2 * ((len(lines) - 1) / 2 - k))
+            paths.append(path.transformed(shift))
+        label_paths[(text, size)] = paths[0].make_compound_path(*paths)
+    return label_paths[(text, size)]
+
+# Function: annotate_cells
+# Purpose: write a label on every cell of a heatmap, drawn as one collection instead of one text artist per cell
+# Parameters: ax, the heatmap's Axes
+#             labels, a 2d list of strings (rows, columns)
+#             size=10, a float of the font size in points
+# Produces: None
+def annotate_cells(ax, labels, size=10):
+    offsets = [(j, i) for i in range(len(labels)) for j in range(len(labels[i]))]
+    paths = [label_path(labels[i][j], size) for j, i in offsets]
+    collection = PathCollection(paths, offsets=offsets, offset_transform=ax.transData, facecolors="w", edgecolors="none",
+                                transform=Affine2D().scale(1 / 72) + ax.figure.dpi_scale_trans) # Points to display units
+    ax.add_collection(collection, autolim=False)
 
 # Function: heatmap_general
 # Purpose: create a heatmap
@@ -14,10 +96,11 @@ from utils import *
 #             abs_range=False, whether to set the colorbar range as [1,3] or [min,max]
 #             dest=".", a string of where to save the image
 #             name="fig", a string of what to name the file
+#             intervals=None, a (low, high) tuple of arrays shaped like values, to annotate each cell with its interval
 # Produces: None
 def heatmap_general(values, xtick_labels, ytick_labels, title,
-                    save_png=True, abs_range=False, dest=".", name="fig"):
-    fig, ax = plt.subplots()
+                    save_png=True, abs_range=False, dest=".", name="fig", intervals=None):
+    fig, ax = new_figure("heatmap")
 
     if abs_range:
         im = ax.imshow(values, cmap="viridis", vmin=1, vmax=3)
@@ -35,19 +118,18 @@ def heatmap_general(values, xtick_labels, ytick_labels, title,
              rotation_mode="anchor")
 
     if width < 60:
-        for i in range(height):
-            for j in range(width):
-                text = ax.text(j, i, round(values[i, j], 2 if width < 40 else 1),
-                                ha="center", va="center", color="w")
+        labels = [[str(round(values[i, j], 2 if width < 40 else 1)) for j in range(width)] for i in range(height)]
+        if intervals is not None:
+            labels = [[f"{labels[i][j]}\n[{intervals[0][i, j]:.2f}, {intervals[1][i, j]:.2f}]" for j in range(width)]
+                      for i in range(height)]
+        annotate_cells(ax, labels, size=10 if intervals is None else 7)
 
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.05)
+    fig.colorbar(im, cax=cax) # Before saving, so the saved image has it too
 
     ax.set_title(title)
-    if save_png:
-        plt.savefig(dest + f"{name} fig_{'absolute' if abs_range else ''}.png", bbox_inches="tight")
-    plt.colorbar(im, cax=cax)
-    plt.show()
+    finish_figure(fig, save_png, dest + f"{name} fig_{'absolute' if abs_range else ''}.png")
 
 # Function: histo_general
 # Purpose: create a histogram
@@ -58,18 +140,16 @@ def heatmap_general(values, xtick_labels, ytick_labels, title,
 #             name="fig", a string of what to name the file
 # Produces: None
 def histo_general(values, title, save_png=True, dest=".", name="fig"):
-    fig, ax = plt.subplots()
+    fig, ax = new_figure("histo")
     ax.set_title(title)
 
     q75, q25 = np.percentile(values, [75, 25])
     h = 2 * (q75-q25) * (len(values) ** (-1/3)) # Select bin width using Freedman-Diaconis rule
     n_bins = int((max(values)-min(values))/h)
 
-    plt.hist(values, bins=n_bins)
+    ax.hist(values, bins=n_bins)
 
-    if save_png:
-        plt.savefig(dest + f"{name}.png", bbox_inches="tight")
-    plt.show()
+    finish_figure(fig, save_png, dest + f"{name}.png")
 
 # Function: graph_general
 # Purpose: create a graph
@@ -81,7 +161,7 @@ def histo_general(values, title, save_png=True, dest=".", name="fig"):
 #             absolute=False, whether to have the y-range be [1,3] or [min,max]
 # Produces: None
 def graph_general(data, title, save_png=True, dest=".", name="fig", absolute=False):
-    fig, ax = plt.subplots()
+    fig, ax = new_figure("graph")
 
     xtick_labels = [code[0] for code in data]
     y_vals = [code[1] for code in data]
@@ -94,12 +174,10 @@ def graph_general(data, title, save_png=True, dest=".", name="fig", absolute=Fal
 
     ax.set_title(title)
 
-    if absolute: plt.ylim([1,3])
-    plt.hlines(2, 0, len(xtick_labels), colors=["black"], linestyles="dashed") # Line at chance PS score
-    plt.plot(y_vals)
-    if save_png:
-        plt.savefig(dest + f"{name}.png", bbox_inches="tight")
-    plt.show()
+    if absolute: ax.set_ylim([1,3])
+    ax.hlines(2, 0, len(xtick_labels), colors=["black"], linestyles="dashed") # Line at chance PS score
+    ax.plot(y_vals)
+    finish_figure(fig, save_png, dest + f"{name}.png")
 
 # Function: visualize_goals_vs_codes
 # Purpose: create a heatmap of PS score parameterized by goal and prompt
@@ -121,7 +199,15 @@ def visualize_goals_vs_codes(ps_scores, save_png=False, dest=".", absolute_range
     cells = np.vstack((np.mean(cells, axis=0), cells)) # Get averages over codes
 
     heatmap_general(cells, codes + ["average"], ["average"] + goals, "Power-Seeking Scores (1=low, 3=high)",
-                    save_png=save_png, abs_range=absolute_range, dest=dest, name=f"{datetime.datetime.now().strftime('%Y.%d.%m %H.%M.%S')} {name}")
+                    save_png=save_png, abs_range=absolute_range, dest=dest, name=stamp(name))
+
+# Function: with_averages
+# Purpose: add a column of row averages and then a first row of column averages to a table, as the heatmaps show them
+# Parameters: cells, a 2d numpy array
+# Produces: cells, a 2d numpy array one row and one column bigger
+def with_averages(cells):
+    cells = np.hstack((cells, np.mean(cells, axis=1, keepdims=True)))
+    return np.vstack((np.mean(cells, axis=0), cells))
 
 # Function: visualize_variates
 # Purpose: create a heatmap of PS score, where each cell is average over all goals of prompt that have that particular variate value
@@ -131,13 +217,11 @@ def visualize_goals_vs_codes(ps_scores, save_png=False, dest=".", absolute_range
 #             dest=".", a string of where to save the image
 #             absolute_range=True, whether to have the colorbar range be [1,3] or [min,max]
 #             name="variates", a string of what to name the file
+#             bootstrap=None, an analysis.Bootstrap of the experiment, to show 95% intervals
 # Produces: None
 def visualize_variates(ps_scores, variates,
-                       save_png=False, dest=".", absolute_range=True, name="variates"):
-    goals = list(ps_scores.keys())
-    codes = list(list(ps_scores.values())[0].keys())
-
-    aggregate = aggregate_over_goals(goals, codes, ps_scores)
+                       save_png=False, dest=".", absolute_range=True, name="variates", bootstrap=None):
+    tensor = CodeTensor.from_experiment(ps_scores)
 
     variate_names = [["no desc", "desc"],
                      ["!docile", "docile"],
@@ -146,24 +230,12 @@ def visualize_variates(ps_scores, variates,
                      ["no diff", "diff"],
                      ["!success", "success"]] # For axis labels
 
-    margin_meta = ""
-    for i in range(len(codes[0])):
-        if i in list(variates):
-            margin_meta += "{}"
-        else:
-            margin_meta += "X"
-
-    v1_range = len(descriptions) if variates[0] == 2 else 2
-    v2_range = len(descriptions) if variates[1] == 2 else 2
-
-    cells = np.array([[marginalize_ps_scores(margin_meta.format(i, j), aggregate)[margin_meta.format(i, j)]
-                       for i in range(v1_range)] for j in range(v2_range)]) # Get average PS score of all codes that have particular values
-    row_average = np.transpose(np.reshape(np.mean(cells, axis=1), (1, v2_range)))
-    cells = np.hstack((cells, row_average))
-    cells = np.vstack((np.mean(cells, axis=0), cells))
+    cells = with_averages(tensor.variates_grid(variates)) # Get average PS score of all codes that have particular values
+    intervals = bootstrap.interval(f"variates_{variates[0]}_{variates[1]}", transform=with_averages) if bootstrap else None
 
     heatmap_general(cells, variate_names[variates[0]] + ["average"], ["average"] + variate_names[variates[1]], "Power-Seeking Scores (1=low, 3=high)",
-                    save_png=save_png, abs_range=absolute_range, dest=dest, name=f"{datetime.datetime.now().strftime('%Y.%d.%m %H.%M.%S')} {name}")
+                    save_png=save_png, abs_range=absolute_range, dest=dest, name=stamp(name),
+                    intervals=intervals)
 
 # Function: visualize_goals_vs_variate
 # Purpose: create a heatmap of PS score parameterized by goal and prompt variate
@@ -173,11 +245,11 @@ def visualize_variates(ps_scores, variates,
 #             dest=".", a string of where to save the image
 #             absolute_range=True, whether to have the colorbar range be [1,3] or [min,max]
 #             name="variates", a string of what to name the file
+#             bootstrap=None, an analysis.Bootstrap of the experiment, to show 95% intervals
 # Produces: None
 def visualize_goals_vs_variate(ps_scores, variate,
-                               save_png=False, dest=".", absolute_range=True, name="goal_variate"):
+                               save_png=False, dest=".", absolute_range=True, name="goal_variate", bootstrap=None):
     goals = list(ps_scores.keys())
-    codes = list(list(ps_scores.values())[0].keys())
 
     variate_names = [["no desc", "desc"],
                      ["!docile", "docile"],
@@ -186,26 +258,54 @@ def visualize_goals_vs_variate(ps_scores, variate,
                      ["no diff", "diff"],
                      ["!success", "success"]]
 
-    margin_meta = ""
-    for i in range(len(codes[0])):
-        if i == variate:
-            margin_meta += "{}"
-        else:
-            margin_meta += "X"
-
-    v_range = len(descriptions) if variate == 2 else 2
-
-    cells = np.array([[dict_mean(filter_dict(get_code_match(margin_meta.format(i), codes), ps_scores[goal])) for goal in goals] for i in range(v_range)])
-    cells = np.transpose(cells)
-
-    row_average = np.transpose(np.reshape(np.mean(cells, axis=1), (1, len(goals))))
-    cells = np.hstack((cells, row_average))
-    cells = np.vstack((np.mean(cells, axis=0), cells))
+    cells = CodeTensor.from_experiment(ps_scores, goals).goals_vs_variate(variate) # Rows are goals, columns are variate values
+    cells = with_averages(cells)
+    intervals = None
+    if bootstrap is not None:
+        rows = [bootstrap.goals.index(goal) for goal in goals] # Same row order as the plot
+        intervals = bootstrap.interval(f"goals_{variate}", transform=lambda sample: with_averages(sample[rows]))
 
     heatmap_general(cells, variate_names[variate] + ["average"], ["average"] + goals,
                     "Power-Seeking Scores (1=low, 3=high)",
                     save_png=save_png, abs_range=absolute_range, dest=dest,
-                    name=f"{datetime.datetime.now().strftime('%Y.%d.%m %H.%M.%S')} {name}")
+                    name=stamp(name), intervals=intervals)
 
 def visualize_code_histo(ps_ratings, save_png=False, dest=".", name="code_histo"):
     histo_general(ps_ratings, "Power-Seeking over Codes", save_png=save_png, dest=dest, name=name)
+
+# Function: visualize_models_vs_codes
+# Purpose: create a heatmap of PS score parameterized by model and prompt, averaged over goals
+# Parameters: experiments, a dictionary of multi-goal experiment dictionaries, keyed by model (see load_store_models)
+#             save_png=True, a boolean of whether to save the heatmap as an image
+#             dest=".", a string of where to save the image
+#             absolute_range=True, whether to have the colorbar range be [1,3] or [min,max]
+#             name="models", a string of what to name the file
+# Produces: None
+def visualize_models_vs_codes(experiments, save_png=False, dest=".", absolute_range=True, name="models"):
+    models = list(experiments.keys())
+    codes = sorted({code for ps_scores in experiments.values() for goal in ps_scores for code in ps_scores[goal]})
+
+    tensors = {model: CodeTensor.from_experiment(experiments[model]) for model in models}
+    cells = np.array([[nanmean(tensors[model].scores[(slice(None),) + tuple(int(c) for c in code)]) for code in codes]
+                      for model in models]) # Rows are models, columns are prompt codes
+
+    heatmap_general(cells, codes, models, "Power-Seeking Scores by Model (1=low, 3=high)",
+                    save_png=save_png, abs_range=absolute_range, dest=dest, name=stamp(name))
+
+# Function: visualize_models_vs_goals
+# Purpose: create a heatmap of PS score parameterized by model and goal, averaged over prompts
+# Parameters: experiments, a dictionary of multi-goal experiment dictionaries, keyed by model (see load_store_models)
+#             save_png=True, a boolean of whether to save the heatmap as an image
+#             dest=".", a string of where to save the image
+#             absolute_range=True, whether to have the colorbar range be [1,3] or [min,max]
+#             name="models_goals", a string of what to name the file
+# Produces: None
+def visualize_models_vs_goals(experiments, save_png=False, dest=".", absolute_range=True, name="models_goals"):
+    models = list(experiments.keys())
+    goals = sorted({goal for ps_scores in experiments.values() for goal in ps_scores})
+
+    cells = np.array([[np.mean(list(experiments[model][goal].values())) if goal in experiments[model] else np.nan
+                       for goal in goals] for model in models]) # Rows are models, columns are goals
+
+    heatmap_general(cells, goals, models, "Power-Seeking Scores by Model (1=low, 3=high)",
+                    save_png=save_png, abs_range=absolute_range, dest=dest, name=stamp(name))
@@ -0,0 +1,228 @@
+import asyncio # Running several work units at once
+import json
+import os
+import socket # Default worker names
+import sqlite3 # The shared queue
+import time # Leases
+from utils import * # Constants, saving/loading data
+import lm_utils # Routing each model to its backend
+from async_engine import Scheduler, async_single_prompt_experiment # Rate limits, retries and the per-cell runs
+from run_log import RunLog, read_run_log, ASYNC_FSYNC_EVERY # Each worker's shard of choices
+from result_store import make_table, write_part # Columnar result storage
+
+# Sharded sweeps: the (model, goal, code) cells of a design (each scored over all its plan orderings) are split into work units
+# in a SQLite queue in a shared folder. Any number of workers, on any machines that see the folder and with their own API keys,
+# claim units under a time-limited lease, keep the lease alive with heartbeats while they work, and write their choices to
+# their own shard (shards/<worker>/run_log.jsonl), so workers never write to the same file. A unit whose lease runs out (its
+# worker died or lost the folder) is handed to the next worker that asks. merge_shards then combines the shards into one result
+# store and per-goal csv's.
+#
+# Leases are wall-clock times, so machines' clocks should agree to well within lease_seconds. The queue uses SQLite's default
+# rollback journal rather than WAL, which doesn't work over network filesystems.
+
+# Class: WorkQueue
+# Purpose: SQLite queue of leased work units, each a (model, goal, list of codes)
+# Parameters: dest, a string of the shared sweep folder (the queue is dest/queue.sqlite)
+#             timeout=60, a float of seconds to wait for another worker's transaction to finish
+class WorkQueue:
+    def __init__(self, dest, timeout=60):
+        os.makedirs(dest, exist_ok=True)
+        self.path = os.path.join(dest, "queue.sqlite")
+        self.db = sqlite3.connect(self.path, timeout=timeout, isolation_level=None) # Transactions are begun explicitly
+        self.db.execute("""CREATE TABLE IF NOT EXISTS units (
+                               id INTEGER PRIMARY KEY, model TEXT, goal TEXT, codes TEXT, status TEXT DEFAULT 'pending',
+                               worker TEXT, lease_expires REAL DEFAULT 0, attempts INTEGER DEFAULT 0, finished REAL,
+                               error TEXT, UNIQUE (model, goal, codes))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS units_status ON units (status, lease_expires)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)") # Shared by every worker
+
+    # Which of each goal's plan sets the sweep runs; set once, as shards aren't keyed by it
+    def plan_set(self, plan_set=None):
+        row = self.db.execute("SELECT value FROM settings WHERE key = 'plan_set'").fetchone()
+        if row is not None:
+            if plan_set is not None and int(row[0]) != plan_set:
+                raise ValueError(f"This queue runs plan set {row[0]}, not {plan_set}; use a new folder for another plan set")
+            return int(row[0])
+        plan_set = 0 if plan_set is None else plan_set
+        self.db.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('plan_set', ?)", (str(plan_set),))
+        return plan_set
+
+    # Add units for every (model, goal) and run of unit_size codes; units already in the queue are left as they are
+    def add(self, models, goals, codes, unit_size=16):
+        rows = [(model, goal, json.dumps(codes[i:i + unit_size])) for model in models for goal in goals
+                for i in range(0, len(codes), unit_size)]
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.executemany("INSERT OR IGNORE INTO units (model, goal, codes) VALUES (?, ?, ?)", rows)
+        self.db.execute("COMMIT")
+        return len(rows)
+
+    # Lease the next pending unit (or one whose lease ran out) to a worker; None if there's nothing to hand out right now
+    def claim(self, worker, lease_seconds=120):
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE") # Locks out other claims, so a unit goes to one worker
+        try:
+            row = self.db.execute("""SELECT id, model, goal, codes FROM units
+                                     WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?)
+                                     ORDER BY id LIMIT 1""", (now,)).fetchone()
+            if row is not None:
+                self.db.execute("""UPDATE units SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1
+                                   WHERE id = ?""", (worker, now + lease_seconds, row[0]))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return {"id": row[0], "model": row[1], "goal": row[2], "codes": json.loads(row[3])}
+
+    # Extend a worker's lease on a unit; False if the lease was lost (it ran out and the unit went to another worker)
+    def heartbeat(self, unit_id, worker, lease_seconds=120):
+        cursor = self.db.execute("UPDATE units SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                                 (time.time() + lease_seconds, unit_id, worker))
+        return cursor.rowcount == 1
+
+    # Mark a unit done
+    def complete(self, unit_id, worker):
+        self.db.execute("UPDATE units SET status = 'done', finished = ?, worker = ? WHERE id = ?", (time.time(), worker, unit_id))
+
+    # Give a unit back after an error, to be retried (or, after max_attempts, set aside as failed)
+    def release(self, unit_id, worker, error, max_attempts=5):
+        self.db.execute("""UPDATE units SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, lease_expires = 0,
+                           error = ? WHERE id = ? AND worker = ?""", (max_attempts, error, unit_id, worker))
+
+    # Number of units by status ("pending", "leased", "done", "failed"), with leases that ran out counted as pending
+    def progress(self):
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        for status, expired, n in self.db.execute("""SELECT status, status = 'leased' AND lease_expires < ?, COUNT(*)
+                                                     FROM units GROUP BY 1, 2""", (time.time(),)):
+            counts["pending" if expired else status] += n
+        return counts
+
+    def close(self):
+        self.db.close()
+
+# Function: create_queue
+# Purpose: split a design into work units in a shared sweep folder (adding to the queue if there already is one)
+# Parameters: dest, a string of the shared sweep folder
+#             goals, a list of strings
+#             codes, a list of strings
+#             models, a list of model name strings
+#             unit_size=16, an integer of how many codes (each over all its plan orderings) make one unit
+#             plan_set=None, an integer of which of each goal's plan sets to run (fixed when the queue is made: None for 0 in a new
+#                 queue, or whichever the queue already runs)
+# Produces: progress, a dictionary of the number of units by status
+def create_queue(dest, goals, codes, models, unit_size=16, plan_set=None):
+    queue = WorkQueue(dest)
+    queue.plan_set(plan_set)
+    queue.add(models, goals, codes, unit_size)
+    progress = queue.progress()
+    queue.close()
+    return progress
+
+# Function: work
+# Purpose: be one worker of a sharded sweep: claim units until the queue is finished, heartbeating each lease while it runs
+# Parameters: dest, a string of the shared sweep folder
+#             worker=None, a string naming this worker (defaults to host name and process id); its shard is dest/shards/<worker>
+#             backend=None, the backend to send this worker's requests to (e.g. OpenAIBackend(api_key=...)), None for the default
+#             parallel_units=4, an integer of how many units to run at once
+#             lease_seconds=120, a float of how long a claim lasts without a heartbeat
+#             heartbeat_every=30, a float of seconds between heartbeats
+#             poll_every=10, a float of seconds to wait, when other workers hold every unit left, before asking again
+#             verbose=True, a boolean controlling printing behavior
+#             **limits, Scheduler settings for this worker (max_concurrency, requests_per_min, tokens_per_min, max_retries)
+# Produces: n_units, an integer of how many units this worker finished
+async def work(dest, worker=None, backend=None, parallel_units=4, lease_seconds=120, heartbeat_every=30, poll_every=10,
+               verbose=True, **limits):
+    worker = worker if worker is not None else f"{socket.gethostname()}-{os.getpid()}"
+    if backend is not None:
+        lm_utils.set_backend(backend)
+    queue = WorkQueue(dest)
+    plan_set = queue.plan_set() # As the queue was made with
+    run_log = RunLog(os.path.join(dest, "shards", worker), fsync_every=ASYNC_FSYNC_EVERY)
+    scheduler = Scheduler(**limits) # Inside the running event loop
+    n_units = 0
+    t1 = time.time()
+
+    async def keep_lease(unit): # Heartbeat until cancelled
+        while True:
+            await asyncio.sleep(heartbeat_every)
+            if not queue.heartbeat(unit["id"], worker, lease_seconds) and verbose:
+                print(f"{worker}: lost the lease on unit {unit['id']}; finishing it anyway (duplicates are dropped when merging)")
+
+    async def run_units():
+        nonlocal n_units
+        while True:
+            unit = queue.claim(worker, lease_seconds)
+            if unit is None:
+                progress = queue.progress()
+                if progress["pending"] + progress["leased"] == 0:
+                    return
+                await asyncio.sleep(poll_every) # Others hold the rest; their leases may still run out
+                continue
+            heartbeat = asyncio.ensure_future(keep_lease(unit))
+            try:
+                plans = load_plans(unit["goal"], plan_set)
+                await asyncio.gather(*[async_single_prompt_experiment(scheduler, unit["model"], code, unit["goal"], plans,
+                                                                      run_log=run_log) for code in unit["codes"]])
+                queue.complete(unit["id"], worker)
+                n_units += 1
+            except Exception as e: # Let another attempt (maybe another worker) have it
+                queue.release(unit["id"], worker, f"{type(e).__name__}: {e}")
+                if verbose:
+                    print(f"{worker}: unit {unit['id']} failed ({type(e).__name__}: {e})")
+            finally:
+                heartbeat.cancel()
+
+    try:
+        await asyncio.gather(*[run_units() for _ in range(parallel_units)])
+    finally:
+        run_log.close()
+        queue.close()
+        if backend is not None and hasattr(backend, "aclose"): # Connection pools belong to this event loop
+            await backend.aclose()
+    if verbose:
+        print(f"{worker}: finished {n_units} units in {time.time()-t1:.2f} seconds "
+              f"({scheduler.n_calls} calls, {scheduler.n_retries} retries).")
+    return n_units
+
+# Function: run_worker
+# Purpose: synchronous entry point for work
+# Parameters: dest, a string of the shared sweep folder
+#             **kwargs, passed to work
+# Produces: n_units, an integer of how many units this worker finished
+def run_worker(dest, **kwargs):
+    return asyncio.run(work(dest, **kwargs))
+
+# Function: merge_shards
+# Purpose: combine every worker's shard into one result store (dest/store) and per-goal csv's (dest/<goal>.csv for a single model,
+#          dest/models/<model>/<goal>.csv for several), keeping the first answer for cells more than one worker ran
+# Parameters: dest, a string of the shared sweep folder
+#             save_csv=True, a boolean of whether to write the csv's as well
+#             n_permutations=6, an integer of how many plan orderings make a complete cell; incomplete cells (from units that
+#                 were still running) are kept in the store but left out of the averages
+# Produces: experiments, a dictionary of multi-goal experiment dictionaries (keyed by goal and then code), keyed by model
+def merge_shards(dest, save_csv=True, n_permutations=6):
+    cells = {}
+    shards = os.path.join(dest, "shards")
+    for worker in sorted(os.listdir(shards)) if os.path.isdir(shards) else []:
+        for r in read_run_log(os.path.join(shards, worker, "run_log.jsonl")):
+            key = (r["model"], r["goal"], r["code"], r["permutation"])
+            if key not in cells or r["time"] < cells[key]["time"]:
+                cells[key] = r
+    records = sorted(cells.values(), key=lambda r: (r["model"], r["goal"], r["code"], r["permutation"]))
+    write_part(make_table([r["model"] for r in records], [r["goal"] for r in records], [r["code"] for r in records],
+                          [r["permutation"] for r in records], [r["choice"] for r in records], [r["ps"] for r in records],
+                          [r["time"] for r in records]), os.path.join(dest, "store"), part="shards")
+
+    sums = {}
+    for r in records:
+        cell = sums.setdefault(r["model"], {}).setdefault(r["goal"], {}).setdefault(r["code"], [0.0, 0])
+        cell[0] += r["ps"]
+        cell[1] += 1
+    experiments = {model: {goal: {code: s / n for code, (s, n) in scores.items() if n == n_permutations}
+                           for goal, scores in goals.items()} for model, goals in sums.items()}
+    for model, experiment in experiments.items() if save_csv else []:
+        folder = dest if len(experiments) == 1 else os.path.join(dest, "models", model)
+        os.makedirs(folder, exist_ok=True)
+        experiment_to_csv(experiment, folder if folder[-1] == "/" else folder + "/")
+    return experiments